@@ -0,0 +1,350 @@
+##################################################
+# Timings of the HIRO hot paths on synthetic data (no MuJoCo)
+#
+#   python benchmarks/run.py --out baseline.json
+#   python benchmarks/run.py --compare baseline.json
+#
+# Every case reports the median and best time per call over --repeat runs.
+# With --compare, cases whose median got more than --tolerance slower than
+# in the stored results are flagged and the exit status is 1.
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import numpy as np
+import torch
+import gym
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from hiro.models import HiroAgent, HigherController, LowerController
+from hiro.hiro_utils import LowReplayBuffer, HighReplayBuffer, Subgoal
+from hiro.utils import get_tensor, device
+from envs import make_env, EnvWithGoal, maze_env
+from envs.point_maze_env import VecPointMazeEnv
+
+# Dimensions of AntMaze
+STATE_DIM = 31
+ACTION_DIM = 8
+GOAL_DIM = 2
+SUBGOAL_DIM = 15
+FREQ = 10
+SCALE_LOW = 30 * np.ones(ACTION_DIM)
+SCALE_HIGH = Subgoal(SUBGOAL_DIM).action_space.high * np.ones(SUBGOAL_DIM)
+
+
+class StubEnv(object):
+    # Stand-in for EnvWithGoal that keeps returning one random observation
+    def __init__(self):
+        self.action_space = gym.spaces.Box(-30, 30, (ACTION_DIM,))
+        self.obs = {
+            'observation': np.random.randn(STATE_DIM),
+            'achieved_goal': np.zeros(GOAL_DIM),
+            'desired_goal': np.zeros(GOAL_DIM)}
+
+    def step(self, a):
+        return self.obs, -1., False, {}
+
+
+def stub_ant_maze_env():
+    # AntMazeEnv whose simulator does nothing, to time the code around it.
+    # None without mujoco_py: importing gym.envs.mujoco needs it.
+    try:
+        from envs.ant import AntEnv
+    except (ImportError, gym.error.DependencyNotInstalled):
+        return None
+
+    class StubAntEnv(AntEnv):
+        dt = 0.05
+        frame_skip = 5
+
+        def __init__(self, file_path=None):
+            self._expose_all_qpos = True
+            self._expose_body_coms = None
+            self._expose_body_comvels = None
+            self._init_obs_layout()
+            self.data = type('StubData', (), {'qpos': np.random.randn(15), 'qvel': np.random.randn(14)})()
+            self.action_space = gym.spaces.Box(-30, 30, (ACTION_DIM,))
+            self._com = np.zeros(3)
+
+        def do_simulation(self, a, frame_skip):
+            pass
+
+        def get_body_com(self, name):
+            return self._com
+
+        def reset(self):
+            return self._get_obs()
+
+    class StubAntMazeEnv(maze_env.MazeEnv):
+        MODEL_CLASS = StubAntEnv
+
+    return StubAntMazeEnv
+
+
+def randn(*shape):
+    return np.random.randn(*shape).astype(np.float32)
+
+def fill_low(buffer, n, chunk=10000):
+    while buffer.size < n:
+        c = min(chunk, n - buffer.size)
+        buffer.append_batch(
+            randn(c, STATE_DIM), randn(c, SUBGOAL_DIM), randn(c, ACTION_DIM), randn(c, STATE_DIM),
+            randn(c, SUBGOAL_DIM), randn(c), np.zeros(c))
+    return buffer
+
+def fill_high(buffer, n, chunk=10000):
+    while buffer.size < n:
+        c = min(chunk, n - buffer.size)
+        buffer.append_batch(
+            randn(c, STATE_DIM), randn(c, GOAL_DIM), randn(c, SUBGOAL_DIM), randn(c, STATE_DIM),
+            randn(c), np.zeros(c), randn(c, FREQ, STATE_DIM), randn(c, FREQ, ACTION_DIM))
+    return buffer
+
+def tensor(*shape):
+    return torch.randn(*shape, device=device)
+
+
+# Every case builds its inputs and returns the function to time
+def sample_low(buffer_size, batch_size=100):
+    buffer = fill_low(LowReplayBuffer(STATE_DIM, SUBGOAL_DIM, ACTION_DIM, buffer_size, batch_size), buffer_size)
+    return buffer.sample
+
+def sample_high(buffer_size, batch_size=100):
+    buffer = HighReplayBuffer(STATE_DIM, GOAL_DIM, SUBGOAL_DIM, ACTION_DIM, buffer_size, batch_size, FREQ)
+    return fill_high(buffer, buffer_size).sample
+
+def off_policy_corrections(batch_size=100):
+    high_con = HigherController(STATE_DIM, GOAL_DIM, SUBGOAL_DIM, SCALE_HIGH, 'model')
+    low_con = LowerController(STATE_DIM, SUBGOAL_DIM, ACTION_DIM, SCALE_LOW, 'model')
+    sgoals = tensor(batch_size, SUBGOAL_DIM)
+    states = tensor(batch_size, FREQ, STATE_DIM)
+    actions = tensor(batch_size, FREQ, ACTION_DIM)
+    return lambda: high_con.off_policy_corrections(low_con, batch_size, sgoals, states, actions)
+
+def td3_train(batch_size, fused_critic=False):
+    # One update of the lower controller; every second one also updates the
+    # actor and the targets (policy_freq=2), so time pairs of updates
+    con = LowerController(STATE_DIM, SUBGOAL_DIM, ACTION_DIM, SCALE_LOW, 'model', fused_critic=fused_critic)
+    states, n_states = tensor(batch_size, STATE_DIM), tensor(batch_size, STATE_DIM)
+    sgoals, n_sgoals = tensor(batch_size, SUBGOAL_DIM), tensor(batch_size, SUBGOAL_DIM)
+    actions = tensor(batch_size, ACTION_DIM)
+    rewards, not_done = tensor(batch_size, 1), torch.ones(batch_size, 1, device=device)
+    def train():
+        con._train(states, sgoals, actions, rewards, n_states, n_sgoals, not_done)
+        con._train(states, sgoals, actions, rewards, n_states, n_sgoals, not_done)
+    return train
+
+def train_utd(utd, batch_size=100, buffer_size=100000):
+    # Lower and higher controller updates, sampled from replay buffers and
+    # utd at a time; timed per pair of updates
+    low_buffer = fill_low(LowReplayBuffer(STATE_DIM, SUBGOAL_DIM, ACTION_DIM, buffer_size, batch_size), buffer_size)
+    high_buffer = HighReplayBuffer(STATE_DIM, GOAL_DIM, SUBGOAL_DIM, ACTION_DIM, buffer_size // FREQ, batch_size, FREQ)
+    fill_high(high_buffer, buffer_size // FREQ)
+    high_con = HigherController(STATE_DIM, GOAL_DIM, SUBGOAL_DIM, SCALE_HIGH, 'model')
+    low_con = LowerController(STATE_DIM, SUBGOAL_DIM, ACTION_DIM, SCALE_LOW, 'model')
+    def train():
+        low_con.train(low_buffer, utd)
+        high_con.train(high_buffer, low_con, utd)
+    return train
+
+def target_update(mode):
+    # One Polyak update of the lower controller's targets: both critics and
+    # the actor
+    con = LowerController(STATE_DIM, SUBGOAL_DIM, ACTION_DIM, SCALE_LOW, 'model', target_update=mode)
+    return lambda: con._update_target_networks(con.tau)
+
+def act(rows, noise=False):
+    # TD3Controller.policy()/policy_with_noise() on NumPy observations
+    con = LowerController(STATE_DIM, SUBGOAL_DIM, ACTION_DIM, SCALE_LOW, 'model')
+    states, sgoals = np.random.randn(rows, STATE_DIM).squeeze(), np.random.randn(rows, SUBGOAL_DIM).squeeze()
+    return lambda: con.act(states, sgoals, noise)
+
+def to_tensor(batch_size):
+    z = np.random.randn(STATE_DIM) if batch_size == 1 else np.random.randn(batch_size, STATE_DIM)
+    return lambda: get_tensor(z)
+
+def agent_step():
+    # A full window of HiroAgent.step: the high policy runs on the first step
+    agent = HiroAgent(
+        state_dim=STATE_DIM,
+        action_dim=ACTION_DIM,
+        goal_dim=GOAL_DIM,
+        subgoal_dim=SUBGOAL_DIM,
+        scale_low=SCALE_LOW,
+        start_training_steps=0,
+        model_path='model',
+        model_save_freq=1000,
+        buffer_size=1000,
+        batch_size=100,
+        buffer_freq=FREQ,
+        train_freq=10,
+        reward_scaling=0.1,
+        policy_freq_high=2,
+        policy_freq_low=2)
+    env = StubEnv()
+    s = env.obs['observation']
+    agent.set_final_goal(np.zeros(GOAL_DIM))
+    def step():
+        for step in range(FREQ):
+            agent.step(s, env, step, global_step=1, explore=True)
+            agent.end_step()
+    return step
+
+def point_env_step(num_envs=1):
+    # EnvWithGoal(PointMazeEnv), or num_envs of them in a VecPointMazeEnv
+    env = make_env('PointMaze') if num_envs == 1 else VecPointMazeEnv('PointMaze', num_envs, seed=0)
+    env.reset()
+    a = np.random.uniform(-30, 30, (num_envs, ACTION_DIM))
+    if num_envs == 1:
+        a = a[0]
+    def step():
+        # Episodes are never reset, which does not change the cost of a step
+        env.step(a)
+    return step
+
+def ant_env_step(env_cls, obs_buffer=False):
+    # EnvWithGoal(AntMazeEnv) step without the simulation
+    env = EnvWithGoal(env_cls(maze_id='Maze'), 'AntMaze', obs_buffer)
+    env.reset()
+    a = np.zeros(ACTION_DIM)
+    return lambda: env.step(a)
+
+def cases(buffer_sizes, batch_sizes):
+    # name -> (setup, number of calls the time is divided by)
+    cases = {}
+    for n in buffer_sizes:
+        cases['sample_low/%d' % n] = (lambda n=n: sample_low(n), 1)
+        # One high transition per FREQ low ones
+        cases['sample_high/%d' % (n // FREQ)] = (lambda n=n: sample_high(n // FREQ), 1)
+    cases['off_policy_corrections/100'] = (off_policy_corrections, 1)
+    for b in batch_sizes:
+        cases['td3_train/%d' % b] = (lambda b=b: td3_train(b), 2)
+        cases['td3_train/%d/fused_critic' % b] = (lambda b=b: td3_train(b, fused_critic=True), 2)
+    for utd in (1, 8):
+        cases['train/utd%d' % utd] = (lambda utd=utd: train_utd(utd), utd)
+    for mode in ('loop', 'foreach', 'flat'):
+        cases['target_update/%s' % mode] = (lambda mode=mode: target_update(mode), 1)
+    for rows in (1, 64):
+        cases['act/%d' % rows] = (lambda rows=rows: act(rows), 1)
+        cases['act/%d/noise' % rows] = (lambda rows=rows: act(rows, noise=True), 1)
+    cases['get_tensor/1'] = (lambda: to_tensor(1), 1)
+    cases['get_tensor/100'] = (lambda: to_tensor(100), 1)
+    cases['agent_step'] = (agent_step, FREQ)
+    ant_env = stub_ant_maze_env()
+    if ant_env is not None:
+        cases['ant_env_overhead'] = (lambda: ant_env_step(ant_env), 1)
+        cases['ant_env_overhead/obs_buffer'] = (lambda: ant_env_step(ant_env, True), 1)
+    cases['point_env_step'] = (point_env_step, 1)
+    cases['vec_point_env_step/64'] = (lambda: point_env_step(64), 64)
+    return cases
+
+
+def measure(fn, repeat=5, min_time=0.2):
+    # Seconds per call of fn: the number of calls per run is chosen so that
+    # one run takes at least min_time
+    def run(number):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        return time.perf_counter() - start
+
+    run(1)
+    number = 1
+    while True:
+        elapsed = run(number)
+        if elapsed >= min_time:
+            break
+        number = max(number * 2, int(number * min_time / max(elapsed, 1e-9)))
+    times = [elapsed / number] + [run(number) / number for _ in range(repeat - 1)]
+    return times, number
+
+def run_benchmarks(names=None, buffer_sizes=(10000, 100000, 1000000), batch_sizes=(100, 256, 1024),
+                   repeat=5, min_time=0.2, verbose=True):
+    results = {}
+    for name, (setup, calls) in cases(buffer_sizes, batch_sizes).items():
+        if names and not any(pattern in name for pattern in names):
+            continue
+        np.random.seed(0)
+        torch.manual_seed(0)
+        fn = setup()
+        times, number = measure(fn, repeat, min_time)
+        times = np.array(times) / calls
+        results[name] = {
+            'median_us': 1e6 * float(np.median(times)),
+            'min_us': 1e6 * float(np.min(times)),
+            'number': number * calls,
+            'repeat': repeat,
+        }
+        if verbose:
+            print('%-32s %12.1f us %12.1f us' % (name, results[name]['median_us'], results[name]['min_us']))
+    return results
+
+def environment():
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'torch': torch.__version__,
+        'device': str(device),
+        'threads': torch.get_num_threads(),
+        'machine': platform.machine(),
+    }
+
+def compare(results, baseline, tolerance=0.1):
+    # Names of the cases whose median is more than tolerance slower than in
+    # baseline; cases missing from either side are skipped
+    regressions = []
+    print('%-32s %12s %12s %8s' % ('case', 'baseline', 'current', 'ratio'))
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result['median_us'] / baseline[name]['median_us']
+        flag = ''
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print('%-32s %9.1f us %9.1f us %7.2fx%s' % (name, baseline[name]['median_us'], result['median_us'], ratio, flag))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('cases', nargs='*', help='Only run cases whose name contains one of these')
+    parser.add_argument('--out', default=None, type=str, help='Write the results to this JSON file')
+    parser.add_argument('--compare', default=None, type=str, help='JSON file of earlier results to check for regressions')
+    parser.add_argument('--tolerance', default=0.1, type=float, help='Slowdown of the median flagged as a regression')
+    parser.add_argument('--repeat', default=5, type=int)
+    parser.add_argument('--min_time', default=0.2, type=float, help='Unit = Second, minimum duration of one run')
+    parser.add_argument('--buffer_sizes', default=[10000, 100000, 1000000], type=int, nargs='+')
+    parser.add_argument('--batch_sizes', default=[100, 256, 1024], type=int, nargs='+')
+    parser.add_argument('--threads', default=None, type=int, help='torch.set_num_threads, default: torch default')
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    print('%-32s %15s %15s' % ('case', 'median', 'min'))
+    results = run_benchmarks(args.cases, args.buffer_sizes, args.batch_sizes, args.repeat, args.min_time)
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump({'environment': environment(), 'results': results}, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print()
+        regressions = compare(results, baseline['results'], args.tolerance)
+        if regressions:
+            print('%d regression(s): %s' % (len(regressions), ', '.join(regressions)))
+            sys.exit(1)
@@ -5,9 +5,14 @@ import argparse
 
 import envs.create_maze_env
 
+# Episodes of EnvWithGoal end after this many steps
+MAX_EPISODE_STEPS = 500
 
+
+# PointMaze, PointPush and PointFall (envs/point_maze_env.py) share the
+# goals and rewards of the ant task on the same maze
 def get_goal_sample_fn(env_name, evaluate):
-    if env_name == 'AntMaze':
+    if env_name in ('AntMaze', 'PointMaze'):
         # NOTE: When evaluating (i.e. the metrics shown in the paper,
         # we use the commented out goal sampling function.    The uncommented
         # one is only used for training.
@@ -15,31 +20,59 @@ def get_goal_sample_fn(env_name, evaluate):
             return lambda: np.array([0., 16.])
         else:
             return lambda: np.random.uniform((-4, -4), (20, 20))
-    elif env_name == 'AntPush':
+    elif env_name in ('AntPush', 'PointPush'):
         return lambda: np.array([0., 19.])
-    elif env_name == 'AntFall':
+    elif env_name in ('AntFall', 'PointFall'):
         return lambda: np.array([0., 27., 4.5])
     else:
         assert False, 'Unknown env'
 
 
 def get_reward_fn(env_name):
-    if env_name == 'AntMaze':
+    if env_name in ('AntMaze', 'PointMaze'):
         return lambda obs, goal: -np.sum(np.square(obs[:2] - goal)) ** 0.5
-    elif env_name == 'AntPush':
+    elif env_name in ('AntPush', 'PointPush'):
         return lambda obs, goal: -np.sum(np.square(obs[:2] - goal)) ** 0.5
-    elif env_name == 'AntFall':
+    elif env_name in ('AntFall', 'PointFall'):
         return lambda obs, goal: -np.sum(np.square(obs[:3] - goal)) ** 0.5
     else:
         assert False, 'Unknown env'
 
 
+def goal_reward(obs, goal, goal_dim):
+    # Batched get_reward_fn: -||obs[..., :goal_dim] - goal|| over any leading
+    # axes, for NumPy arrays and torch tensors alike
+    return -(((obs[..., :goal_dim] - goal) ** 2).sum(-1) ** 0.5)
+
+
+def get_batch_reward_fn(env_name):
+    goal_dim = get_goal_dim(env_name)
+    return lambda obs, goal: goal_reward(obs, goal, goal_dim)
+
+
+def get_goal_dim(env_name):
+    # Number of leading observation entries compared with the goal
+    return 3 if env_name in ('AntFall', 'PointFall') else 2
+
+
+def env_dims(env_name):
+    # (state_dim, goal_dim, action_dim, action_high) of make_env(env_name),
+    # without starting a simulator
+    obs_dim, action_high = create_maze_env.maze_env_dims(env_name)
+    return obs_dim + 1, get_goal_dim(env_name), len(action_high), action_high.copy()
+
+
 def success_fn(last_reward):
+    # Elementwise for arrays and tensors of rewards as well
     return last_reward > -5.0
 
 
 class EnvWithGoal(object):
-    def __init__(self, base_env, env_name):
+    # With obs_buffer, every observation is written into the same
+    # preallocated array, which is only valid until the next step or reset.
+    # That suits callers that copy or send it right away (e.g. vec env
+    # workers). Otherwise each step allocates just the returned array.
+    def __init__(self, base_env, env_name, obs_buffer=False):
         self.base_env = base_env
         self.env_name = env_name
         self.evaluate = False
@@ -49,6 +82,7 @@ class EnvWithGoal(object):
         self.count = 0
         self.state_dim = self.base_env.observation_space.shape[0] + 1
         self.action_dim = self.base_env.action_space.shape[0]
+        self.obs_buffer = np.empty(self.state_dim) if obs_buffer else None
 
     def seed(self, seed):
         self.base_env.seed(seed)
@@ -56,27 +90,36 @@ class EnvWithGoal(object):
     def reset(self):
         # self.viewer_setup()
         self.goal_sample_fn = get_goal_sample_fn(self.env_name, self.evaluate)
-        obs = self.base_env.reset()
+        obs = self._obs_array()
+        self.base_env.reset(out=obs[:-1])
         self.count = 0
         self.goal = self.goal_sample_fn()
+        # add timestep
+        obs[-1] = self.count
         return {
-            # add timestep
-            'observation': np.r_[obs.copy(), self.count], 
+            'observation': obs,
             'achieved_goal': obs[:2],
             'desired_goal': self.goal,
         }
 
     def step(self, a):
-        obs, _, done, info = self.base_env.step(a)
+        obs = self._obs_array()
+        _, _, done, info = self.base_env.step(a, out=obs[:-1])
         reward = self.reward_fn(obs, self.goal)
         self.count += 1
+        # add timestep
+        obs[-1] = self.count
         next_obs = {
-            # add timestep
-            'observation': np.r_[obs.copy(), self.count],
+            'observation': obs,
             'achieved_goal': obs[:2],
             'desired_goal': self.goal,
         }
-        return next_obs, reward, done or self.count >= 500, info
+        return next_obs, reward, done or self.count >= MAX_EPISODE_STEPS, info
+
+    def _obs_array(self):
+        if self.obs_buffer is not None:
+            return self.obs_buffer
+        return np.empty(self.state_dim)
 
     def render(self):
         self.base_env.render()
@@ -103,6 +146,9 @@ class EnvWithGoal(object):
     def observation_space(self):
         return self.base_env.observation_space
 
+def make_env(env_name, obs_buffer=False):
+    return EnvWithGoal(create_maze_env.create_maze_env(env_name), env_name, obs_buffer)
+
 def run_environment(env_name, episode_length, num_episodes):
     env = EnvWithGoal(
             create_maze_env.create_maze_env(env_name),
@@ -15,11 +15,37 @@
 
 """Wrapper for creating the ant environment in gym_mujoco."""
 
+import os
 import math
+import contextlib
 import numpy as np
 from gym import utils
 from gym.envs.mujoco import mujoco_env
 
+# Loaded models by (path, modification time, size). Envs of one process
+# share the model of a file and only get their own MjSim.
+_models = {}
+
+
+@contextlib.contextmanager
+def _shared_models():
+  # MujocoEnv.__init__ loads the model itself, so its loader is swapped for
+  # a cached one while an env is constructed
+  load = mujoco_env.mujoco_py.load_model_from_path
+
+  def load_cached(path):
+    stat = os.stat(path)
+    key = (path, stat.st_mtime, stat.st_size)
+    if key not in _models:
+      _models[key] = load(path)
+    return _models[key]
+
+  mujoco_env.mujoco_py.load_model_from_path = load_cached
+  try:
+    yield
+  finally:
+    mujoco_env.mujoco_py.load_model_from_path = load
+
 
 class AntEnv(mujoco_env.MujocoEnv, utils.EzPickle):
   FILE = "ant.xml"
@@ -29,20 +55,35 @@ class AntEnv(mujoco_env.MujocoEnv, utils.EzPickle):
     self._expose_all_qpos = expose_all_qpos
     self._expose_body_coms = expose_body_coms
     self._expose_body_comvels = expose_body_comvels
-    self._body_com_indices = {}
-    self._body_comvel_indices = {}
+    self._init_obs_layout()
 
-    mujoco_env.MujocoEnv.__init__(self, file_path, 5)
+    with _shared_models():
+      mujoco_env.MujocoEnv.__init__(self, file_path, 5)
     utils.EzPickle.__init__(self)
 
   @property
   def physics(self):
     return self.model
 
+  def _init_obs_layout(self):
+    # The observation is qpos[2 or 0:15], qvel[:14], then 3 entries per
+    # exposed body com and comvel. Their index ranges are fixed up front.
+    self._qpos_start = 0 if self._expose_all_qpos else 2
+    size = (15 - self._qpos_start) + 14
+    self._body_com_indices = {}
+    self._body_comvel_indices = {}
+    for name in self._expose_body_coms or []:
+      self._body_com_indices[name] = range(size, size + 3)
+      size += 3
+    for name in self._expose_body_comvels or []:
+      self._body_comvel_indices[name] = range(size, size + 3)
+      size += 3
+    self.obs_dim = size
+
   def _step(self, a):
     return self.step(a)
 
-  def step(self, a):
+  def step(self, a, out=None):
     xposbefore = self.get_body_com("torso")[0]
     self.do_simulation(a, self.frame_skip)
     xposafter = self.get_body_com("torso")[0]
@@ -50,43 +91,26 @@ class AntEnv(mujoco_env.MujocoEnv, utils.EzPickle):
     ctrl_cost = .5 * np.square(a).sum()
     survive_reward = 1.0
     reward = forward_reward - ctrl_cost + survive_reward
-    state = self.state_vector()
     done = False
-    ob = self._get_obs()
+    ob = self._get_obs(out)
     return ob, reward, done, dict(
         reward_forward=forward_reward,
         reward_ctrl=-ctrl_cost,
         reward_survive=survive_reward)
 
-  def _get_obs(self):
-    # No cfrc observation
-    if self._expose_all_qpos:
-      obs = np.concatenate([
-          self.data.qpos.flat[:15],  # Ensures only ant obs.
-          self.data.qvel.flat[:14],
-      ])
-    else:
-      obs = np.concatenate([
-          self.data.qpos.flat[2:15],
-          self.data.qvel.flat[:14],
-      ])
-
-    if self._expose_body_coms is not None:
-      for name in self._expose_body_coms:
-        com = self.get_body_com(name)
-        if name not in self._body_com_indices:
-          indices = range(len(obs), len(obs) + len(com))
-          self._body_com_indices[name] = indices
-        obs = np.concatenate([obs, com])
-
-    if self._expose_body_comvels is not None:
-      for name in self._expose_body_comvels:
-        comvel = self.get_body_comvel(name)
-        if name not in self._body_comvel_indices:
-          indices = range(len(obs), len(obs) + len(comvel))
-          self._body_comvel_indices[name] = indices
-        obs = np.concatenate([obs, comvel])
-    return obs
+  def _get_obs(self, out=None):
+    # No cfrc observation. Written into out (obs_dim entries) if given.
+    if out is None:
+      out = np.empty(self.obs_dim)
+    n_qpos = 15 - self._qpos_start
+    out[:n_qpos] = self.data.qpos[self._qpos_start:15]  # Ensures only ant obs.
+    out[n_qpos:n_qpos + 14] = self.data.qvel[:14]
+
+    for name, indices in self._body_com_indices.items():
+      out[indices.start:indices.stop] = self.get_body_com(name)
+    for name, indices in self._body_comvel_indices.items():
+      out[indices.start:indices.stop] = self.get_body_comvel(name)
+    return out
 
   def reset_model(self):
     qpos = self.init_qpos + self.np_random.uniform(
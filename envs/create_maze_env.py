@@ -13,10 +13,44 @@
 # limitations under the License.
 # ==============================================================================
 
-from .ant_maze_env import AntMazeEnv
+
+import os
+import functools
+import xml.etree.ElementTree as ET
+import numpy as np
+
+# Size of AntEnv's default observation, qpos[:15] and qvel[:14], plus the
+# time feature of MazeEnv
+ANT_MAZE_OBS_DIM = 15 + 14 + 1
+
+
+@functools.lru_cache(maxsize=None)
+def maze_env_dims(env_name):
+  """(obs_dim, action_high) of create_maze_env(env_name) without building it.
+
+  The ant's action bounds are the ctrlrange of the motors in its model file.
+  """
+  if env_name.startswith('Point'):
+    from .point_maze_env import OBS_DIM, ACTION_DIM, ACTION_HIGH
+    return OBS_DIM, np.full(ACTION_DIM, ACTION_HIGH)
+  if not env_name.startswith(('AntMaze', 'AntPush', 'AntFall')):
+    raise ValueError('Unknown maze environment %s' % env_name)
+
+  tree = ET.parse(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'assets', 'ant.xml'))
+  motors = tree.findall('.//actuator/motor')
+  action_high = np.array([float(motor.get('ctrlrange').split()[1]) for motor in motors])
+  return ANT_MAZE_OBS_DIM, action_high
 
 
 def create_maze_env(env_name=None):
+  if env_name.startswith('Point'):
+    # NumPy point mass, see point_maze_env.py
+    from .point_maze_env import PointMazeEnv, maze_id_of
+    return PointMazeEnv(maze_id=maze_id_of(env_name))
+
+  # Imported here so that envs can be imported without mujoco_py
+  from .ant_maze_env import AntMazeEnv
+
   maze_id = None
   if env_name.startswith('AntMaze'):
     maze_id = 'Maze'
@@ -16,6 +16,7 @@
 """Adapted from rllab maze_env.py."""
 
 import os
+import hashlib
 import tempfile
 import xml.etree.ElementTree as ET
 import math
@@ -25,7 +26,31 @@ import gym
 from envs import maze_env_utils
 
 # Directory that contains mujoco xml files.
-MODEL_DIR = 'assets'
+MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'assets')
+
+# Generated maze models are content-addressed: one file per model file and
+# maze configuration, shared by every env (and process) that uses it.
+XML_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'hiro_maze_xml')
+
+
+def _xml_cache_path(xml_path, maze_id, maze_height, maze_size_scaling):
+  with open(xml_path, 'rb') as f:
+    key = hashlib.sha1(f.read())
+  key.update(repr((maze_id, float(maze_height), float(maze_size_scaling))).encode())
+  return os.path.join(XML_CACHE_DIR, '%s_%s.xml' % (maze_id, key.hexdigest()[:16]))
+
+
+def _write_xml(tree, path):
+  # Written to a file of this process and renamed, so other processes never
+  # see a partial file
+  os.makedirs(XML_CACHE_DIR, exist_ok=True)
+  tmp_path = '%s.%d.tmp' % (path, os.getpid())
+  try:
+    tree.write(tmp_path)
+    os.replace(tmp_path, path)
+  finally:
+    if os.path.exists(tmp_path):
+      os.remove(tmp_path)
 
 
 class MazeEnv(gym.Env):
@@ -47,12 +72,10 @@ class MazeEnv(gym.Env):
     model_cls = self.__class__.MODEL_CLASS
     if model_cls is None:
       raise "MODEL_CLASS unspecified!"
-    xml_path = os.path.join("envs", MODEL_DIR, model_cls.FILE)
-    tree = ET.parse(xml_path)
-    worldbody = tree.find(".//worldbody")
+    xml_path = os.path.join(MODEL_DIR, model_cls.FILE)
 
-    self.MAZE_HEIGHT = height = maze_height
-    self.MAZE_SIZE_SCALING = size_scaling = maze_size_scaling
+    self.MAZE_HEIGHT = maze_height
+    self.MAZE_SIZE_SCALING = maze_size_scaling
     self.MAZE_STRUCTURE = structure = maze_env_utils.construct_maze(maze_id=self._maze_id)
     self.elevated = any(-1 in row for row in structure)  # Elevate the maze to allow for falling.
     self.blocks = any(
@@ -63,6 +86,23 @@ class MazeEnv(gym.Env):
     self._init_torso_x = torso_x
     self._init_torso_y = torso_y
 
+    # The maze is only built when no env has generated it before
+    file_path = _xml_cache_path(xml_path, maze_id, maze_height, maze_size_scaling)
+    if not os.path.exists(file_path):
+      _write_xml(self._build_tree(xml_path), file_path)
+
+    self.wrapped_env = model_cls(*args, file_path=file_path, **kwargs)
+    self._observation_space = None
+
+  def _build_tree(self, xml_path):
+    tree = ET.parse(xml_path)
+    worldbody = tree.find(".//worldbody")
+
+    height = self.MAZE_HEIGHT
+    size_scaling = self.MAZE_SIZE_SCALING
+    structure = self.MAZE_STRUCTURE
+    torso_x, torso_y = self._init_torso_x, self._init_torso_y
+
     height_offset = 0.
     if self.elevated:
       # Increase initial z-pos of ant.
@@ -186,19 +226,24 @@ class MazeEnv(gym.Env):
         raise Exception("Every geom of the torso must have a name "
                         "defined")
 
-    _, file_path = tempfile.mkstemp(text=True, suffix=".xml")
-    tree.write(file_path)
+    return tree
 
-    self.wrapped_env = model_cls(*args, file_path=file_path, **kwargs)
+  def _get_obs(self, out=None):
+    # Observation of the wrapped env and the time, written into out if given
+    if out is None:
+      out = np.empty(self.wrapped_env.obs_dim + 1)
+    self.wrapped_env._get_obs(out[:-1])
+    out[-1] = self.t * 0.001
+    return out
 
-  def _get_obs(self):
-    return np.concatenate([self.wrapped_env._get_obs(),
-                           [self.t * 0.001]])
+  def seed(self, seed=None):
+    # The start noise of reset_model comes from the wrapped env's np_random
+    return self.wrapped_env.seed(seed)
 
-  def reset(self):
+  def reset(self, out=None):
     self.t = 0
     self.wrapped_env.reset()
-    return self._get_obs()
+    return self._get_obs(out)
 
   @property
   def viewer(self):
@@ -209,10 +254,13 @@ class MazeEnv(gym.Env):
 
   @property
   def observation_space(self):
-    shape = self._get_obs().shape
-    high = np.inf * np.ones(shape)
-    low = -high
-    return gym.spaces.Box(low, high)
+    # Built once: the observation size is fixed by the wrapped env
+    if self._observation_space is None:
+      shape = (self.wrapped_env.obs_dim + 1,)
+      high = np.inf * np.ones(shape)
+      low = -high
+      self._observation_space = gym.spaces.Box(low, high)
+    return self._observation_space
 
   @property
   def action_space(self):
@@ -227,9 +275,13 @@ class MazeEnv(gym.Env):
           return j * size_scaling, i * size_scaling
     assert False, 'No robot in maze specification.'
 
-  def step(self, action):
+  def step(self, action, out=None):
     self.t += 1
-    inner_next_obs, inner_reward, done, info = self.wrapped_env.step(action)
-    next_obs = self._get_obs()
+    if out is None:
+      out = np.empty(self.wrapped_env.obs_dim + 1)
+    # The wrapped env writes its observation in front of the time
+    inner_next_obs, inner_reward, done, info = self.wrapped_env.step(action, out[:-1])
+    out[-1] = self.t * 0.001
+    next_obs = out
     done = False
     return next_obs, inner_reward, done, info
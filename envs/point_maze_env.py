@@ -0,0 +1,187 @@
+"""Point mass in the maze layouts of maze_env_utils, simulated in NumPy.
+
+A fast stand-in for AntMazeEnv: no MuJoCo, same observation and action
+sizes, same maze geometry. The 8-dim action (range [-30, 30] like the ant's
+motors) is read as four 2-D pushes; their mean moves the point by at most
+max_speed per step. The point is a square of half-width radius and slides
+along the walls of the block grid.
+
+Observations use the 30 dims of MazeEnv:
+  [0:2] x, y   [2] z   [3:7] orientation quaternion   [7:15] last action / 30
+  [15:17] x, y displacement of the last step   [17:29] zeros   [29] t * 0.001
+"""
+
+import numpy as np
+import gym
+
+from envs import maze_env_utils, get_goal_sample_fn, get_goal_dim, get_batch_reward_fn, MAX_EPISODE_STEPS
+from envs.vec_env import VecEnv
+
+OBS_DIM = 30
+ACTION_DIM = 8
+ACTION_HIGH = 30.
+TORSO_HEIGHT = 0.75
+
+
+class MazeGrid(object):
+    # Block grid of a maze, in the coordinates of MazeEnv: the robot starts
+    # at the origin and cell (i, j) is centered at
+    # (j * scaling - torso_x, i * scaling - torso_y). Fixed and movable
+    # blocks and chasms (-1) are all walls for the point.
+    def __init__(self, maze_id='Maze', maze_size_scaling=8):
+        structure = maze_env_utils.construct_maze(maze_id=maze_id)
+        self.scaling = maze_size_scaling
+        walls = np.array([[cell not in (0, 'r') for cell in row] for row in structure])
+        # Everything outside the grid is a wall too
+        self.walls = np.pad(walls, 1, constant_values=True)
+        i, j = [(i, j) for i, row in enumerate(structure) for j, cell in enumerate(row) if cell == 'r'][0]
+        self.torso_x, self.torso_y = j * maze_size_scaling, i * maze_size_scaling
+        self._offset = np.array([self.torso_x, self.torso_y])
+        self._corners = np.array([[-1, -1], [-1, 1], [1, -1], [1, 1]])
+        self._last_cell = np.array([self.walls.shape[1] - 1, self.walls.shape[0] - 1])
+
+    def blocked(self, xy, radius):
+        # (n, 2) positions -> (n,) whether the square around them hits a wall
+        corners = xy[:, None, :] + radius * self._corners
+        # Cell of every corner, shifted by the padding
+        cells = np.floor((corners + self._offset) / self.scaling + 1.5).astype(int)
+        cells = np.minimum(np.maximum(cells, 0), self._last_cell)
+        return self.walls[cells[..., 1], cells[..., 0]].any(1)
+
+    def move(self, xy, delta, radius):
+        # Moves every point by delta. A blocked move is retried along x
+        # only, then along y only, so points slide along walls.
+        new = xy + delta
+        blocked = self.blocked(new, radius)
+        if blocked.any():
+            only_x = np.stack([new[:, 0], xy[:, 1]], 1)
+            only_y = np.stack([xy[:, 0], new[:, 1]], 1)
+            x_ok = ~self.blocked(only_x, radius)
+            y_ok = ~self.blocked(only_y, radius)
+            fallback = np.where(x_ok[:, None], only_x, np.where(y_ok[:, None], only_y, xy))
+            new = np.where(blocked[:, None], fallback, new)
+        return new
+
+
+def observations(xy, velocity, actions, t):
+    # (n, OBS_DIM) observations of n points
+    obs = np.zeros((len(xy), OBS_DIM))
+    obs[:, 0:2] = xy
+    obs[:, 2] = TORSO_HEIGHT
+    obs[:, 3] = 1.
+    obs[:, 7:15] = actions / ACTION_HIGH
+    obs[:, 15:17] = velocity
+    obs[:, 29] = t * 0.001
+    return obs
+
+def displacement(actions, max_speed):
+    actions = np.clip(actions, -ACTION_HIGH, ACTION_HIGH)
+    return actions.reshape(len(actions), 4, 2).mean(1) * (max_speed / ACTION_HIGH)
+
+
+class PointMazeEnv(gym.Env):
+    # Drop-in for AntMazeEnv under EnvWithGoal
+    def __init__(self, maze_id='Maze', maze_size_scaling=8, max_speed=0.5, radius=0.5):
+        self.grid = MazeGrid(maze_id, maze_size_scaling)
+        self.max_speed = max_speed
+        self.radius = radius
+        self.action_space = gym.spaces.Box(-ACTION_HIGH, ACTION_HIGH, (ACTION_DIM,))
+        self.observation_space = gym.spaces.Box(-np.inf, np.inf, (OBS_DIM,))
+        self.np_random = np.random.RandomState()
+        self.xy = np.zeros((1, 2))
+        self.t = 0
+
+    def seed(self, seed=None):
+        self.np_random = np.random.RandomState(seed)
+        return [seed]
+
+    def _get_obs(self, velocity=None, action=None, out=None):
+        if velocity is None:
+            velocity, action = np.zeros((1, 2)), np.zeros((1, ACTION_DIM))
+        obs = observations(self.xy, velocity, action, self.t)[0]
+        if out is None:
+            return obs
+        out[:] = obs
+        return out
+
+    def reset(self, out=None):
+        # Same start noise as the ant's reset_model
+        self.t = 0
+        self.xy = self.np_random.uniform(-.1, .1, size=(1, 2))
+        return self._get_obs(out=out)
+
+    def step(self, action, out=None):
+        self.t += 1
+        action = np.asarray(action, dtype=float).reshape(1, ACTION_DIM)
+        xy = self.grid.move(self.xy, displacement(action, self.max_speed), self.radius)
+        velocity, self.xy = xy - self.xy, xy
+        return self._get_obs(velocity, action, out), 0., False, {}
+
+    def render(self, *args, **kwargs):
+        raise NotImplementedError('PointMazeEnv has no viewer')
+
+
+class VecPointMazeEnv(VecEnv):
+    # num_envs EnvWithGoal(PointMazeEnv) stepped together in one NumPy call.
+    # Env i is seeded with seed + i and goals come from np.random as in
+    # EnvWithGoal, so it matches a DummyVecEnv of those envs.
+    def __init__(self, env_name='PointMaze', num_envs=1, seed=None, maze_size_scaling=8,
+                 max_speed=0.5, radius=0.5):
+        self.env_name = env_name
+        self.num_envs = num_envs
+        self.evaluate = False
+        self.grid = MazeGrid(maze_id_of(env_name), maze_size_scaling)
+        self.max_speed = max_speed
+        self.radius = radius
+        self.goal_dim = get_goal_dim(env_name)
+        self.reward_fn = get_batch_reward_fn(env_name)
+
+        self.action_space = gym.spaces.Box(-ACTION_HIGH, ACTION_HIGH, (ACTION_DIM,))
+        self.observation_space = gym.spaces.Box(-np.inf, np.inf, (OBS_DIM,))
+        self.state_dim, self.action_dim = OBS_DIM + 1, ACTION_DIM
+
+        if seed is None:
+            seed = np.random.randint(2**31 - num_envs)
+        self.np_randoms = [np.random.RandomState(seed + i) for i in range(num_envs)]
+        self.xy = np.zeros((num_envs, 2))
+        self.t = np.zeros(num_envs, dtype=int)
+        self.goals = np.zeros((num_envs, self.goal_dim))
+
+    def _obs_dict(self, obs, indices):
+        return {
+            'observation': np.concatenate([obs, self.t[indices, None]], 1),
+            'achieved_goal': obs[:, :2],
+            'desired_goal': self.goals[indices].copy(),
+        }
+
+    def reset(self, indices=None):
+        indices = np.array(self._indices(indices))
+        goal_sample_fn = get_goal_sample_fn(self.env_name, self.evaluate)
+        for i in indices:
+            self.xy[i] = self.np_randoms[i].uniform(-.1, .1, size=2)
+            self.goals[i] = goal_sample_fn()
+        self.t[indices] = 0
+        zeros = np.zeros((len(indices), 2))
+        obs = observations(self.xy[indices], zeros, np.zeros((len(indices), ACTION_DIM)), self.t[indices])
+        return self._obs_dict(obs, indices)
+
+    def step_async(self, actions):
+        self._actions = np.asarray(actions, dtype=float).reshape(self.num_envs, ACTION_DIM)
+
+    def step_wait(self):
+        actions = self._actions
+        self.t += 1
+        xy = self.grid.move(self.xy, displacement(actions, self.max_speed), self.radius)
+        velocity, self.xy = xy - self.xy, xy
+        obs = observations(xy, velocity, actions, self.t)
+        rewards = self.reward_fn(obs, self.goals)
+        dones = self.t >= MAX_EPISODE_STEPS
+        return self._obs_dict(obs, slice(None)), rewards, dones, [{} for _ in range(self.num_envs)]
+
+
+def maze_id_of(env_name):
+    # 'PointMaze' -> 'Maze'
+    for maze_id in ('Maze', 'Push', 'Fall'):
+        if env_name.endswith(maze_id):
+            return maze_id
+    raise ValueError('Unknown maze environment %s' % env_name)
@@ -0,0 +1,137 @@
+"""Run several EnvWithGoal instances side by side and step them as a batch."""
+
+import multiprocessing as mp
+import numpy as np
+
+
+def _stack(obs_list):
+    # List of EnvWithGoal observation dicts -> dict of stacked arrays
+    return {k: np.stack([obs[k] for obs in obs_list]) for k in obs_list[0]}
+
+
+def _worker(remote, parent_remote, env_fn, seed):
+    parent_remote.close()
+    # Forked workers inherit the parent's RNG state, so goals and random
+    # actions would otherwise be identical in every env
+    np.random.seed(seed)
+    env = env_fn()
+    env.seed(seed)
+    try:
+        while True:
+            cmd, data = remote.recv()
+            if cmd == 'step':
+                remote.send(env.step(data))
+            elif cmd == 'reset':
+                remote.send(env.reset())
+            elif cmd == 'spaces':
+                remote.send((env.observation_space, env.action_space, env.state_dim, env.action_dim))
+            elif cmd == 'close':
+                break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        remote.close()
+
+
+class VecEnv(object):
+    # Common interface: observations are dicts of arrays with a leading
+    # num_envs axis, rewards and dones are (num_envs,) arrays. Envs are not
+    # reset automatically; call reset(indices) for the ones that are done.
+    num_envs = 0
+
+    def reset(self, indices=None):
+        raise NotImplementedError
+
+    def step(self, actions):
+        self.step_async(actions)
+        return self.step_wait()
+
+    def step_async(self, actions):
+        raise NotImplementedError
+
+    def step_wait(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def _indices(self, indices):
+        if indices is None:
+            return range(self.num_envs)
+        return np.atleast_1d(indices)
+
+    def _collect(self, results):
+        obs, rewards, dones, infos = zip(*results)
+        return _stack(obs), np.array(rewards), np.array(dones), list(infos)
+
+
+class DummyVecEnv(VecEnv):
+    # Steps every env in this process, one after the other
+    def __init__(self, env_fns, seed=None):
+        self.envs = [fn() for fn in env_fns]
+        self.num_envs = len(self.envs)
+        if seed is not None:
+            for i, env in enumerate(self.envs):
+                env.seed(seed + i)
+        env = self.envs[0]
+        self.observation_space, self.action_space = env.observation_space, env.action_space
+        self.state_dim, self.action_dim = env.state_dim, env.action_dim
+        self._actions = None
+
+    def reset(self, indices=None):
+        return _stack([self.envs[i].reset() for i in self._indices(indices)])
+
+    def step_async(self, actions):
+        self._actions = actions
+
+    def step_wait(self):
+        return self._collect([env.step(a) for env, a in zip(self.envs, self._actions)])
+
+
+class SubprocVecEnv(VecEnv):
+    # One worker process per env. Actions are sent to every worker before
+    # any result is read, so the envs are simulated in parallel.
+    def __init__(self, env_fns, seed=None):
+        self.num_envs = len(env_fns)
+        if seed is None:
+            seed = np.random.randint(2**31 - self.num_envs)
+
+        self.remotes, work_remotes = zip(*[mp.Pipe() for _ in range(self.num_envs)])
+        self.processes = []
+        for i, (remote, work_remote, fn) in enumerate(zip(self.remotes, work_remotes, env_fns)):
+            process = mp.Process(target=_worker, args=(work_remote, remote, fn, seed + i), daemon=True)
+            process.start()
+            self.processes.append(process)
+            work_remote.close()
+
+        self.remotes[0].send(('spaces', None))
+        self.observation_space, self.action_space, self.state_dim, self.action_dim = self.remotes[0].recv()
+        self.closed = False
+
+    def reset(self, indices=None):
+        remotes = [self.remotes[i] for i in self._indices(indices)]
+        for remote in remotes:
+            remote.send(('reset', None))
+        return _stack([remote.recv() for remote in remotes])
+
+    def step_async(self, actions):
+        for remote, a in zip(self.remotes, actions):
+            remote.send(('step', a))
+
+    def step_wait(self):
+        return self._collect([remote.recv() for remote in self.remotes])
+
+    def close(self):
+        if self.closed:
+            return
+        for remote in self.remotes:
+            remote.send(('close', None))
+        for process in self.processes:
+            process.join()
+        self.closed = True
+
+
+def make_vec_env(env_fns, seed=None):
+    if len(env_fns) == 1:
+        return DummyVecEnv(env_fns, seed)
+    return SubprocVecEnv(env_fns, seed)
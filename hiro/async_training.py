@@ -0,0 +1,187 @@
+##################################################
+# Asynchronous actor-learner training for HIRO/TD3
+#
+# Actor processes run episodes and append transitions straight into the
+# agent's replay buffers, which are moved to shared memory before the
+# actors are forked. The learner (the calling process) trains on those
+# buffers and publishes its actor weights back to the actors.
+import copy
+import time
+import queue
+import multiprocessing as mp
+import numpy as np
+import torch
+
+from hiro.models import HiroAgent, device
+
+_ctx = mp.get_context('fork')
+
+
+def _policies(agent):
+    if isinstance(agent, HiroAgent):
+        return [agent.high_con.actor, agent.low_con.actor]
+    return [agent.con.actor]
+
+def _buffers(agent):
+    if isinstance(agent, HiroAgent):
+        return [agent.replay_buffer_low, agent.replay_buffer_high]
+    return [agent.replay_buffer]
+
+
+class SharedWeights():
+    # Shared memory copies of the policies plus a version that is bumped on
+    # every publish, so actors only reload when something changed.
+    def __init__(self, policies):
+        self.policies = [copy.deepcopy(p).share_memory() for p in policies]
+        self.lock = _ctx.Lock()
+        self._version = _ctx.RawValue('q', 0)
+
+    @property
+    def version(self):
+        return self._version.value
+
+    def publish(self, policies):
+        with self.lock, torch.no_grad():
+            for shared, policy in zip(self.policies, policies):
+                for x, y in zip(shared.parameters(), policy.parameters()):
+                    x.copy_(y)
+            self._version.value += 1
+
+    def pull(self, policies):
+        with self.lock, torch.no_grad():
+            for shared, policy in zip(self.policies, policies):
+                for x, y in zip(policy.parameters(), shared.parameters()):
+                    x.copy_(y)
+            return self._version.value
+
+
+class ActorPool():
+    # num_actors processes collecting experience for agent.
+    #
+    # utd_ratio: learner updates (gradient steps of the lower controller)
+    #   per environment step. The learner waits for data when it gets ahead
+    #   of this ratio.
+    # max_staleness: how many environment steps the actors may run ahead of
+    #   the learner (relative to utd_ratio) before they wait for it, so
+    #   that data is collected with a policy at most that far behind.
+    # start_training_steps: random exploration steps, collected without
+    #   any throttling before the first update.
+    def __init__(self, agent, env_fn, num_actors, utd_ratio=1.0, max_staleness=1000,
+                 start_training_steps=0, seed=None):
+        if device.type == 'cuda':
+            raise ValueError('Actor processes are forked and can not use CUDA')
+
+        self.agent = agent
+        self.env_fn = env_fn
+        self.num_actors = num_actors
+        self.utd_ratio = utd_ratio
+        self.max_staleness = max_staleness
+        self.start_training_steps = start_training_steps
+        self.seed = np.random.randint(2**31 - num_actors) if seed is None else seed
+
+        for buffer in _buffers(agent):
+            buffer.share_memory()
+        self.weights = SharedWeights(_policies(agent))
+
+        self._env_steps = np.frombuffer(_ctx.RawArray('q', num_actors), dtype=np.int64)
+        self._updates = _ctx.RawValue('q', 0)
+        self._stop = _ctx.Event()
+        self.episodes = _ctx.Queue()
+        self.processes = []
+
+    @property
+    def env_steps(self):
+        return int(self._env_steps.sum())
+
+    @property
+    def updates(self):
+        return self._updates.value
+
+    def start(self):
+        for rank in range(self.num_actors):
+            process = _ctx.Process(target=self._run, args=(rank,), daemon=True)
+            process.start()
+            self.processes.append(process)
+
+    def can_update(self):
+        # True when the learner is behind utd_ratio. The learner polls this
+        # while it waits for data, so it also fails on dead actors.
+        self.check_actors()
+        steps = self.env_steps - self.start_training_steps
+        return steps > 0 and self.updates < self.utd_ratio * steps
+
+    def check_actors(self):
+        # Actors only return once the pool is closed
+        for rank, process in enumerate(self.processes):
+            if not process.is_alive():
+                raise RuntimeError('Actor %d exited with code %s' % (rank, process.exitcode))
+
+    def record_update(self, n=1):
+        # n: gradient steps of the update, e.g. HiroAgent.utd_low
+        self._updates.value += n
+
+    def publish(self):
+        self.weights.publish(_policies(self.agent))
+
+    def finished_episodes(self):
+        # (episode_reward, episode_subreward) of every episode finished
+        # since the last call
+        episodes = []
+        while True:
+            try:
+                episodes.append(self.episodes.get_nowait())
+            except queue.Empty:
+                return episodes
+
+    def close(self):
+        self._stop.set()
+        for process in self.processes:
+            process.join()
+        self.processes = []
+
+    def _must_wait(self):
+        steps = self.env_steps - self.start_training_steps
+        return steps > 0 and steps > self.updates / self.utd_ratio + self.max_staleness
+
+    def _run(self, rank):
+        # Body of an actor process
+        np.random.seed(self.seed + rank)
+        torch.manual_seed(self.seed + rank)
+        torch.set_num_threads(1)
+        # Episodes still queued when the learner stops are dropped
+        self.episodes.cancel_join_thread()
+
+        agent = self.agent
+        policies = _policies(agent)
+        version = self.weights.pull(policies)
+        env = self.env_fn()
+        env.seed(self.seed + rank)
+
+        while not self._stop.is_set():
+            obs = env.reset()
+            fg = obs['desired_goal']
+            s = obs['observation']
+            done = False
+            step = 0
+            episode_reward = 0
+            agent.set_final_goal(fg)
+
+            while not done:
+                while self._must_wait():
+                    if self._stop.is_set():
+                        return
+                    time.sleep(0.001)
+                if self.weights.version != version:
+                    version = self.weights.pull(policies)
+
+                a, r, n_s, done = agent.step(s, env, step, self.env_steps, explore=True)
+                agent.append(step, s, a, n_s, r, done)
+                self._env_steps[rank] += 1
+
+                s = n_s
+                episode_reward += r
+                step += 1
+                agent.end_step()
+
+            self.episodes.put((episode_reward, getattr(agent, 'episode_subreward', 0)))
+            agent.end_episode(0)
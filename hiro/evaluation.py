@@ -0,0 +1,58 @@
+##################################################
+# Evaluation episodes spread over a pool of worker processes
+#
+# Every worker builds its own env once. Episode i of an evaluation is run
+# with seed + i on a fresh copy of the policy snapshot, so the results do
+# not depend on how episodes are distributed over the workers and match
+# agent.evaluate_policy(env, eval_episodes, seed=seed).
+import multiprocessing as mp
+import numpy as np
+import torch
+
+_env = None
+
+
+def _init_worker(env_fn):
+    global _env
+    torch.set_num_threads(1)
+    _env = env_fn()
+    _env.evaluate = True
+
+def _run_episode(policy, seed):
+    return policy.snapshot().evaluate_episode(_env, seed=seed)
+
+
+class EvaluationResult():
+    # Pending evaluation; get() returns the (rewards, success_rate) of
+    # Agent.evaluate_policy
+    def __init__(self, result, eval_episodes):
+        self.result = result
+        self.eval_episodes = eval_episodes
+
+    def ready(self):
+        return self.result.ready()
+
+    def get(self):
+        rewards, errors = zip(*self.result.get())
+        success = sum(1 if error <=5 else 0 for error in errors)
+        return np.array(rewards), success/self.eval_episodes
+
+
+class EvaluationPool():
+    def __init__(self, env_fn, num_workers):
+        # Spawned rather than forked: workers start from a clean interpreter
+        # and are free to initialise MuJoCo (or CUDA) themselves
+        self.pool = mp.get_context('spawn').Pool(num_workers, _init_worker, (env_fn,))
+
+    def evaluate(self, policy, eval_episodes=10, seed=0):
+        return self.evaluate_async(policy, eval_episodes, seed).get()
+
+    def evaluate_async(self, policy, eval_episodes=10, seed=0):
+        # policy is pickled to the workers, so pass agent.snapshot() rather
+        # than the agent itself
+        tasks = [(policy, seed + e) for e in range(eval_episodes)]
+        return EvaluationResult(self.pool.starmap_async(_run_episode, tasks, chunksize=1), eval_episodes)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
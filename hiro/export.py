@@ -0,0 +1,123 @@
+##################################################
+# Actor export for rollout workers
+#
+# export_actors() writes the high and low actors of a HiroAgent (or of a
+# snapshot of one) as frozen TorchScript modules, with the settings of the
+# hierarchy in policy.json. ScriptedHiroPolicy runs the hierarchical policy
+# from those files alone, like HiroAgent does without exploration: it
+# needs torch and NumPy, but not hiro.models or the environment packages.
+# export_numpy_actors() writes the same for NumpyHiroPolicy
+# (hiro/numpy_policy.py), which does not need torch either.
+#
+#   export_actors(agent, 'model/exp/export')
+#   policy = ScriptedHiroPolicy('model/exp/export')
+#   rewards, error = policy.evaluate_episode(env, seed=0)
+import os
+import copy
+import json
+import numpy as np
+import torch
+from hiro.numpy_policy import ExportedHiroPolicy, LAYERS
+
+ACTOR_FILES = {'high': 'high_actor.pt', 'low': 'low_actor.pt'}
+META_FILE = 'policy.json'
+
+
+def _script_actor(actor, state_dim, goal_dim, method):
+    actor = copy.deepcopy(actor).cpu().eval()
+    if method == 'script':
+        module = torch.jit.script(actor)
+    elif method == 'trace':
+        module = torch.jit.trace(actor, (torch.zeros(1, state_dim), torch.zeros(1, goal_dim)))
+    else:
+        raise ValueError('Unknown export method %s' % method)
+    # Parameters become constants, so the graph can be optimised for
+    # inference
+    return torch.jit.freeze(module)
+
+def export_actors(agent, path, method='script'):
+    # method: 'script' (torch.jit.script) or 'trace' (torch.jit.trace)
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    low_actor, high_actor = agent.low_con.actor, agent.high_con.actor
+    # From the actors: agent.fg keeps its 2-dim default until a final goal
+    # is set
+    subgoal_dim = high_actor.l3.out_features
+    state_dim = low_actor.l1.in_features - subgoal_dim
+    meta = {
+        'state_dim': state_dim,
+        'goal_dim': high_actor.l1.in_features - state_dim,
+        'subgoal_dim': subgoal_dim,
+        'action_dim': low_actor.l3.out_features,
+        'buffer_freq': agent.buffer_freq,
+        # Acts on the first step of the next episode, as in HiroAgent
+        'sg': np.asarray(agent.sg, dtype=float).tolist(),
+        'method': method,
+    }
+
+    for name, actor, goal_dim in (('high', high_actor, meta['goal_dim']), ('low', low_actor, subgoal_dim)):
+        module = _script_actor(actor, state_dim, goal_dim, method)
+        module.save(os.path.join(path, ACTOR_FILES[name]))
+    with open(os.path.join(path, META_FILE), 'w') as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+def actor_arrays(actor, name):
+    # TD3Actor -> float32 arrays for NumpyActor, weights as (in, out)
+    arrays = {'%s.scale' % name: actor.scale.detach().cpu().numpy()}
+    for l in LAYERS:
+        layer = getattr(actor, l)
+        arrays['%s.%s.weight' % (name, l)] = layer.weight.detach().cpu().numpy().T
+        arrays['%s.%s.bias' % (name, l)] = layer.bias.detach().cpu().numpy()
+    return {k: np.ascontiguousarray(v, dtype=np.float32) for k, v in arrays.items()}
+
+def export_numpy_actors(agent, filename):
+    # Both actors and the settings of the hierarchy in one .npz file, for
+    # NumpyHiroPolicy
+    dirname = os.path.dirname(filename)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname)
+    arrays = actor_arrays(agent.high_con.actor, 'high')
+    arrays.update(actor_arrays(agent.low_con.actor, 'low'))
+    # Acts on the first step of the next episode, as in HiroAgent
+    arrays['sg'] = np.asarray(agent.sg, dtype=np.float32)
+    arrays['buffer_freq'] = np.asarray(agent.buffer_freq)
+    # np.savez adds .npz to names without it
+    with open(filename, 'wb') as f:
+        np.savez(f, **arrays)
+
+
+class ScriptedHiroPolicy(ExportedHiroPolicy):
+    # ExportedHiroPolicy on the TorchScript actors. Copies (and pickles,
+    # e.g. for EvaluationPool) reload the actors from path.
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_FILE)) as f:
+            self.meta = json.load(f)
+        self._load_actors()
+        super(ScriptedHiroPolicy, self).__init__(
+            self.meta['buffer_freq'], self.meta['subgoal_dim'], self.meta['goal_dim'], self.meta['sg'])
+
+    def _load_actors(self):
+        self.high_actor = torch.jit.load(os.path.join(self.path, ACTOR_FILES['high']))
+        self.low_actor = torch.jit.load(os.path.join(self.path, ACTOR_FILES['low']))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['high_actor'], state['low_actor']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._load_actors()
+
+    def _run(self, actor, state, goal):
+        state = torch.from_numpy(np.asarray(state, dtype=np.float32))
+        goal = torch.from_numpy(np.asarray(goal, dtype=np.float32))
+        with torch.inference_mode():
+            return actor(state.reshape(-1, state.shape[-1]), goal.reshape(-1, goal.shape[-1])).numpy().squeeze()
+
+    def _seed(self, seed):
+        np.random.seed(seed)
+        torch.manual_seed(seed)
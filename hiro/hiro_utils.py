@@ -1,110 +1,758 @@
+import os
+import json
+import mmap
+import queue
+import threading
+import multiprocessing as mp
 import torch
 import numpy as np
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 
+def _counter(i):
+    return property(
+        lambda self: int(self._counters[i]),
+        lambda self, value: self._counters.__setitem__(i, value))
+
+def subgoal_transition(s, sg, n_s):
+    # h(s, sg, n_s) of HIRO: the subgoal relative to the next state. Works
+    # on single transitions and on batches (any leading axes), of NumPy
+    # arrays or torch tensors.
+    dim = sg.shape[-1]
+    return s[..., :dim] + sg - n_s[..., :dim]
+
+def low_reward(s, sg, n_s):
+    # Intrinsic reward of the lower controller, -||s + sg - n_s||, batched
+    # like subgoal_transition
+    dim = sg.shape[-1]
+    return -(((s[..., :dim] + sg - n_s[..., :dim]) ** 2).sum(-1) ** 0.5)
+
+def _shared_array(array):
+    # Copy of array in anonymous shared memory, which processes forked
+    # afterwards see (and write) as well
+    shared = np.frombuffer(mmap.mmap(-1, max(array.nbytes, 1)), dtype=array.dtype, count=array.size)
+    shared = shared.reshape(array.shape)
+    shared[...] = array
+    return shared
+
+
 class ReplayBuffer():
-    def __init__(self, state_dim, goal_dim, action_dim, buffer_size, batch_size):
+    # Ring state is kept in one small array so share_memory() can move it
+    ptr, size, total = _counter(0), _counter(1), _counter(2)
+
+    def __init__(self, state_dim, goal_dim, action_dim, buffer_size, batch_size, dtype=np.float32,
+                 storage_path=None, prioritized=False, alpha=0.6, beta=0.4, fields=None):
         self.buffer_size = buffer_size
         self.batch_size = batch_size
+        self._counters = np.zeros(3, dtype=np.int64)
         self.ptr = 0
         self.size = 0
-        self.state = np.zeros((buffer_size, state_dim))
-        self.goal = np.zeros((buffer_size, goal_dim))
-        self.action = np.zeros((buffer_size, action_dim))
-        self.n_state = np.zeros((buffer_size, state_dim))
-        self.reward = np.zeros((buffer_size, 1))
-        self.not_done = np.zeros((buffer_size, 1))
+        # Number of transitions ever appended; slot of transition i is
+        # i % buffer_size
+        self.total = 0
+        self.dtype = np.dtype(dtype)
+        self.storage_path = storage_path
+
+        if fields is None:
+            fields = [
+                ('state', (state_dim,)),
+                ('goal', (goal_dim,)),
+                ('action', (action_dim,)),
+                ('n_state', (state_dim,)),
+                ('reward', (1,)),
+                ('not_done', (1,)),
+            ]
+        self._allocate(fields)
+        if self._reopened:
+            with open(self.storage_path+'.json') as f:
+                self._load_meta(json.load(f))
+
+        # Prioritized replay: transitions are sampled proportionally to
+        # (|td_error| + epsilon)^alpha, and the loss is corrected with
+        # importance sampling weights.
+        self.prioritized = prioritized
+        if prioritized:
+            self.alpha = alpha
+            self.beta = beta
+            self.epsilon = 1e-6
+            self.max_priority = 1.0
+            self.tree = SumTree(buffer_size)
+            self.tree.update(np.arange(self.size), np.ones(self.size))
+
+        # Held while a transition is written or a batch is gathered, so
+        # batches can be sampled from another thread (see BatchPrefetcher)
+        self.lock = threading.Lock()
 
         self.device = device
+        self._pinned = None
+        self._copied = None
+
+    def __getstate__(self):
+        # Locks and CUDA staging state are per process; recreate them on copy
+        state = self.__dict__.copy()
+        state.update(lock=None, _pinned=None, _copied=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def _allocate(self, fields):
+        # Structure of arrays packed into one (buffer_size, width) block, so
+        # that a batch is gathered with a single indexed copy. Every field is
+        # exposed as a view of its columns (e.g. self.state).
+        self.fields = []
+        width = 0
+        for name, shape in fields:
+            self.fields.append((name, shape, width, width + int(np.prod(shape))))
+            width += int(np.prod(shape))
+        self.width = width
+
+        # Fields of a sampled batch: the stored fields, plus any that
+        # subclasses assemble at sample time.
+        self.batch_fields = list(self.fields)
+        self.batch_width = width
+
+        self._reopened = False
+        self.storage = self._open_array((self.buffer_size, self.width), self.dtype)
+        self._bind_fields()
+
+    def _bind_fields(self):
+        for name, shape, start, end in self.fields:
+            setattr(self, name, self.storage[:, start:end].reshape((self.buffer_size,) + shape))
+
+    def share_memory(self):
+        # Like torch.nn.Module.share_memory(): after this call, processes
+        # forked from this one append to and sample from the same buffer.
+        # Disk backed storage is a shared mapping already.
+        if self.prioritized:
+            raise ValueError('Prioritized replay buffers can not be shared between processes')
+
+        if not isinstance(self.storage, np.memmap):
+            self.storage = _shared_array(self.storage)
+            self._bind_fields()
+        self._counters = _shared_array(self._counters)
+        self.lock = mp.get_context('fork').Lock()
+        return self
+
+    def _add_batch_field(self, name, shape):
+        width = int(np.prod(shape))
+        self.batch_fields.append((name, shape, self.batch_width, self.batch_width + width))
+        self.batch_width += width
+
+    def _open_array(self, shape, dtype, suffix=''):
+        if self.storage_path is None:
+            return np.zeros(shape, dtype=dtype)
+
+        # Disk backed: arrays live in <storage_path><suffix>.npy and the ring
+        # state in <storage_path>.json. An existing buffer with the same
+        # layout is reopened as is, so a crashed run picks up everything up
+        # to the last flush().
+        data_path, meta_path = self.storage_path+suffix+'.npy', self.storage_path+'.json'
+        if os.path.exists(data_path) and os.path.exists(meta_path):
+            array = np.lib.format.open_memmap(data_path, mode='r+')
+            if array.shape != shape or array.dtype != dtype:
+                raise ValueError('%s holds a %s %s array, expected %s %s' % (
+                    data_path, array.dtype, array.shape, np.dtype(dtype), shape))
+            self._reopened = True
+            return array
+
+        dirname = os.path.dirname(data_path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        return np.lib.format.open_memmap(data_path, mode='w+', dtype=dtype, shape=shape)
+
+    def _meta(self):
+        return {'ptr': self.ptr, 'size': self.size, 'total': self.total}
+
+    def _load_meta(self, meta):
+        self.ptr = meta['ptr']
+        self.size = meta['size']
+        self.total = meta['total']
+
+    def flush(self):
+        # Make appended transitions durable. No-op for in-memory buffers.
+        if self.storage_path is None:
+            return
+
+        self.storage.flush()
+        meta_path = self.storage_path+'.json'
+        with open(meta_path+'.tmp', 'w') as f:
+            json.dump(self._meta(), f)
+        os.replace(meta_path+'.tmp', meta_path)
+
+    def _arrays(self):
+        # Arrays holding the transitions, by name
+        return {'storage': self.storage}
+
+    def state_dict(self):
+        # Consistent copy of the buffer for a checkpoint. Disk backed arrays
+        # are copied too: training keeps overwriting their files after the
+        # checkpoint, so the files alone would not match its ring state.
+        with self.lock:
+            state = {'meta': self._meta()}
+            for name, array in self._arrays().items():
+                state[name] = torch.from_numpy(np.array(array))
+            if self.prioritized:
+                state['tree'] = self.tree.tree.copy()
+                state['max_priority'] = self.max_priority
+        return state
+
+    def load_state_dict(self, state):
+        with self.lock:
+            for name, array in self._arrays().items():
+                if name not in state:
+                    continue
+                if tuple(state[name].shape) != array.shape:
+                    raise ValueError('Checkpoint holds a %s array for %s, expected %s' % (
+                        tuple(state[name].shape), name, array.shape))
+                array[...] = state[name].numpy()
+            self._load_meta(state['meta'])
+            # Disk backed files now hold the checkpoint
+            self.flush()
+
+            if self.prioritized:
+                if 'tree' in state:
+                    self.tree.tree[...] = state['tree']
+                    self.max_priority = state['max_priority']
+                else:
+                    self.tree.tree[...] = 0
+                    self.tree.update(np.arange(self.size), np.ones(self.size))
 
     def append(self, state, goal, action, n_state, reward, done):
-        self.state[self.ptr] = state
-        self.goal[self.ptr] = goal
-        self.action[self.ptr] = action
-        self.n_state[self.ptr] = n_state
-        self.reward[self.ptr] = reward
-        self.not_done[self.ptr] = 1. - done
+        with self.lock:
+            ptr = self.ptr
+            self.state[ptr] = state
+            self.goal[ptr] = goal
+            self.action[ptr] = action
+            self.n_state[ptr] = n_state
+            self.reward[ptr] = reward
+            self.not_done[ptr] = 1. - done
 
-        self.ptr = (self.ptr+1) % self.buffer_size
-        self.size = min(self.size+1, self.buffer_size)
+            self._advance()
 
-    def sample(self):
-        ind = np.random.randint(0, self.size, size=self.batch_size)
-
-        return (
-            torch.FloatTensor(self.state[ind]).to(self.device),
-            torch.FloatTensor(self.goal[ind]).to(self.device),
-            torch.FloatTensor(self.action[ind]).to(self.device),
-            torch.FloatTensor(self.n_state[ind]).to(self.device),
-            torch.FloatTensor(self.reward[ind]).to(self.device),
-            torch.FloatTensor(self.not_done[ind]).to(self.device),
+    def append_batch(self, state, goal, action, n_state, reward, done):
+        # append() for a stack of transitions, e.g. one per env
+        with self.lock:
+            ind = self._slots(len(state))
+            self.state[ind] = state
+            self.goal[ind] = goal
+            self.action[ind] = action
+            self.n_state[ind] = n_state
+            self.reward[ind, 0] = reward
+            self.not_done[ind, 0] = 1. - np.asarray(done, dtype=float)
+
+            self._advance(len(ind))
+
+    def _slots(self, count):
+        return (self.ptr + np.arange(count)) % self.buffer_size
+
+    def _advance(self, count=1):
+        if self.prioritized:
+            # New transitions are sampled at least once with max priority
+            if count == 1:
+                self.tree.set(self.ptr, self.max_priority ** self.alpha)
+            else:
+                self.tree.update(self._slots(count), np.full(count, self.max_priority ** self.alpha))
+
+        counters = self._counters
+        counters[0] = (counters[0] + count) % self.buffer_size
+        counters[1] = min(counters[1] + count, self.buffer_size)
+        counters[2] += count
+
+    def sample(self, batch_size=None):
+        with self.lock:
+            ind = self._sample_indices(batch_size or self.batch_size)
+            batch = self._gather(ind)
+            weights = self._importance_weights(ind) if self.prioritized else None
+        batch = self._to_tensors(batch)
+
+        if self.prioritized:
+            return batch + (ind, weights)
+        return batch
+
+    def _sample_indices(self, batch_size):
+        if self.prioritized:
+            ind = self.tree.sample(batch_size)
+            # Rounding can land on an empty leaf; use the newest transition
+            return np.where(self.tree.get(ind) > 0, ind, (self.ptr - 1) % self.buffer_size)
+        return np.random.randint(0, self.size, size=batch_size)
+
+    def _importance_weights(self, ind):
+        # w_i = (N * P(i))^-beta, normalised by the largest weight in the batch
+        probs = self.tree.get(ind) / self.tree.total()
+        weights = (self.size * probs) ** -self.beta
+        weights = torch.from_numpy((weights / weights.max()).astype(np.float32))
+        return weights.unsqueeze(1).to(self.device)
+
+    def update_priorities(self, ind, td_errors):
+        priorities = np.abs(td_errors) + self.epsilon
+        with self.lock:
+            # Transitions dropped since they were sampled (see
+            # HighIndexReplayBuffer._evict) keep priority 0
+            live = (self.ptr - 1 - np.asarray(ind)) % self.buffer_size < self.size
+            if not live.all():
+                ind, priorities = np.asarray(ind)[live], priorities[live]
+                if len(ind) == 0:
+                    return
+            self.max_priority = max(self.max_priority, priorities.max())
+            self.tree.update(ind, priorities ** self.alpha)
+
+    def recompute_rewards(self, reward_fn, fields, ind=None):
+        # Rewrites the rewards at ind (default: every stored transition)
+        # with reward_fn(*[field[ind] for field in fields]) in one call, e.g.
+        # after relabeling goals or changing the reward scale:
+        #   low_buffer.recompute_rewards(low_reward, ('state', 'goal', 'n_state'))
+        with self.lock:
+            if ind is None:
+                ind = np.arange(self.size)
+            rewards = reward_fn(*[getattr(self, name)[ind] for name in fields])
+            self.reward[ind, 0] = np.reshape(rewards, -1)
+
+    def _gather(self, ind):
+        batch = self._staging(len(ind))
+        np.take(self.storage, ind, axis=0, out=batch[:, :self.width], mode='clip')
+        return batch
+
+    def _staging(self, batch_size):
+        # On CPU the returned tensors alias the gathered rows, so every batch
+        # gets its own array. On CUDA rows are gathered into one reusable
+        # pinned buffer, which must not be overwritten before the previous
+        # host-to-device copy has finished.
+        if self.device.type != 'cuda':
+            return np.empty((batch_size, self.batch_width), dtype=self.dtype)
+
+        if self._pinned is None or self._pinned.shape[0] != batch_size:
+            self._pinned = torch.from_numpy(
+                np.empty((batch_size, self.batch_width), dtype=self.dtype)).pin_memory()
+        if self._copied is not None:
+            self._copied.synchronize()
+        return self._pinned.numpy()
+
+    def _to_tensors(self, batch):
+        batch = torch.from_numpy(batch)
+        if self.device.type == 'cuda':
+            batch = batch.to(self.device, non_blocking=True)
+            self._copied = torch.cuda.Event()
+            self._copied.record()
+        batch = batch.float()
+
+        return tuple(
+            batch[:, start:end].view((batch.shape[0],) + shape)
+            for _, shape, start, end in self.batch_fields
         )
 
 class LowReplayBuffer(ReplayBuffer):
-    def __init__(self, state_dim, goal_dim, action_dim, buffer_size, batch_size):
-        super(LowReplayBuffer, self).__init__(state_dim, goal_dim, action_dim, buffer_size, batch_size)
-        self.n_goal = np.zeros((buffer_size, goal_dim))
+    # her_ratio: fraction of the sampled transitions whose subgoal is
+    #   relabeled in hindsight (see _relabel). This needs the episode of
+    #   every transition: episode_start and episode_end hold the global
+    #   indices of its first and one past its last transition (0 while the
+    #   episode runs), stride the distance between its consecutive
+    #   transitions (the number of envs appending together).
+    def __init__(self, state_dim, goal_dim, action_dim, buffer_size, batch_size, dtype=np.float32,
+                 storage_path=None, prioritized=False, alpha=0.6, beta=0.4, her_ratio=0.):
+        super(LowReplayBuffer, self).__init__(
+            state_dim, goal_dim, action_dim, buffer_size, batch_size, dtype, storage_path,
+            prioritized, alpha, beta,
+            fields=[
+                ('state', (state_dim,)),
+                ('goal', (goal_dim,)),
+                ('action', (action_dim,)),
+                ('n_state', (state_dim,)),
+                ('n_goal', (goal_dim,)),
+                ('reward', (1,)),
+                ('not_done', (1,)),
+            ])
+        self.her_ratio = her_ratio
+        if her_ratio:
+            self.episode_start = self._open_array((buffer_size,), np.int64, '_episode_start')
+            self.episode_end = self._open_array((buffer_size,), np.int64, '_episode_end')
+            self.stride = self._open_array((buffer_size,), np.int64, '_stride')
+            self._columns = {name: (start, end) for name, _, start, end in self.fields}
 
     def append(self, state, goal, action, n_state, n_goal, reward, done):
-        self.state[self.ptr] = state
-        self.goal[self.ptr] = goal
-        self.action[self.ptr] = action
-        self.n_state[self.ptr] = n_state
-        self.n_goal[self.ptr] = n_goal
-        self.reward[self.ptr] = reward
-        self.not_done[self.ptr] = 1. - done
+        with self.lock:
+            ptr = self.ptr
+            self.state[ptr] = state
+            self.goal[ptr] = goal
+            self.action[ptr] = action
+            self.n_state[ptr] = n_state
+            self.n_goal[ptr] = n_goal
+            self.reward[ptr] = reward
+            self.not_done[ptr] = 1. - done
 
-        self.ptr = (self.ptr+1) % self.buffer_size
-        self.size = min(self.size+1, self.buffer_size)
+            if self.her_ratio:
+                self._track_episodes(np.array([done]), 1)
+            self._advance()
 
-    def sample(self):
-        ind = np.random.randint(0, self.size, size=self.batch_size)
-
-        return (
-            torch.FloatTensor(self.state[ind]).to(self.device),
-            torch.FloatTensor(self.goal[ind]).to(self.device),
-            torch.FloatTensor(self.action[ind]).to(self.device),
-            torch.FloatTensor(self.n_state[ind]).to(self.device),
-            torch.FloatTensor(self.n_goal[ind]).to(self.device),
-            torch.FloatTensor(self.reward[ind]).to(self.device),
-            torch.FloatTensor(self.not_done[ind]).to(self.device),
-        )
+    def append_batch(self, state, goal, action, n_state, n_goal, reward, done):
+        with self.lock:
+            ind = self._slots(len(state))
+            self.state[ind] = state
+            self.goal[ind] = goal
+            self.action[ind] = action
+            self.n_state[ind] = n_state
+            self.n_goal[ind] = n_goal
+            self.reward[ind, 0] = reward
+            self.not_done[ind, 0] = 1. - np.asarray(done, dtype=float)
+
+            if self.her_ratio:
+                self._track_episodes(np.asarray(done), len(ind))
+            self._advance(len(ind))
+
+    def _track_episodes(self, done, stride):
+        # Episode bookkeeping of the transitions being appended, one per env,
+        # before _advance(). A transition continues the episode of the one
+        # stride steps back unless that one was done or appended with a
+        # different number of envs.
+        index = self.total + np.arange(len(done))
+        slot = index % self.buffer_size
+        prev = (index - stride) % self.buffer_size
+        running = (index >= stride) & (self.stride[prev] == stride) & (self.not_done[prev, 0] > 0)
+
+        start = np.where(running, self.episode_start[prev], index)
+        self.episode_start[slot] = start
+        self.episode_end[slot] = 0
+        self.stride[slot] = stride
+
+        # Close finished episodes on all of their transitions still stored
+        oldest = self.total + len(done) - self.buffer_size
+        for i in np.flatnonzero(done):
+            first = max(start[i], oldest + (start[i] - oldest) % stride)
+            self.episode_end[np.arange(first, index[i] + 1, stride) % self.buffer_size] = index[i] + 1
+
+    def _gather(self, ind):
+        batch = super(LowReplayBuffer, self)._gather(ind)
+        if self.her_ratio:
+            self._relabel(batch, ind)
+        return batch
+
+    def _relabel(self, batch, ind):
+        # Hindsight relabeling: in a her_ratio fraction of the rows, the
+        # subgoal becomes one that was achieved, the offset from the state to
+        # the next state of a transition at or after it in the same episode.
+        # n_goal and the reward are recomputed for the new subgoal.
+        rows = np.flatnonzero(np.random.random_sample(len(ind)) < self.her_ratio)
+        if not len(rows):
+            return
+        slot = ind[rows]
+
+        # Global index of every relabeled transition and of the last one of
+        # its episode; a running episode ends at its env's newest transition
+        index = self.total - 1 - (self.ptr - 1 - slot) % self.buffer_size
+        stride = self.stride[slot]
+        end = self.episode_end[slot]
+        last = np.where(end > 0, end - 1, index + stride * ((self.total - 1 - index) // stride))
+        future = index + stride * np.random.randint(0, (last - index) // stride + 1)
+
+        dim = self.goal.shape[1]
+        state, n_state = self.state[slot], self.n_state[slot]
+        goal = self.n_state[future % self.buffer_size, :dim] - state[:, :dim]
+        relabeled = {
+            'goal': goal,
+            'n_goal': subgoal_transition(state, goal, n_state),
+            'reward': low_reward(state, goal, n_state)[:, None],
+        }
+        for name, value in relabeled.items():
+            start, end = self._columns[name]
+            batch[rows, start:end] = value
+
+    def flush(self):
+        if self.storage_path is not None and self.her_ratio:
+            self.episode_start.flush()
+            self.episode_end.flush()
+            self.stride.flush()
+        super(LowReplayBuffer, self).flush()
+
+    def _arrays(self):
+        arrays = super(LowReplayBuffer, self)._arrays()
+        if self.her_ratio:
+            arrays.update(episode_start=self.episode_start, episode_end=self.episode_end, stride=self.stride)
+        return arrays
+
+    def share_memory(self):
+        # Actors appending to a shared buffer interleave their episodes, which
+        # can then not be followed by global index
+        if self.her_ratio:
+            raise ValueError('LowReplayBuffer with her_ratio can not be shared between processes')
+        return super(LowReplayBuffer, self).share_memory()
 
 class HighReplayBuffer(ReplayBuffer):
-    def __init__(self, state_dim, goal_dim, subgoal_dim, action_dim, buffer_size, batch_size, freq):
-        super(HighReplayBuffer, self).__init__(state_dim, goal_dim, action_dim, buffer_size, batch_size)
-        self.action = np.zeros((buffer_size, subgoal_dim))
-        self.state_arr = np.zeros((buffer_size, freq, state_dim))
-        self.action_arr = np.zeros((buffer_size, freq, action_dim))
+    def __init__(self, state_dim, goal_dim, subgoal_dim, action_dim, buffer_size, batch_size, freq,
+                 dtype=np.float32, storage_path=None, prioritized=False, alpha=0.6, beta=0.4):
+        super(HighReplayBuffer, self).__init__(
+            state_dim, goal_dim, action_dim, buffer_size, batch_size, dtype, storage_path,
+            prioritized, alpha, beta,
+            fields=[
+                ('state', (state_dim,)),
+                ('goal', (goal_dim,)),
+                ('action', (subgoal_dim,)),
+                ('n_state', (state_dim,)),
+                ('reward', (1,)),
+                ('not_done', (1,)),
+                ('state_arr', (freq, state_dim)),
+                ('action_arr', (freq, action_dim)),
+            ])
 
     def append(self, state, goal, action, n_state, reward, done, state_arr, action_arr):
-        self.state[self.ptr] = state
-        self.goal[self.ptr] = goal
-        self.action[self.ptr] = action
-        self.n_state[self.ptr] = n_state
-        self.reward[self.ptr] = reward
-        self.not_done[self.ptr] = 1. - done
-        self.state_arr[self.ptr,:,:] = state_arr
-        self.action_arr[self.ptr,:,:] = action_arr
-
-        self.ptr = (self.ptr+1) % self.buffer_size
-        self.size = min(self.size+1, self.buffer_size)
+        with self.lock:
+            ptr = self.ptr
+            self.state[ptr] = state
+            self.goal[ptr] = goal
+            self.action[ptr] = action
+            self.n_state[ptr] = n_state
+            self.reward[ptr] = reward
+            self.not_done[ptr] = 1. - done
+            self.state_arr[ptr,:,:] = state_arr
+            self.action_arr[ptr,:,:] = action_arr
 
-    def sample(self):
-        ind = np.random.randint(0, self.size, size=self.batch_size)
-
-        return (
-            torch.FloatTensor(self.state[ind]).to(self.device),
-            torch.FloatTensor(self.goal[ind]).to(self.device),
-            torch.FloatTensor(self.action[ind]).to(self.device),
-            torch.FloatTensor(self.n_state[ind]).to(self.device),
-            torch.FloatTensor(self.reward[ind]).to(self.device),
-            torch.FloatTensor(self.not_done[ind]).to(self.device),
-            torch.FloatTensor(self.state_arr[ind]).to(self.device),
-            torch.FloatTensor(self.action_arr[ind]).to(self.device)
-        )
+            self._advance()
+
+    def append_batch(self, state, goal, action, n_state, reward, done, state_arr, action_arr):
+        with self.lock:
+            ind = self._slots(len(state))
+            self.state[ind] = state
+            self.goal[ind] = goal
+            self.action[ind] = action
+            self.n_state[ind] = n_state
+            self.reward[ind, 0] = reward
+            self.not_done[ind, 0] = 1. - np.asarray(done, dtype=float)
+            self.state_arr[ind] = state_arr
+            self.action_arr[ind] = action_arr
+
+            self._advance(len(ind))
+
+class HighIndexReplayBuffer(ReplayBuffer):
+    # Same transitions and samples as HighReplayBuffer, but the freq-step
+    # window of states/actions is not copied: each transition keeps the
+    # global index of the window's first step in low_buffer, and windows
+    # are gathered from there at sample time. With several envs appending to
+    # low_buffer in turn, consecutive steps of one env are stride apart.
+    # state and n_state are not stored either: they are the state of the
+    # window's first step and the n_state of its last one.
+    def __init__(self, low_buffer, goal_dim, subgoal_dim, buffer_size, batch_size, freq,
+                 dtype=np.float32, storage_path=None, prioritized=False, alpha=0.6, beta=0.4):
+        self.low_buffer = low_buffer
+        self.freq = freq
+        state_dim = low_buffer.state.shape[1]
+        action_dim = low_buffer.action.shape[1]
+
+        super(HighIndexReplayBuffer, self).__init__(
+            state_dim, goal_dim, action_dim, buffer_size, batch_size, dtype, storage_path,
+            prioritized, alpha, beta,
+            fields=[
+                ('goal', (goal_dim,)),
+                ('action', (subgoal_dim,)),
+                ('reward', (1,)),
+                ('not_done', (1,)),
+            ])
+        self.start = self._open_array((buffer_size,), np.int64, '_start')
+        self.stride = self._open_array((buffer_size,), np.int64, '_stride')
+
+        self._add_batch_field('state_arr', (freq, state_dim))
+        self._add_batch_field('action_arr', (freq, action_dim))
+        self._add_batch_field('n_state', (state_dim,))
+        # Sampled tuples are laid out like those of HighReplayBuffer; state
+        # is a view of the first step of state_arr
+        fields = {field[0]: field for field in self.batch_fields}
+        _, _, start, _ = fields['state_arr']
+        fields['state'] = ('state', (state_dim,), start, start + state_dim)
+        self.batch_fields = [fields[name] for name in (
+            'state', 'goal', 'action', 'n_state', 'reward', 'not_done', 'state_arr', 'action_arr')]
+
+    def append(self, goal, action, reward, done, start, stride=1):
+        with self.lock:
+            ptr = self.ptr
+            self.goal[ptr] = goal
+            self.action[ptr] = action
+            self.reward[ptr] = reward
+            self.not_done[ptr] = 1. - done
+            self.start[ptr] = start
+            self.stride[ptr] = stride
+
+            self._advance()
+
+    def append_batch(self, goal, action, reward, done, start, stride=1):
+        with self.lock:
+            ind = self._slots(len(goal))
+            self.goal[ind] = goal
+            self.action[ind] = action
+            self.reward[ind, 0] = reward
+            self.not_done[ind, 0] = 1. - np.asarray(done, dtype=float)
+            self.start[ind] = start
+            self.stride[ind] = stride
+
+            self._advance(len(ind))
+
+    def flush(self):
+        if self.storage_path is not None:
+            self.start.flush()
+            self.stride.flush()
+        super(HighIndexReplayBuffer, self).flush()
+
+    def _arrays(self):
+        arrays = super(HighIndexReplayBuffer, self)._arrays()
+        arrays.update(start=self.start, stride=self.stride)
+        return arrays
+
+    def share_memory(self):
+        # Eviction reads the low buffer's ring state, which other processes
+        # would be advancing without this buffer's lock
+        raise ValueError('HighIndexReplayBuffer can not be shared between processes')
+
+    def sample(self, batch_size=None):
+        # The low buffer must not overwrite a window between eviction and
+        # the gather
+        with self.low_buffer.lock:
+            return super(HighIndexReplayBuffer, self).sample(batch_size)
+
+    def _sample_indices(self, batch_size):
+        self._evict()
+        if self.prioritized:
+            return super(HighIndexReplayBuffer, self)._sample_indices(batch_size)
+
+        # Live transitions are the newest self.size ones
+        return (self.ptr - self.size + np.random.randint(0, self.size, size=batch_size)) % self.buffer_size
+
+    def _evict(self):
+        # Drop the oldest transitions once the low level buffer has started
+        # overwriting their windows. Windows are appended in order, so the
+        # stale ones are always at the tail of the ring.
+        oldest = self.low_buffer.total - self.low_buffer.size
+        while self.size > 0 and self.start[(self.ptr - self.size) % self.buffer_size] < oldest:
+            if self.prioritized:
+                self.tree.set((self.ptr - self.size) % self.buffer_size, 0.)
+            self.size -= 1
+
+    def _gather(self, ind):
+        batch = super(HighIndexReplayBuffer, self)._gather(ind)
+
+        # Shape: (batch_size, freq)
+        window = self.start[ind, None] + self.stride[ind, None] * np.arange(self.freq)
+        window %= self.low_buffer.buffer_size
+
+        fields = {name: (start, end) for name, _, start, end in self.batch_fields}
+        start, end = fields['state_arr']
+        batch[:, start:end] = self.low_buffer.state[window].reshape(len(ind), -1)
+        start, end = fields['action_arr']
+        batch[:, start:end] = self.low_buffer.action[window].reshape(len(ind), -1)
+        start, end = fields['n_state']
+        batch[:, start:end] = self.low_buffer.n_state[window[:, -1]]
+
+        return batch
+
+class BatchPrefetcher():
+    # Samples the next num_batches batches of replay_buffer on a background
+    # thread while the learner runs the current update. It is a drop-in for
+    # the buffer wherever only sample() and buffer attributes are used.
+    # Batches are drawn from the buffer as it was when they were sampled, so
+    # they may miss up to num_batches steps of the newest transitions.
+    # sample_size: rows per prefetched batch, default the buffer's
+    # batch_size. Other sizes are sampled on the calling thread.
+    def __init__(self, replay_buffer, num_batches=2, sample_size=None):
+        self.replay_buffer = replay_buffer
+        self.num_batches = num_batches
+        self.sample_size = sample_size or replay_buffer.batch_size
+        self.queue = queue.Queue(maxsize=num_batches)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __getattr__(self, name):
+        # Dunders (e.g. __deepcopy__) must not resolve to the buffer's
+        if name.startswith('__') or name == 'replay_buffer':
+            raise AttributeError(name)
+        return getattr(self.replay_buffer, name)
+
+    def __getstate__(self):
+        # A copy starts without queued batches or a thread
+        return {'replay_buffer': self.replay_buffer, 'num_batches': self.num_batches,
+                'sample_size': self.sample_size}
+
+    def __setstate__(self, state):
+        self.__init__(state['replay_buffer'], state['num_batches'], state['sample_size'])
+
+    def sample(self, batch_size=None):
+        if batch_size is not None and batch_size != self.sample_size:
+            return self.replay_buffer.sample(batch_size)
+
+        # Start lazily: the buffer has to hold transitions before sampling
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+        batch = self.queue.get()
+        if isinstance(batch, Exception):
+            raise batch
+        return batch
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                batch = self.replay_buffer.sample(self.sample_size)
+            except Exception as e:
+                batch = e
+
+            while not self._stop.is_set():
+                try:
+                    self.queue.put(batch, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            if isinstance(batch, Exception):
+                return
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+class SumTree():
+    # Array-backed binary tree whose leaves hold per-slot priorities and
+    # whose inner nodes hold the sum of their children, so tree[1] is the
+    # total priority. Leaf i is at tree[leaf + i].
+    def __init__(self, size):
+        self.leaf, self.depth = 2, 1
+        while self.leaf < size:
+            self.leaf *= 2
+            self.depth += 1
+        self.tree = np.zeros(2 * self.leaf)
+
+    def total(self):
+        return self.tree[1]
+
+    def get(self, ind):
+        return self.tree[ind + self.leaf]
+
+    def set(self, index, priority):
+        i = index + self.leaf
+        self.tree[i] = priority
+        i //= 2
+        while i >= 1:
+            self.tree[i] = self.tree[2*i] + self.tree[2*i+1]
+            i //= 2
+
+    def update(self, ind, priorities):
+        # Batched set(): one vectorised pass per tree level. Duplicate
+        # parents just write the same sum twice.
+        i = np.asarray(ind) + self.leaf
+        self.tree[i] = priorities
+        for _ in range(self.depth):
+            i = i // 2
+            self.tree[i] = self.tree[2*i] + self.tree[2*i+1]
+
+    def sample(self, batch_size):
+        # Stratified proportional sampling: one uniform draw per equal slice
+        # of the total mass, all descending the tree in lockstep.
+        mass = (np.arange(batch_size) + np.random.uniform(size=batch_size)) * (self.total() / batch_size)
+        i = np.ones(batch_size, dtype=np.int64)
+        for _ in range(self.depth):
+            left = 2 * i
+            go_right = mass >= self.tree[left]
+            mass = np.where(go_right, mass - self.tree[left], mass)
+            i = left + go_right
+        return i - self.leaf
 
 class SubgoalActionSpace(object):
     def __init__(self, dim):
@@ -14,9 +14,10 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from .utils import get_tensor
-from hiro.hiro_utils import LowReplayBuffer, HighReplayBuffer, ReplayBuffer, Subgoal
-from hiro.utils import _is_update
+from .utils import get_tensor, clone_state
+from hiro.hiro_utils import LowReplayBuffer, HighReplayBuffer, HighIndexReplayBuffer, ReplayBuffer, Subgoal
+from hiro.hiro_utils import BatchPrefetcher, subgoal_transition, low_reward
+from hiro.utils import _is_update, listdirs, profiler
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -34,7 +35,28 @@ class TD3Actor(nn.Module):
         self.l3 = nn.Linear(300, action_dim)
 
     def forward(self, state, goal):
-        a = F.relu(self.l1(torch.cat([state, goal], 1)))
+        return self.forward_input(torch.cat([state, goal], 1))
+
+    def forward_input(self, state_goal):
+        # forward() on state and goal concatenated
+        a = F.relu(self.l1(state_goal))
+        a = F.relu(self.l2(a))
+        return self.scale * torch.tanh(self.l3(a))
+
+    def forward_candidates(self, state, goal, candidates):
+        # Actions for every (candidate, timestep) pair where the goal fed to
+        # the actor is goal + candidate.
+        # state: (B, T, state_dim), goal: (B, T, goal_dim)
+        # candidates: (B, C, goal_dim) -> (B, C, T, action_dim)
+        # l1 is linear, so its state/goal part is computed once per timestep
+        # and its candidate part once per candidate.
+        state_dim = state.shape[-1]
+        w_state, w_goal = self.l1.weight[:, :state_dim], self.l1.weight[:, state_dim:]
+
+        base = F.linear(state, w_state, self.l1.bias) + F.linear(goal, w_goal)
+        cand = F.linear(candidates, w_goal)
+
+        a = F.relu(base[:, None] + cand[:, :, None])
         a = F.relu(self.l2(a))
         return self.scale * torch.tanh(self.l3(a))
 
@@ -59,7 +81,72 @@ class TD3Critic(nn.Module):
 
         return q
 
+class EnsembleCritic(nn.Module):
+    # num_critics Q networks with the layers TD3Critic.forward evaluates
+    # (l1-l3), run together: the weights of every layer are stacked along a
+    # leading member axis, so each layer is one batched matmul for all of
+    # them. Weights are stored (in, out) for torch.baddbmm.
+    def __init__(self, state_dim, goal_dim, action_dim, num_critics=2, hidden_dim=300):
+        super(EnsembleCritic, self).__init__()
+        sizes = [state_dim + goal_dim + action_dim, hidden_dim, hidden_dim, 1]
+        self.weights = nn.ParameterList([
+            nn.Parameter(torch.empty(num_critics, n_in, n_out)) for n_in, n_out in zip(sizes, sizes[1:])])
+        self.biases = nn.ParameterList([
+            nn.Parameter(torch.empty(num_critics, 1, n_out)) for n_out in sizes[1:]])
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        # Same initialization as nn.Linear, member by member
+        for w, b in zip(self.weights, self.biases):
+            for i in range(w.shape[0]):
+                nn.init.kaiming_uniform_(w[i].t(), a=5 ** 0.5)
+            nn.init.uniform_(b, -w.shape[1] ** -0.5, w.shape[1] ** -0.5)
+
+    def forward(self, state, goal, action):
+        # Shape: (num_critics, batch_size, 1)
+        sa = torch.cat([state, goal, action], 1)
+        w, b = self.weights, self.biases
+        q = F.relu(torch.matmul(sa, w[0]) + b[0])
+        q = F.relu(torch.baddbmm(b[1], q, w[1]))
+        return torch.baddbmm(b[2], q, w[2])
+
+    def q1(self, state, goal, action):
+        # First member only, for the actor loss
+        sa = torch.cat([state, goal, action], 1)
+        w, b = self.weights, self.biases
+        q = F.relu(torch.addmm(b[0][0], sa, w[0][0]))
+        q = F.relu(torch.addmm(b[1][0], q, w[1][0]))
+        return torch.addmm(b[2][0], q, w[2][0])
+
+    def load_critics(self, critics):
+        # Copies the Q1 layers of TD3Critics into the members, e.g. from the
+        # files save() writes without fused_critic
+        with torch.no_grad():
+            for i, critic in enumerate(critics):
+                for j, layer in enumerate([critic.l1, critic.l2, critic.l3]):
+                    self.weights[j][i].copy_(layer.weight.t())
+                    self.biases[j][i, 0].copy_(layer.bias)
+
+def flatten_parameters(module):
+    # Moves the parameters of module into one contiguous buffer, of which
+    # they become views, and returns it. Parameters keep their identity, so
+    # optimizers and load_state_dict() work on them as before.
+    params = list(module.parameters())
+    flat = torch.cat([p.data.reshape(-1) for p in params])
+    offset = 0
+    for p in params:
+        p.data = flat[offset:offset + p.numel()].view_as(p)
+        offset += p.numel()
+    return flat
+
 class TD3Controller(object):
+    # Modules and optimizers that make up the training state
+    _state_attrs = (
+        'actor', 'actor_target', 'critic1', 'critic2', 'critic1_target', 'critic2_target',
+        'actor_optimizer', 'critic1_optimizer', 'critic2_optimizer')
+    _fused_state_attrs = (
+        'actor', 'actor_target', 'critic', 'critic_target', 'actor_optimizer', 'critic_optimizer')
+
     def __init__(
             self,
             state_dim,
@@ -74,7 +161,9 @@ class TD3Controller(object):
             noise_clip=0.5,
             gamma=0.99,
             policy_freq=2,
-            tau=0.005):
+            tau=0.005,
+            fused_critic=False,
+            target_update='loop'):
         self.name = 'td3'
         self.scale = scale
         self.model_path = model_path
@@ -91,27 +180,83 @@ class TD3Controller(object):
         self.actor_target = TD3Actor(state_dim, goal_dim, action_dim, scale=scale).to(device)
         self.actor_optimizer = torch.optim.Adam(self.actor.parameters(), lr=actor_lr)
 
-        self.critic1 = TD3Critic(state_dim, goal_dim, action_dim).to(device)
-        self.critic2 = TD3Critic(state_dim, goal_dim, action_dim).to(device)
-        self.critic1_target = TD3Critic(state_dim, goal_dim, action_dim).to(device)
-        self.critic2_target = TD3Critic(state_dim, goal_dim, action_dim).to(device)
-
-        self.critic1_optimizer = torch.optim.Adam(self.critic1.parameters(), lr=critic_lr)
-        self.critic2_optimizer = torch.optim.Adam(self.critic2.parameters(), lr=critic_lr)
+        # fused_critic: both critics in one EnsembleCritic with one optimizer
+        # instead of critic1 and critic2. Training is the same: Adam works
+        # element-wise, so one optimizer over the stacked weights takes the
+        # steps of the two.
+        self.fused_critic = fused_critic
+        if fused_critic:
+            self._state_attrs = self._fused_state_attrs
+            self.critic = EnsembleCritic(state_dim, goal_dim, action_dim).to(device)
+            self.critic_target = EnsembleCritic(state_dim, goal_dim, action_dim).to(device)
+            self.critic_optimizer = torch.optim.Adam(self.critic.parameters(), lr=critic_lr)
+        else:
+            self.critic1 = TD3Critic(state_dim, goal_dim, action_dim).to(device)
+            self.critic2 = TD3Critic(state_dim, goal_dim, action_dim).to(device)
+            self.critic1_target = TD3Critic(state_dim, goal_dim, action_dim).to(device)
+            self.critic2_target = TD3Critic(state_dim, goal_dim, action_dim).to(device)
+
+            self.critic1_optimizer = torch.optim.Adam(self.critic1.parameters(), lr=critic_lr)
+            self.critic2_optimizer = torch.optim.Adam(self.critic2.parameters(), lr=critic_lr)
+
+        # How Polyak updates of the targets run:
+        #   'loop': per parameter, tau * origin + (1 - tau) * target
+        #   'foreach': one multi-tensor lerp over all parameters of a network
+        #   'flat': the parameters of every network live in one contiguous
+        #     buffer (see flatten_parameters), updated with a single lerp
+        if target_update not in ('loop', 'foreach', 'flat'):
+            raise ValueError('Unknown target_update mode %s' % target_update)
+        self.target_update = target_update
+        self._flatten()
         self._initialize_target_networks()
 
         self._initialized = False
         self.total_it = 0
+        self._act_cache = {}
 
     def _initialize_target_networks(self):
-        self._update_target_network(self.critic1_target, self.critic1, 1.0)
-        self._update_target_network(self.critic2_target, self.critic2, 1.0)
-        self._update_target_network(self.actor_target, self.actor, 1.0)
+        self._update_target_networks(1.0)
         self._initialized = True
 
+    def _flatten(self):
+        self._flat = {}
+        if self.target_update == 'flat':
+            for target, origin in self._target_pairs():
+                self._flat[target] = flatten_parameters(target)
+                self._flat[origin] = flatten_parameters(origin)
+
+    def __getstate__(self):
+        # Copied parameters are no longer views of the flat buffers, so
+        # copies build their own
+        state = self.__dict__.copy()
+        state['_flat'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._flatten()
+
+    def _target_pairs(self):
+        # (target, online) networks
+        if self.fused_critic:
+            pairs = [(self.critic_target, self.critic)]
+        else:
+            pairs = [(self.critic1_target, self.critic1), (self.critic2_target, self.critic2)]
+        return pairs + [(self.actor_target, self.actor)]
+
+    def _update_target_networks(self, tau):
+        for target, origin in self._target_pairs():
+            self._update_target_network(target, origin, tau)
+
     def _update_target_network(self, target, origin, tau):
-        for target_param, origin_param in zip(target.parameters(), origin.parameters()):
-            target_param.data.copy_(tau * origin_param.data + (1.0 - tau) * target_param.data)
+        with torch.no_grad():
+            if self.target_update == 'flat':
+                self._flat[target].lerp_(self._flat[origin], tau)
+            elif self.target_update == 'foreach':
+                torch._foreach_lerp_(list(target.parameters()), list(origin.parameters()), tau)
+            else:
+                for target_param, origin_param in zip(target.parameters(), origin.parameters()):
+                    target_param.data.copy_(tau * origin_param.data + (1.0 - tau) * target_param.data)
 
     def save(self, episode):
         # create episode directory. (e.g. model/2000)
@@ -124,6 +269,12 @@ class TD3Controller(object):
             self.actor.state_dict(), 
             os.path.join(model_path, self.name+"_actor.h5")
         )
+        if self.fused_critic:
+            torch.save(
+                self.critic.state_dict(),
+                os.path.join(model_path, self.name+"_critic.h5")
+            )
+            return
         torch.save(
             self.critic1.state_dict(), 
             os.path.join(model_path, self.name+"_critic1.h5")
@@ -136,7 +287,7 @@ class TD3Controller(object):
     def load(self, episode):
         # episode is -1, then read most updated
         if episode<0:
-            episode_list = map(int, os.listdir(self.model_path))
+            episode_list = [int(d) for d in listdirs(self.model_path) if d.isdigit()]
             episode = max(episode_list)
 
         model_path = os.path.join(self.model_path, str(episode)) 
@@ -144,6 +295,11 @@ class TD3Controller(object):
         self.actor.load_state_dict(torch.load(
             os.path.join(model_path, self.name+"_actor.h5"))
         )
+        if self.fused_critic:
+            self.critic.load_state_dict(torch.load(
+                os.path.join(model_path, self.name+"_critic.h5"))
+            )
+            return
         self.critic1.load_state_dict(torch.load(
             os.path.join(model_path, self.name+"_critic1.h5"))
         )
@@ -151,9 +307,22 @@ class TD3Controller(object):
             os.path.join(model_path, self.name+"_critic2.h5"))
         )
 
-    def _train(self, states, goals, actions, rewards, n_states, n_goals, not_done):
+    def state_dict(self):
+        # Unlike save(), everything needed to resume training, copied to CPU
+        state = {name: getattr(self, name).state_dict() for name in self._state_attrs}
+        state['total_it'] = self.total_it
+        return clone_state(state)
+
+    def load_state_dict(self, state):
+        for name in self._state_attrs:
+            getattr(self, name).load_state_dict(state[name])
+        self.total_it = state['total_it']
+        self._initialized = True
+
+    def _train(self, states, goals, actions, rewards, n_states, n_goals, not_done, weights=None):
         self.total_it += 1
-        with torch.no_grad():
+        profiler.count('updates', self.name)
+        with profiler.phase('critic_target', self.name), torch.no_grad():
             noise = (
                 torch.randn_like(actions) * self.policy_noise
             ).clamp(-self.noise_clip, self.noise_clip)
@@ -162,38 +331,68 @@ class TD3Controller(object):
             n_actions = torch.min(n_actions,  self.actor.scale)
             n_actions = torch.max(n_actions, -self.actor.scale)
 
-            target_Q1 = self.critic1_target(n_states, n_goals, n_actions)
-            target_Q2 = self.critic2_target(n_states, n_goals, n_actions)
-            target_Q = torch.min(target_Q1, target_Q2)
+            if self.fused_critic:
+                target_Q = self.critic_target(n_states, n_goals, n_actions).min(0)[0]
+            else:
+                target_Q1 = self.critic1_target(n_states, n_goals, n_actions)
+                target_Q2 = self.critic2_target(n_states, n_goals, n_actions)
+                target_Q = torch.min(target_Q1, target_Q2)
             target_Q_detached = (rewards + not_done * self.gamma * target_Q).detach()
 
-        current_Q1 = self.critic1(states, goals, actions)
-        current_Q2 = self.critic2(states, goals, actions)
-
-        critic1_loss = F.smooth_l1_loss(current_Q1, target_Q_detached)
-        critic2_loss = F.smooth_l1_loss(current_Q2, target_Q_detached)
-        critic_loss = critic1_loss + critic2_loss
-
-        td_error = (target_Q_detached - current_Q1).mean().cpu().data.numpy()
-
-        self.critic1_optimizer.zero_grad()
-        self.critic2_optimizer.zero_grad()
-        critic_loss.backward()
-        self.critic1_optimizer.step()
-        self.critic2_optimizer.step()
+        with profiler.phase('critic_update', self.name):
+            if self.fused_critic:
+                current_Q = self.critic(states, goals, actions)
+                current_Q1 = current_Q[0]
+                if weights is None:
+                    critic_loss = F.smooth_l1_loss(
+                        current_Q, target_Q_detached.expand_as(current_Q)) * len(current_Q)
+                else:
+                    critic_loss = (weights * F.smooth_l1_loss(
+                        current_Q, target_Q_detached.expand_as(current_Q), reduction='none')).mean() * len(current_Q)
+            else:
+                current_Q1 = self.critic1(states, goals, actions)
+                current_Q2 = self.critic2(states, goals, actions)
+
+                if weights is None:
+                    critic1_loss = F.smooth_l1_loss(current_Q1, target_Q_detached)
+                    critic2_loss = F.smooth_l1_loss(current_Q2, target_Q_detached)
+                else:
+                    # Importance sampling correction for prioritized replay
+                    critic1_loss = (weights * F.smooth_l1_loss(current_Q1, target_Q_detached, reduction='none')).mean()
+                    critic2_loss = (weights * F.smooth_l1_loss(current_Q2, target_Q_detached, reduction='none')).mean()
+                critic_loss = critic1_loss + critic2_loss
+
+            td_errors = target_Q_detached - current_Q1.detach()
+            td_error = td_errors.mean().cpu().data.numpy()
+            if weights is not None:
+                self.td_errors = td_errors.squeeze(1).cpu().numpy()
+
+            if self.fused_critic:
+                self.critic_optimizer.zero_grad()
+                critic_loss.backward()
+                self.critic_optimizer.step()
+            else:
+                self.critic1_optimizer.zero_grad()
+                self.critic2_optimizer.zero_grad()
+                critic_loss.backward()
+                self.critic1_optimizer.step()
+                self.critic2_optimizer.step()
 
         if self.total_it % self.policy_freq == 0:
-            a = self.actor(states, goals)
-            Q1 = self.critic1(states, goals, a)
-            actor_loss = -Q1.mean() # multiply by neg becuz gradient ascent
+            with profiler.phase('actor_update', self.name):
+                a = self.actor(states, goals)
+                if self.fused_critic:
+                    Q1 = self.critic.q1(states, goals, a)
+                else:
+                    Q1 = self.critic1(states, goals, a)
+                actor_loss = -Q1.mean() # multiply by neg becuz gradient ascent
 
-            self.actor_optimizer.zero_grad()
-            actor_loss.backward()
-            self.actor_optimizer.step()
+                self.actor_optimizer.zero_grad()
+                actor_loss.backward()
+                self.actor_optimizer.step()
 
-            self._update_target_network(self.critic1_target, self.critic1, self.tau)
-            self._update_target_network(self.critic2_target, self.critic2, self.tau)
-            self._update_target_network(self.actor_target, self.actor, self.tau)
+            with profiler.phase('target_update', self.name):
+                self._update_target_networks(self.tau)
 
             return {'actor_loss_'+self.name: actor_loss, 'critic_loss_'+self.name: critic_loss}, \
                     {'td_error_'+self.name: td_error}
@@ -202,20 +401,53 @@ class TD3Controller(object):
                     {'td_error_'+self.name: td_error}
 
     def train(self, replay_buffer, iterations=1):
-        states, goals, actions, n_states, rewards, not_done = replay_buffer.sample()
-        return self._train(states, goals, actions, rewards, n_states, goals, not_done)
+        batch, ind, weights = self._sample(replay_buffer, iterations)
+
+        losses, td_errors = {}, {}
+        for batch, ind, weights in self._split(batch, ind, weights, replay_buffer.batch_size):
+            states, goals, actions, n_states, rewards, not_done = batch
+            loss, td_error = self._train(states, goals, actions, rewards, n_states, goals, not_done, weights)
+            self._update_priorities(replay_buffer, ind)
+            losses.update(loss)
+            td_errors.update(td_error)
+        return losses, td_errors
+
+    def _sample(self, replay_buffer, iterations=1):
+        # The batches of iterations updates, drawn as one batch. Prioritized
+        # buffers append the slot indices and importance weights.
+        with profiler.phase('sample', self.name):
+            batch = replay_buffer.sample(iterations * replay_buffer.batch_size)
+        if replay_buffer.prioritized:
+            return batch[:-2], batch[-2], batch[-1]
+        return batch, None, None
+
+    def _split(self, batch, ind, weights, batch_size):
+        # Yields (batch, ind, weights) of every update in a _sample() batch
+        for start in range(0, len(batch[0]), batch_size):
+            rows = slice(start, start + batch_size)
+            yield ([x[rows] for x in batch],
+                   None if ind is None else ind[rows],
+                   None if weights is None else weights[rows])
+
+    def _update_priorities(self, replay_buffer, ind):
+        if ind is not None:
+            with profiler.phase('priorities', self.name):
+                replay_buffer.update_priorities(ind, self.td_errors)
 
     def policy(self, state, goal, to_numpy=True):
+        if to_numpy:
+            return self.act(state, goal)
+
         state = get_tensor(state)
         goal = get_tensor(goal)
         action = self.actor(state, goal)
 
-        if to_numpy:
-            return action.cpu().data.numpy().squeeze()
-
         return action.squeeze()
 
     def policy_with_noise(self, state, goal, to_numpy=True):
+        if to_numpy:
+            return self.act(state, goal, noise=True)
+
         state = get_tensor(state)
         goal = get_tensor(goal)
         action = self.actor(state, goal)
@@ -224,11 +456,44 @@ class TD3Controller(object):
         action = torch.min(action,  self.actor.scale)
         action = torch.max(action, -self.actor.scale)
 
-        if to_numpy:
-            return action.cpu().data.numpy().squeeze()
-
         return action.squeeze()
 
+    def act(self, state, goal, noise=False):
+        # Inference path of policy()/policy_with_noise() for NumPy inputs
+        # (one row or a batch): no autograd, and state and goal are copied
+        # from NumPy views straight into one reused input buffer, which the
+        # actor reads without concatenating. Exploration noise is drawn into
+        # a reused buffer as well. The returned action is a new array.
+        state, goal = np.asarray(state), np.asarray(goal)
+        rows = len(state) if state.ndim > 1 else 1
+        inputs, noises = self._act_buffers(rows)
+        state_dim = state.shape[-1]
+
+        with torch.inference_mode():
+            if inputs.is_cpu:
+                array = inputs.numpy()
+                array[:, :state_dim] = state.reshape(rows, -1)
+                array[:, state_dim:] = goal.reshape(rows, -1)
+            else:
+                inputs[:, :state_dim].copy_(torch.from_numpy(state).reshape(rows, -1))
+                inputs[:, state_dim:].copy_(torch.from_numpy(goal).reshape(rows, -1))
+            action = self.actor.forward_input(inputs)
+            if noise:
+                action += noises.normal_(0, self.expl_noise)
+                action.clamp_(-self.actor.scale, self.actor.scale)
+            return action.cpu().numpy().squeeze()
+
+    def _act_buffers(self, rows):
+        # One pair of buffers per batch size (1, num_envs, ...). Allocated
+        # outside inference mode, so they can be copied with the controller.
+        buffers = self._act_cache.get(rows)
+        if buffers is None:
+            weight = self.actor.l1.weight
+            buffers = self._act_cache[rows] = (
+                torch.empty(rows, weight.shape[1], device=weight.device),
+                torch.empty(rows, self.actor.l3.out_features, device=weight.device))
+        return buffers
+
     def _sample_exploration_noise(self, actions):
         mean = torch.zeros(actions.size()).to(device)
         var = torch.ones(actions.size()).to(device)
@@ -250,84 +515,106 @@ class HigherController(TD3Controller):
         noise_clip=0.5,
         gamma=0.99,
         policy_freq=2,
-        tau=0.005):
+        tau=0.005,
+        correction_rows=None,
+        fused_critic=False,
+        target_update='loop'):
         super(HigherController, self).__init__(
             state_dim, goal_dim, action_dim, scale, model_path,
             actor_lr, critic_lr, expl_noise, policy_noise,
-            noise_clip, gamma, policy_freq, tau
+            noise_clip, gamma, policy_freq, tau, fused_critic, target_update
         )
         self.name = 'high'
         self.action_dim = action_dim
 
+        # Max (candidate x timestep) rows scored per forward pass of the lower
+        # actor. A single pass is fastest on GPU; on CPU the activations of a
+        # large batch fall out of cache, so it is split into ~2k-row slices.
+        if correction_rows is None:
+            correction_rows = 2048 if device.type == 'cpu' else 0
+        self.correction_rows = correction_rows
+
     def off_policy_corrections(self, low_con, batch_size, sgoals, states, actions, candidate_goals=8):
-        first_s = [s[0] for s in states] # First x
-        last_s = [s[-1] for s in states] # Last x
+        # sgoals: (batch_size, subgoal_dim)
+        # states: (batch_size, seq_len, state_dim)
+        # actions: (batch_size, seq_len, action_dim)
+        candidates = self._candidate_goals(sgoals, states, candidate_goals)
+        max_indices = self._select_candidates(low_con, candidates, states, actions)
+
+        return candidates[torch.arange(batch_size, device=candidates.device), max_indices]
 
+    def _candidate_goals(self, sgoals, states, candidate_goals=8):
         # Shape: (batch_size, 1, subgoal_dim)
         # diff = 1
-        diff_goal = (np.array(last_s) -
-                     np.array(first_s))[:, np.newaxis, :self.action_dim]
+        diff_goal = (states[:, -1, :self.action_dim] - states[:, 0, :self.action_dim]).unsqueeze(1)
 
-        # Shape: (batch_size, 1, subgoal_dim)
+        # Shape: (batch_size, candidate_goals, subgoal_dim)
         # original = 1
         # random = candidate_goals
-        original_goal = np.array(sgoals)[:, np.newaxis, :]
-        random_goals = np.random.normal(loc=diff_goal, scale=.5*self.scale[None, None, :],
-                                        size=(batch_size, candidate_goals, original_goal.shape[-1]))
-        random_goals = random_goals.clip(-self.scale, self.scale)
+        original_goal = sgoals.unsqueeze(1)
+        scale = self.actor.scale
+        random_goals = diff_goal + 0.5 * scale * torch.randn(
+            (sgoals.shape[0], candidate_goals, self.action_dim), device=sgoals.device)
+        random_goals = torch.min(random_goals,  scale)
+        random_goals = torch.max(random_goals, -scale)
 
         # Shape: (batch_size, 10, subgoal_dim)
-        candidates = np.concatenate([original_goal, diff_goal, random_goals], axis=1)
-        #states = np.array(states)[:, :-1, :]
-        actions = np.array(actions)
-        seq_len = len(states[0])
-
-        # For ease
-        new_batch_sz = seq_len * batch_size
-        action_dim = actions[0][0].shape
-        obs_dim = states[0][0].shape
-        ncands = candidates.shape[1]
+        return torch.cat([original_goal, diff_goal, random_goals], dim=1)
 
-        true_actions = actions.reshape((new_batch_sz,) + action_dim)
-        observations = states.reshape((new_batch_sz,) + obs_dim)
-        goal_shape = (new_batch_sz, self.action_dim)
-        # observations = get_obs_tensor(observations, sg_corrections=True)
+    def _select_candidates(self, low_con, candidates, states, actions):
+        batch_size, ncands, seq_len = candidates.shape[0], candidates.shape[1], states.shape[1]
+        chunk = self.correction_rows // (ncands * seq_len) if self.correction_rows else 0
 
-        # batched_candidates = np.tile(candidates, [seq_len, 1, 1])
-        # batched_candidates = batched_candidates.transpose(1, 0, 2)
+        if chunk <= 0 or chunk >= batch_size:
+            return self._score_candidates(low_con, candidates, states, actions)
 
-        policy_actions = np.zeros((ncands, new_batch_sz) + action_dim)
+        return torch.cat([
+            self._score_candidates(low_con, candidates[i:i+chunk], states[i:i+chunk], actions[i:i+chunk])
+            for i in range(0, batch_size, chunk)])
 
-        for c in range(ncands):
-            subgoal = candidates[:,c]
-            candidate = (subgoal + states[:, 0, :self.action_dim])[:, None] - states[:, :, :self.action_dim]
-            candidate = candidate.reshape(*goal_shape)
-            policy_actions[c] = low_con.policy(observations, candidate)
+    def _score_candidates(self, low_con, candidates, states, actions):
+        # Score every (candidate, timestep) pair with one forward pass of the
+        # lower actor. Subgoals are re-expressed relative to each timestep's
+        # state exactly like subgoal_transition does during the rollout:
+        # goal_t = candidate + s_0 - s_t
+        with torch.no_grad():
+            # Shape: (batch_size, seq_len, subgoal_dim)
+            offsets = states[:, :1, :self.action_dim] - states[:, :, :self.action_dim]
 
-        difference = (policy_actions - true_actions)
-        difference = np.where(difference != -np.inf, difference, 0)
-        difference = difference.reshape((ncands, batch_size, seq_len) + action_dim).transpose(1, 0, 2, 3)
+            # Shape: (batch_size, ncands, seq_len, action_dim)
+            policy_actions = low_con.actor.forward_candidates(states, offsets, candidates)
 
-        logprob = -0.5*np.sum(np.linalg.norm(difference, axis=-1)**2, axis=-1)
-        max_indices = np.argmax(logprob, axis=-1)
+            difference = policy_actions - actions[:, None]
+            logprob = -0.5 * difference.pow(2).sum(dim=(2, 3))
 
-        return candidates[np.arange(batch_size), max_indices]
+        return torch.argmax(logprob, dim=-1)
 
-    def train(self, replay_buffer, low_con):
+    def train(self, replay_buffer, low_con, iterations=1):
         if not self._initialized:
             self._initialize_target_networks()
 
-        states, goals, actions, n_states, rewards, not_done, states_arr, actions_arr = replay_buffer.sample()
-
-        actions = self.off_policy_corrections(
-            low_con,
-            replay_buffer.batch_size,
-            actions.cpu().data.numpy(),
-            states_arr.cpu().data.numpy(),
-            actions_arr.cpu().data.numpy())
-
-        actions = get_tensor(actions)
-        return self._train(states, goals, actions, rewards, n_states, goals, not_done)
+        batch, ind, weights = self._sample(replay_buffer, iterations)
+        states, goals, actions, n_states, rewards, not_done, states_arr, actions_arr = batch
+
+        # The lower controller does not change during these updates, so the
+        # subgoals of all of them are relabeled at once
+        with profiler.phase('off_policy_correction', self.name):
+            actions = self.off_policy_corrections(
+                low_con,
+                len(actions),
+                actions,
+                states_arr,
+                actions_arr)
+        batch = (states, goals, actions, n_states, rewards, not_done)
+
+        losses, td_errors = {}, {}
+        for batch, ind, weights in self._split(batch, ind, weights, replay_buffer.batch_size):
+            states, goals, actions, n_states, rewards, not_done = batch
+            loss, td_error = self._train(states, goals, actions, rewards, n_states, goals, not_done, weights)
+            self._update_priorities(replay_buffer, ind)
+            losses.update(loss)
+            td_errors.update(td_error)
+        return losses, td_errors
 
 class LowerController(TD3Controller):
     def __init__(
@@ -344,26 +631,62 @@ class LowerController(TD3Controller):
         noise_clip=0.5,
         gamma=0.99,
         policy_freq=2,
-        tau=0.005):
+        tau=0.005,
+        fused_critic=False,
+        target_update='loop'):
         super(LowerController, self).__init__(
             state_dim, goal_dim, action_dim, scale, model_path,
             actor_lr, critic_lr, expl_noise, policy_noise,
-            noise_clip, gamma, policy_freq, tau
+            noise_clip, gamma, policy_freq, tau, fused_critic, target_update
         )
         self.name = 'low'
 
-    def train(self, replay_buffer):
+    def train(self, replay_buffer, iterations=1):
         if not self._initialized:
             self._initialize_target_networks()
 
-        states, sgoals, actions, n_states, n_sgoals, rewards, not_done = replay_buffer.sample()
+        batch, ind, weights = self._sample(replay_buffer, iterations)
+
+        losses, td_errors = {}, {}
+        for batch, ind, weights in self._split(batch, ind, weights, replay_buffer.batch_size):
+            states, sgoals, actions, n_states, n_sgoals, rewards, not_done = batch
+            loss, td_error = self._train(states, sgoals, actions, rewards, n_states, n_sgoals, not_done, weights)
+            self._update_priorities(replay_buffer, ind)
+            losses.update(loss)
+            td_errors.update(td_error)
+        return losses, td_errors
 
-        return self._train(states, sgoals, actions, rewards, n_states, n_sgoals, not_done)
+class PolicySnapshot(object):
+    # Inference-only copy of a TD3Controller: its actor and the settings
+    # policy()/policy_with_noise() read, without critics, targets or
+    # optimizers
+    policy = TD3Controller.policy
+    policy_with_noise = TD3Controller.policy_with_noise
+    act = TD3Controller.act
+    _act_buffers = TD3Controller._act_buffers
+    _sample_exploration_noise = TD3Controller._sample_exploration_noise
+
+    def __init__(self, con):
+        self.name = con.name
+        self.expl_noise = con.expl_noise
+        self.actor = copy.deepcopy(con.actor)
+        self._act_cache = {}
 
 class Agent():
     def __init__(self):
         pass
 
+    def snapshot(self):
+        # Copy of the agent with only what evaluate_policy() needs
+        raise NotImplementedError
+
+    def state_dict(self):
+        # Controllers, replay buffers and rollout state, for checkpoints
+        raise NotImplementedError
+
+    def load_state_dict(self, state):
+        raise NotImplementedError
+
     def set_final_goal(self, fg):
         self.fg = fg
 
@@ -381,8 +704,29 @@ class Agent():
 
     def end_episode(self, episode, logger=None):
         raise NotImplementedError
-    
-    def evaluate_policy(self, env, eval_episodes=10, render=False, save_video=False, sleep=-1):
+
+    # Vectorized rollouts: the same steps for num_envs envs at once. Each
+    # env keeps its own final goal (and subgoal state for HIRO); arguments
+    # and returns carry a leading num_envs axis.
+    def init_envs(self, fgs):
+        raise NotImplementedError
+
+    def set_final_goals(self, ind, fgs):
+        self.fgs[ind] = fgs
+
+    def step_envs(self, s, envs, steps, global_step=0, explore=False):
+        raise NotImplementedError
+
+    def append_envs(self, steps, s, a, n_s, r, d):
+        raise NotImplementedError
+
+    def end_step_envs(self):
+        raise NotImplementedError
+
+    def end_episode_env(self, i, episode, logger=None):
+        raise NotImplementedError
+
+    def evaluate_policy(self, env, eval_episodes=10, render=False, save_video=False, sleep=-1, seed=None):
         if save_video:
             from OpenGL import GL
             env = gym.wrappers.Monitor(env, directory='video',
@@ -393,37 +737,52 @@ class Agent():
         rewards = []
         env.evaluate = True
         for e in range(eval_episodes):
-            obs = env.reset()
-            fg = obs['desired_goal']
-            s = obs['observation']
-            done = False
-            reward_episode_sum = 0
-            step = 0
-            
-            self.set_final_goal(fg)
-
-            while not done:
-                if render:
-                    env.render()
-                if sleep>0:
-                    time.sleep(sleep)
-
-                a, r, n_s, done = self.step(s, env, step)
-                reward_episode_sum += r
-                
-                s = n_s
-                step += 1
-                self.end_step()
+            if seed is None:
+                reward_episode_sum, error = self.evaluate_episode(env, render, sleep)
             else:
-                error = np.sqrt(np.sum(np.square(fg-s[:2])))
-                print('Goal, Curr: (%02.2f, %02.2f, %02.2f, %02.2f)     Error:%.2f'%(fg[0], fg[1], s[0], s[1], error))
-                rewards.append(reward_episode_sum)
-                success += 1 if error <=5 else 0
-                self.end_episode(e)
+                # Seeded episodes all start from a snapshot of this agent, so
+                # each result only depends on its own seed
+                reward_episode_sum, error = self.snapshot().evaluate_episode(env, render, sleep, seed + e)
+            rewards.append(reward_episode_sum)
+            success += 1 if error <=5 else 0
+            self.end_episode(e)
 
         env.evaluate = False
         return np.array(rewards), success/eval_episodes
 
+    def evaluate_episode(self, env, render=False, sleep=-1, seed=None):
+        # Returns the episode reward and the final distance to the goal
+        if seed is not None:
+            np.random.seed(seed)
+            torch.manual_seed(seed)
+            env.seed(seed)
+
+        obs = env.reset()
+        fg = obs['desired_goal']
+        s = obs['observation']
+        done = False
+        reward_episode_sum = 0
+        step = 0
+        
+        self.set_final_goal(fg)
+
+        while not done:
+            if render:
+                env.render()
+            if sleep>0:
+                time.sleep(sleep)
+
+            a, r, n_s, done = self.step(s, env, step)
+            reward_episode_sum += r
+            
+            s = n_s
+            step += 1
+            self.end_step()
+
+        error = np.sqrt(np.sum(np.square(fg-s[:2])))
+        print('Goal, Curr: (%02.2f, %02.2f, %02.2f, %02.2f)     Error:%.2f'%(fg[0], fg[1], s[0], s[1], error))
+        return reward_episode_sum, error
+
 class TD3Agent(Agent):
     def __init__(
         self,
@@ -435,14 +794,24 @@ class TD3Agent(Agent):
         model_save_freq,
         buffer_size,
         batch_size,
-        start_training_steps):
+        start_training_steps,
+        buffer_dtype=np.float32,
+        buffer_path=None,
+        prioritized=False,
+        per_alpha=0.6,
+        per_beta=0.4,
+        prefetch=0,
+        fused_critic=False,
+        target_update='loop'):
 
         self.con = TD3Controller(
             state_dim=state_dim,
             goal_dim=goal_dim,
             action_dim=action_dim,
             scale=scale,
-            model_path=model_path
+            model_path=model_path,
+            fused_critic=fused_critic,
+            target_update=target_update
             )
 
         self.replay_buffer = ReplayBuffer(
@@ -450,30 +819,41 @@ class TD3Agent(Agent):
             goal_dim=goal_dim,
             action_dim=action_dim,
             buffer_size=buffer_size,
-            batch_size=batch_size
+            batch_size=batch_size,
+            dtype=buffer_dtype,
+            storage_path=os.path.join(buffer_path, 'replay') if buffer_path else None,
+            prioritized=prioritized,
+            alpha=per_alpha,
+            beta=per_beta
             )
+        # Batches for the next updates are sampled in the background
+        self.sampler = BatchPrefetcher(self.replay_buffer, prefetch) if prefetch else self.replay_buffer
+
         self.model_save_freq = model_save_freq
         self.start_training_steps = start_training_steps
 
     def step(self, s, env, step, global_step=0, explore=False):
-        if explore:
-            if global_step < self.start_training_steps:
-                a = env.action_space.sample()
+        with profiler.phase('act'):
+            if explore:
+                if global_step < self.start_training_steps:
+                    a = env.action_space.sample()
+                else:
+                    a = self._choose_action_with_noise(s)
             else:
-                a = self._choose_action_with_noise(s)
-        else:
-            a = self._choose_action(s)
+                a = self._choose_action(s)
         
-        obs, r, done, _ = env.step(a)
+        with profiler.phase('env_step'):
+            obs, r, done, _ = env.step(a)
         n_s = obs['observation']
 
         return a, r, n_s, done
 
     def append(self, step, s, a, n_s, r, d):
-        self.replay_buffer.append(s, self.fg, a, n_s, r, d)
+        with profiler.phase('append'):
+            self.replay_buffer.append(s, self.fg, a, n_s, r, d)
 
     def train(self, global_step):
-        return self.con.train(self.replay_buffer)
+        return self.con.train(self.sampler)
 
     def _choose_action(self, s):
         return self.con.policy(s, self.fg)
@@ -486,15 +866,76 @@ class TD3Agent(Agent):
 
     def end_episode(self, episode, logger=None):
         if logger:
+            self.replay_buffer.flush()
             if _is_update(episode, self.model_save_freq):
                 self.save(episode=episode)
 
+    def init_envs(self, fgs):
+        self.fgs = np.array(fgs)
+
+    def step_envs(self, s, envs, steps, global_step=0, explore=False):
+        with profiler.phase('act'):
+            if explore:
+                if global_step < self.start_training_steps:
+                    a = np.stack([envs.action_space.sample() for _ in range(envs.num_envs)])
+                else:
+                    a = self.con.policy_with_noise(s, self.fgs).reshape(len(s), -1)
+            else:
+                a = self.con.policy(s, self.fgs).reshape(len(s), -1)
+
+        with profiler.phase('env_step'):
+            obs, r, done, _ = envs.step(a)
+        n_s = obs['observation']
+
+        return a, r, n_s, done
+
+    def append_envs(self, steps, s, a, n_s, r, d):
+        with profiler.phase('append'):
+            self.replay_buffer.append_batch(s, self.fgs, a, n_s, r, d)
+
+    def end_step_envs(self):
+        pass
+
+    def end_episode_env(self, i, episode, logger=None):
+        self.end_episode(episode, logger)
+
     def save(self, episode):
         self.con.save(episode)
 
     def load(self, episode):
         self.con.load(episode)
 
+    def snapshot(self):
+        return TD3Policy(self)
+
+    def state_dict(self):
+        return {
+            'con': self.con.state_dict(),
+            'replay_buffer': self.replay_buffer.state_dict(),
+            'fg': copy.deepcopy(getattr(self, 'fg', None)),
+        }
+
+    def load_state_dict(self, state):
+        self.con.load_state_dict(state['con'])
+        self.replay_buffer.load_state_dict(state['replay_buffer'])
+        self.fg = state['fg']
+
+class TD3Policy(TD3Agent):
+    # Snapshot of a TD3Agent for evaluation: the actor and fg
+    def __init__(self, agent):
+        self.con = PolicySnapshot(agent.con)
+        self.fg = getattr(agent, 'fg', None)
+        self.start_training_steps = agent.start_training_steps
+
+    def append(self, step, s, a, n_s, r, d):
+        raise NotImplementedError('A policy snapshot has no replay buffer')
+
+    def train(self, global_step):
+        raise NotImplementedError('A policy snapshot can not be trained')
+
+    def end_episode(self, episode, logger=None):
+        pass
+
 class HiroAgent(Agent):
     def __init__(
         self,
@@ -512,7 +953,19 @@ class HiroAgent(Agent):
         train_freq,
         reward_scaling,
         policy_freq_high,
-        policy_freq_low):
+        policy_freq_low,
+        buffer_dtype=np.float32,
+        buffer_path=None,
+        high_buffer_index=False,
+        prioritized=False,
+        per_alpha=0.6,
+        per_beta=0.4,
+        prefetch=0,
+        her_ratio=0.,
+        fused_critic=False,
+        target_update='loop',
+        utd_low=1,
+        utd_high=1):
 
         self.subgoal = Subgoal(subgoal_dim)
         scale_high = self.subgoal.action_space.high * np.ones(subgoal_dim)
@@ -525,7 +978,9 @@ class HiroAgent(Agent):
             action_dim=subgoal_dim,
             scale=scale_high,
             model_path=model_path,
-            policy_freq=policy_freq_high
+            policy_freq=policy_freq_high,
+            fused_critic=fused_critic,
+            target_update=target_update
             )
 
         self.low_con = LowerController(
@@ -534,7 +989,9 @@ class HiroAgent(Agent):
             action_dim=action_dim,
             scale=scale_low,
             model_path=model_path,
-            policy_freq=policy_freq_low
+            policy_freq=policy_freq_low,
+            fused_critic=fused_critic,
+            target_update=target_update
             )
 
         self.replay_buffer_low = LowReplayBuffer(
@@ -542,19 +999,60 @@ class HiroAgent(Agent):
             goal_dim=subgoal_dim,
             action_dim=action_dim,
             buffer_size=buffer_size,
-            batch_size=batch_size
-            )
-
-        self.replay_buffer_high = HighReplayBuffer(
-            state_dim=state_dim,
-            goal_dim=goal_dim,
-            subgoal_dim=subgoal_dim,
-            action_dim=action_dim,
-            buffer_size=buffer_size,
             batch_size=batch_size,
-            freq=buffer_freq
+            dtype=buffer_dtype,
+            storage_path=os.path.join(buffer_path, 'low') if buffer_path else None,
+            prioritized=prioritized,
+            alpha=per_alpha,
+            beta=per_beta,
+            her_ratio=her_ratio
             )
 
+        if high_buffer_index:
+            # Windows of states/actions are read back from the low buffer
+            self.replay_buffer_high = HighIndexReplayBuffer(
+                low_buffer=self.replay_buffer_low,
+                goal_dim=goal_dim,
+                subgoal_dim=subgoal_dim,
+                buffer_size=buffer_size,
+                batch_size=batch_size,
+                freq=buffer_freq,
+                dtype=buffer_dtype,
+                storage_path=os.path.join(buffer_path, 'high') if buffer_path else None,
+                prioritized=prioritized,
+                alpha=per_alpha,
+                beta=per_beta
+                )
+        else:
+            self.replay_buffer_high = HighReplayBuffer(
+                state_dim=state_dim,
+                goal_dim=goal_dim,
+                subgoal_dim=subgoal_dim,
+                action_dim=action_dim,
+                buffer_size=buffer_size,
+                batch_size=batch_size,
+                freq=buffer_freq,
+                dtype=buffer_dtype,
+                storage_path=os.path.join(buffer_path, 'high') if buffer_path else None,
+                prioritized=prioritized,
+                alpha=per_alpha,
+                beta=per_beta
+                )
+        self.high_buffer_index = high_buffer_index
+
+        # Updates per train() call of each level; the batches of all of them
+        # are sampled at once
+        self.utd_low = utd_low
+        self.utd_high = utd_high
+
+        # Batches for the next updates are sampled in the background
+        if prefetch:
+            self.sampler_low = BatchPrefetcher(self.replay_buffer_low, prefetch, utd_low * batch_size)
+            self.sampler_high = BatchPrefetcher(self.replay_buffer_high, prefetch, utd_high * batch_size)
+        else:
+            self.sampler_low = self.replay_buffer_low
+            self.sampler_high = self.replay_buffer_high
+
         self.buffer_freq = buffer_freq
         self.train_freq = train_freq
         self.reward_scaling = reward_scaling
@@ -562,6 +1060,7 @@ class HiroAgent(Agent):
         self.sr = 0
 
         self.buf = [None, None, None, 0, None, None, [], []]
+        self.buf_start = None
         self.fg = np.array([0,0])
         self.sg = self.subgoal.action_space.sample()
 
@@ -569,34 +1068,41 @@ class HiroAgent(Agent):
 
     def step(self, s, env, step, global_step=0, explore=False):
         ## Lower Level Controller
-        if explore:
-            # Take random action for start_training_steps
-            if global_step < self.start_training_steps:
-                a = env.action_space.sample()
+        with profiler.phase('act'):
+            if explore:
+                # Take random action for start_training_steps
+                if global_step < self.start_training_steps:
+                    a = env.action_space.sample()
+                else:
+                    a = self._choose_action_with_noise(s, self.sg)
             else:
-                a = self._choose_action_with_noise(s, self.sg)
-        else:
-            a = self._choose_action(s, self.sg)
+                a = self._choose_action(s, self.sg)
 
         # Take action
-        obs, r, done, _ = env.step(a)
+        with profiler.phase('env_step'):
+            obs, r, done, _ = env.step(a)
         n_s = obs['observation']
 
         ## Higher Level Controller
         # Take random action for start_training steps
-        if explore:
-            if global_step < self.start_training_steps:
-                n_sg = self.subgoal.action_space.sample()
+        with profiler.phase('act'):
+            if explore:
+                if global_step < self.start_training_steps:
+                    n_sg = self.subgoal.action_space.sample()
+                else:
+                    n_sg = self._choose_subgoal_with_noise(step, s, self.sg, n_s)
             else:
-                n_sg = self._choose_subgoal_with_noise(step, s, self.sg, n_s)
-        else:
-            n_sg = self._choose_subgoal(step, s, self.sg, n_s)
+                n_sg = self._choose_subgoal(step, s, self.sg, n_s)
         
         self.n_sg = n_sg
 
         return a, r, n_s, done
 
     def append(self, step, s, a, n_s, r, d):
+        with profiler.phase('append'):
+            self._append(step, s, a, n_s, r, d)
+
+    def _append(self, step, s, a, n_s, r, d):
         self.sr = self.low_reward(s, self.sg, n_s)
 
         # Low Replay Buffer
@@ -608,17 +1114,28 @@ class HiroAgent(Agent):
             if len(self.buf[6]) == self.buffer_freq:
                 self.buf[4] = s
                 self.buf[5] = float(d)
-                self.replay_buffer_high.append(
-                    state=self.buf[0],
-                    goal=self.buf[1],
-                    action=self.buf[2],
-                    n_state=self.buf[4],
-                    reward=self.buf[3],
-                    done=self.buf[5],
-                    state_arr=np.array(self.buf[6]),
-                    action_arr=np.array(self.buf[7])
-                )
+                if self.high_buffer_index:
+                    self.replay_buffer_high.append(
+                        goal=self.buf[1],
+                        action=self.buf[2],
+                        reward=self.buf[3],
+                        done=self.buf[5],
+                        start=self.buf_start
+                    )
+                else:
+                    self.replay_buffer_high.append(
+                        state=self.buf[0],
+                        goal=self.buf[1],
+                        action=self.buf[2],
+                        n_state=self.buf[4],
+                        reward=self.buf[3],
+                        done=self.buf[5],
+                        state_arr=np.array(self.buf[6]),
+                        action_arr=np.array(self.buf[7])
+                    )
             self.buf = [s, self.fg, self.sg, 0, None, None, [], []]
+            # s was just appended to the low buffer
+            self.buf_start = self.replay_buffer_low.total - 1
 
         self.buf[3] += self.reward_scaling * r
         self.buf[6].append(s)
@@ -629,17 +1146,129 @@ class HiroAgent(Agent):
         td_errors = {}
 
         if global_step >= self.start_training_steps:
-            loss, td_error = self.low_con.train(self.replay_buffer_low)
+            loss, td_error = self.low_con.train(self.sampler_low, self.utd_low)
             losses.update(loss)
             td_errors.update(td_error)
 
             if global_step % self.train_freq == 0:
-                loss, td_error = self.high_con.train(self.replay_buffer_high, self.low_con)
+                loss, td_error = self.high_con.train(self.sampler_high, self.low_con, self.utd_high)
                 losses.update(loss)
                 td_errors.update(td_error)
 
         return losses, td_errors
 
+    def init_envs(self, fgs):
+        # Per-env copies of fg, sg, n_sg, buf, buf_start, sr and
+        # episode_subreward
+        n = len(fgs)
+        self.fgs = np.array(fgs)
+        self.sgs = np.stack([self.subgoal.action_space.sample() for _ in range(n)])
+        self.n_sgs = self.sgs.copy()
+        self.bufs = [[None, None, None, 0, None, None, [], []] for _ in range(n)]
+        self.buf_starts = [None] * n
+        self.srs = np.zeros(n)
+        self.episode_subrewards = np.zeros(n)
+
+    def step_envs(self, s, envs, steps, global_step=0, explore=False):
+        n = len(s)
+
+        ## Lower Level Controller
+        with profiler.phase('act'):
+            if explore:
+                if global_step < self.start_training_steps:
+                    a = np.stack([envs.action_space.sample() for _ in range(n)])
+                else:
+                    a = self.low_con.policy_with_noise(s, self.sgs).reshape(n, -1)
+            else:
+                a = self.low_con.policy(s, self.sgs).reshape(n, -1)
+
+        with profiler.phase('env_step'):
+            obs, r, done, _ = envs.step(a)
+        n_s = obs['observation']
+
+        with profiler.phase('act'):
+            n_sgs = self._next_subgoals(s, n_s, steps, global_step, explore)
+        self.n_sgs = n_sgs
+
+        return a, r, n_s, done
+
+    def _next_subgoals(self, s, n_s, steps, global_step, explore):
+        n = len(s)
+        ## Higher Level Controller
+        if explore and global_step < self.start_training_steps:
+            n_sgs = np.stack([self.subgoal.action_space.sample() for _ in range(n)])
+        else:
+            n_sgs = self.subgoal_transition_batch(s, self.sgs, n_s)
+            # Only envs at the start of a window ask the high policy
+            new = steps % self.buffer_freq == 0
+            if new.any():
+                if explore:
+                    n_sgs[new] = self.high_con.policy_with_noise(s[new], self.fgs[new]).reshape(-1, n_sgs.shape[1])
+                else:
+                    n_sgs[new] = self.high_con.policy(s[new], self.fgs[new]).reshape(-1, n_sgs.shape[1])
+
+        return n_sgs
+
+    def append_envs(self, steps, s, a, n_s, r, d):
+        with profiler.phase('append'):
+            self._append_envs(steps, s, a, n_s, r, d)
+
+    def _append_envs(self, steps, s, a, n_s, r, d):
+        n = len(s)
+        self.srs = self.low_reward_batch(s, self.sgs, n_s)
+
+        # Low Replay Buffer. Env i's transition lands at global index
+        # first + i, so one env's consecutive steps are n apart.
+        first = self.replay_buffer_low.total
+        self.replay_buffer_low.append_batch(
+            s, self.sgs, a, n_s, self.n_sgs, self.srs, np.asarray(d, dtype=float))
+
+        # High Replay Buffer
+        high = []
+        for i in range(n):
+            buf = self.bufs[i]
+            if _is_update(steps[i], self.buffer_freq, rem=1):
+                if len(buf[6]) == self.buffer_freq:
+                    buf[4] = s[i]
+                    buf[5] = float(d[i])
+                    high.append((buf, self.buf_starts[i]))
+                buf = self.bufs[i] = [s[i], self.fgs[i], self.sgs[i], 0, None, None, [], []]
+                self.buf_starts[i] = first + i
+
+            buf[3] += self.reward_scaling * r[i]
+            buf[6].append(s[i])
+            buf[7].append(a[i])
+
+        if high:
+            bufs = [buf for buf, _ in high]
+            fields = dict(
+                goal=np.stack([buf[1] for buf in bufs]),
+                action=np.stack([buf[2] for buf in bufs]),
+                reward=np.array([buf[3] for buf in bufs]),
+                done=np.array([buf[5] for buf in bufs]))
+            if self.high_buffer_index:
+                self.replay_buffer_high.append_batch(
+                    start=np.array([start for _, start in high]), stride=n, **fields)
+            else:
+                self.replay_buffer_high.append_batch(
+                    state=np.stack([buf[0] for buf in bufs]),
+                    n_state=np.stack([buf[4] for buf in bufs]),
+                    state_arr=np.array([buf[6] for buf in bufs]),
+                    action_arr=np.array([buf[7] for buf in bufs]),
+                    **fields)
+
+    def end_step_envs(self):
+        self.episode_subrewards += self.srs
+        self.sgs = self.n_sgs
+
+    def end_episode_env(self, i, episode, logger=None):
+        self.episode_subreward = self.episode_subrewards[i]
+        self.end_episode(episode, logger)
+        self.episode_subrewards[i] = 0
+        # Like self.buf in end_episode(): no window spans two episodes
+        self.bufs[i] = [None, None, None, 0, None, None, [], []]
+        self.buf_starts[i] = None
+
     def _choose_action_with_noise(self, s, sg):
         return self.low_con.policy_with_noise(s, sg)
 
@@ -669,6 +1298,12 @@ class HiroAgent(Agent):
         abs_s = s[:sg.shape[0]] + sg
         return -np.sqrt(np.sum((abs_s - n_s[:sg.shape[0]])**2))
 
+    def subgoal_transition_batch(self, s, sg, n_s):
+        return subgoal_transition(s, sg, n_s)
+
+    def low_reward_batch(self, s, sg, n_s):
+        return low_reward(s, sg, n_s)
+
     def end_step(self):
         self.episode_subreward += self.sr
         self.sg = self.n_sg
@@ -678,6 +1313,9 @@ class HiroAgent(Agent):
             # log
             logger.write('reward/Intrinsic Reward', self.episode_subreward, episode)
 
+            self.replay_buffer_low.flush()
+            self.replay_buffer_high.flush()
+
             # Save Model
             if _is_update(episode, self.model_save_freq):
                 self.save(episode=episode)
@@ -693,3 +1331,54 @@ class HiroAgent(Agent):
     def load(self, episode):
         self.low_con.load(episode)
         self.high_con.load(episode)
+
+    def snapshot(self):
+        return HiroPolicy(self)
+
+    def state_dict(self):
+        return {
+            'high_con': self.high_con.state_dict(),
+            'low_con': self.low_con.state_dict(),
+            'replay_buffer_low': self.replay_buffer_low.state_dict(),
+            'replay_buffer_high': self.replay_buffer_high.state_dict(),
+            # The high level transition being collected
+            'rollout': copy.deepcopy({
+                'fg': self.fg,
+                'sg': self.sg,
+                'buf': self.buf,
+                'buf_start': self.buf_start,
+                'episode_subreward': self.episode_subreward,
+            }),
+        }
+
+    def load_state_dict(self, state):
+        self.high_con.load_state_dict(state['high_con'])
+        self.low_con.load_state_dict(state['low_con'])
+        self.replay_buffer_low.load_state_dict(state['replay_buffer_low'])
+        self.replay_buffer_high.load_state_dict(state['replay_buffer_high'])
+        for k, v in state['rollout'].items():
+            setattr(self, k, v)
+
+class HiroPolicy(HiroAgent):
+    # Snapshot of a HiroAgent for evaluation: both actors, the subgoal
+    # state and fg
+    def __init__(self, agent):
+        self.subgoal = agent.subgoal
+        self.high_con = PolicySnapshot(agent.high_con)
+        self.low_con = PolicySnapshot(agent.low_con)
+        self.buffer_freq = agent.buffer_freq
+        self.start_training_steps = agent.start_training_steps
+
+        self.fg = agent.fg.copy()
+        self.sg = agent.sg.copy()
+        self.sr = 0
+        self.episode_subreward = 0
+
+    def append(self, step, s, a, n_s, r, d):
+        raise NotImplementedError('A policy snapshot has no replay buffer')
+
+    def train(self, global_step):
+        raise NotImplementedError('A policy snapshot can not be trained')
+
+    def end_episode(self, episode, logger=None):
+        self.episode_subreward = 0
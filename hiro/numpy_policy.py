@@ -0,0 +1,138 @@
+##################################################
+# Hierarchical policy in NumPy for rollout workers
+#
+# export_numpy_actors() (hiro/export.py) writes the weights of the high and
+# low TD3Actor of a HiroAgent, with the settings of the hierarchy, to one
+# .npz file. NumpyHiroPolicy runs the hierarchical policy from that file
+# like HiroAgent does without exploration. This module only needs NumPy:
+# it must not import torch, hiro.models or the environment packages.
+#
+#   export_numpy_actors(agent, 'model/exp/policy.npz')
+#   policy = NumpyHiroPolicy('model/exp/policy.npz')
+#   rewards, error = policy.evaluate_episode(env, seed=0)
+import copy
+import numpy as np
+
+LAYERS = ('l1', 'l2', 'l3')
+
+
+class NumpyActor():
+    # TD3Actor.forward() on (n, state_dim) and (n, goal_dim) float32 rows.
+    # Weights are kept as (in, out), so every layer is one matmul.
+    def __init__(self, weights, biases, scale):
+        self.weights = [np.ascontiguousarray(w, dtype=np.float32) for w in weights]
+        self.biases = [np.asarray(b, dtype=np.float32) for b in biases]
+        self.scale = np.asarray(scale, dtype=np.float32)
+
+    @classmethod
+    def from_arrays(cls, arrays, name):
+        # Inverse of actor_arrays() in hiro/export.py
+        return cls([arrays['%s.%s.weight' % (name, l)] for l in LAYERS],
+                   [arrays['%s.%s.bias' % (name, l)] for l in LAYERS],
+                   arrays['%s.scale' % name])
+
+    def __call__(self, state, goal):
+        (w1, w2, w3), (b1, b2, b3) = self.weights, self.biases
+        a = np.concatenate([state, goal], 1) @ w1
+        a += b1
+        np.maximum(a, 0, out=a)
+        a = a @ w2
+        a += b2
+        np.maximum(a, 0, out=a)
+        a = a @ w3
+        a += b3
+        np.tanh(a, out=a)
+        a *= self.scale
+        return a
+
+
+class ExportedHiroPolicy():
+    # HiroAgent.step()/end_step() without exploration, on a high and a low
+    # actor set by the subclass
+    def __init__(self, buffer_freq, subgoal_dim, goal_dim, sg):
+        self.buffer_freq = buffer_freq
+        self.subgoal_dim = subgoal_dim
+        self.fg = np.zeros(goal_dim)
+        self.sg = np.array(sg, dtype=np.float32)
+        self.n_sg = self.sg
+
+    def snapshot(self):
+        return copy.deepcopy(self)
+
+    def _run(self, actor, state, goal):
+        # Rows of state and goal (or single ones) -> actions, squeezed like
+        # TD3Controller.policy()
+        state = np.asarray(state, dtype=np.float32)
+        goal = np.asarray(goal, dtype=np.float32)
+        return actor(state.reshape(-1, state.shape[-1]), goal.reshape(-1, goal.shape[-1])).squeeze()
+
+    def action(self, s, sg):
+        return self._run(self.low_actor, s, sg)
+
+    def subgoal(self, s, fg):
+        return self._run(self.high_actor, s, fg)
+
+    def subgoal_transition(self, s, sg, n_s):
+        dim = self.subgoal_dim
+        return s[..., :dim] + sg - n_s[..., :dim]
+
+    def set_final_goal(self, fg):
+        self.fg = fg
+
+    def step(self, s, env, step, global_step=0, explore=False):
+        if explore:
+            raise NotImplementedError('An exported policy does not explore')
+        a = self.action(s, self.sg)
+        obs, r, done, _ = env.step(a)
+        n_s = obs['observation']
+
+        if step % self.buffer_freq == 0:
+            self.n_sg = self.subgoal(s, self.fg)
+        else:
+            self.n_sg = self.subgoal_transition(s, self.sg, n_s)
+        return a, r, n_s, done
+
+    def end_step(self):
+        self.sg = self.n_sg
+
+    def end_episode(self, episode, logger=None):
+        pass
+
+    def _seed(self, seed):
+        np.random.seed(seed)
+
+    def evaluate_episode(self, env, seed=None):
+        # Agent.evaluate_episode() without rendering: the episode reward and
+        # the final distance to the goal
+        if seed is not None:
+            self._seed(seed)
+            env.seed(seed)
+
+        obs = env.reset()
+        fg = obs['desired_goal']
+        s = obs['observation']
+        self.set_final_goal(fg)
+
+        done = False
+        reward_episode_sum = 0
+        step = 0
+        while not done:
+            a, r, n_s, done = self.step(s, env, step)
+            reward_episode_sum += r
+            s = n_s
+            step += 1
+            self.end_step()
+
+        return reward_episode_sum, np.sqrt(np.sum(np.square(fg - s[:2])))
+
+
+class NumpyHiroPolicy(ExportedHiroPolicy):
+    # Loads the file written by export_numpy_actors()
+    def __init__(self, filename):
+        with np.load(filename) as arrays:
+            self.high_actor = NumpyActor.from_arrays(arrays, 'high')
+            self.low_actor = NumpyActor.from_arrays(arrays, 'low')
+            sg = arrays['sg']
+            buffer_freq = int(arrays['buffer_freq'])
+        goal_dim = self.high_actor.weights[0].shape[0] - self.low_actor.weights[0].shape[0] + len(sg)
+        super(NumpyHiroPolicy, self).__init__(buffer_freq, len(sg), goal_dim, sg)
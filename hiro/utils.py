@@ -1,5 +1,9 @@
 import os 
 import csv
+import copy
+import time
+import random
+import threading
 import numpy as np
 import torch
 from torch.utils.tensorboard import SummaryWriter
@@ -73,6 +77,201 @@ class ReplayBuffer():
             torch.FloatTensor(self.not_done[ind]).to(self.device),
         )
 
+class _NoPhase(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+class _Phase(object):
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        profiler = self.profiler
+        profiler._depth += 1
+        if profiler._depth > 1:
+            return
+        if profiler.cuda_sync:
+            torch.cuda.synchronize()
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        profiler = self.profiler
+        profiler._depth -= 1
+        if profiler._depth > 0:
+            return
+        if profiler.cuda_sync:
+            torch.cuda.synchronize()
+        profiler._add(self.name, time.perf_counter() - self.start)
+
+class Profiler():
+    # Wall-clock time per phase of the training loop. Phases entered inside
+    # another one (e.g. the policy's 'act' while 'evaluate' runs) count
+    # towards the outer one only; whatever is not covered by a phase is
+    # reported as 'other'. Disabled, the profiler hands out one shared
+    # no-op context manager.
+    #
+    #   with profiler.phase('critic_update', 'low'): ...
+    #   profiler.count('updates', 'low')    # events reported per second
+    #   profiler.step(global_step, logger)  # once per global step
+    _no_phase = _NoPhase()
+
+    def __init__(self):
+        self.enabled = False
+        self.cuda_sync = False
+
+    def enable(self, window=1000, cuda_sync=None):
+        # On CUDA, kernels are waited for at both ends of a phase so their
+        # time lands in the phase that launched them
+        self.enabled = True
+        self.window = window
+        self.cuda_sync = torch.cuda.is_available() if cuda_sync is None else cuda_sync
+        self._phases = {}
+        self._window = {}
+        self._total = {}
+        self._calls = {}
+        self._counts = {}
+        self._window_counts = {}
+        self._steps = 0
+        self._depth = 0
+        self._start = self._window_start = time.perf_counter()
+
+    def disable(self):
+        self.enabled = False
+        self.cuda_sync = False
+
+    def phase(self, name, group=None):
+        if not self.enabled:
+            return self._no_phase
+        if group is not None:
+            name = group + '/' + name
+        phase = self._phases.get(name)
+        if phase is None:
+            phase = self._phases[name] = _Phase(self, name)
+        return phase
+
+    def count(self, name, group=None, n=1):
+        if not self.enabled:
+            return
+        if group is not None:
+            name = group + '/' + name
+        self._counts[name] = self._counts.get(name, 0) + n
+        self._window_counts[name] = self._window_counts.get(name, 0) + n
+
+    def _add(self, name, seconds):
+        self._window[name] = self._window.get(name, 0.) + seconds
+        self._total[name] = self._total.get(name, 0.) + seconds
+        self._calls[name] = self._calls.get(name, 0) + 1
+
+    def step(self, global_step, logger=None):
+        # Writes steps/sec and ms per step of every phase every window steps
+        if not self.enabled:
+            return
+        self._steps += 1
+        if self._steps % self.window:
+            return
+
+        now = time.perf_counter()
+        elapsed, self._window_start = now - self._window_start, now
+        if logger is not None:
+            logger.write('profile/steps_per_sec', self.window / elapsed, global_step)
+            for name, seconds in self._window.items():
+                logger.write('profile/ms/%s' % name, 1e3 * seconds / self.window, global_step)
+            other = elapsed - sum(self._window.values())
+            logger.write('profile/ms/other', 1e3 * other / self.window, global_step)
+            for name, n in self._window_counts.items():
+                logger.write('profile/per_sec/%s' % name, n / elapsed, global_step)
+        self._window = {}
+        self._window_counts = {}
+
+    def summary(self):
+        if not self.enabled:
+            return ''
+        elapsed = time.perf_counter() - self._start
+        steps = max(self._steps, 1)
+        lines = ['%-32s %10s %7s %10s %10s' % ('phase', 'total [s]', '%', 'ms/step', 'calls')]
+        rows = sorted(self._total.items(), key=lambda x: -x[1])
+        rows.append(('other', elapsed - sum(self._total.values())))
+        for name, seconds in rows:
+            lines.append('%-32s %10.2f %7.1f %10.3f %10d' % (
+                name, seconds, 100 * seconds / elapsed, 1e3 * seconds / steps, self._calls.get(name, 0)))
+        lines.append('%d steps in %.1f s, %.1f steps/sec' % (self._steps, elapsed, self._steps / elapsed))
+        for name, n in sorted(self._counts.items()):
+            lines.append('%d %s, %.1f/sec' % (n, name, n / elapsed))
+        return '\n'.join(lines)
+
+# Shared by the agents, controllers and Trainer; see main.py --profile
+profiler = Profiler()
+
+def clone_state(obj):
+    # Copy of a (nested) state dict with every tensor copied to CPU, which
+    # stays consistent while training goes on
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: clone_state(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(clone_state(v) for v in obj)
+    return copy.deepcopy(obj)
+
+def get_rng_state():
+    state = {
+        'random': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state):
+    random.setstate(state['random'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+class CheckpointWriter():
+    # Serializes checkpoints on a background thread. At most one write is in
+    # flight: save() first waits for the previous one. The file is written
+    # to <path>.tmp and renamed, so an interrupted write keeps the last
+    # complete checkpoint.
+    def __init__(self):
+        self._thread = None
+        self._error = None
+
+    def save(self, state, path):
+        self.wait()
+        self._thread = threading.Thread(target=self._write, args=(state, path), daemon=True)
+        self._thread.start()
+
+    def _write(self, state, path):
+        try:
+            dirname = os.path.dirname(path)
+            if dirname and not os.path.exists(dirname):
+                os.makedirs(dirname)
+            torch.save(state, path+'.tmp')
+            os.replace(path+'.tmp', path)
+        except Exception as e:
+            self._error = e
+
+    def wait(self):
+        # Also re-raises an error of the last write
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+def load_checkpoint(path):
+    return torch.load(path, map_location='cpu', weights_only=False)
+
 def record_experience_to_csv(args, experiment_name, csv_name='experiments.csv'):
     # append DATE_TIME to dict
     d = vars(args)
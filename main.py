@@ -2,12 +2,17 @@ import os
 import argparse
 import numpy as np
 import datetime
-import copy
-from envs import EnvWithGoal
-from envs.create_maze_env import create_maze_env
+import time
+import functools
+from envs import make_env, env_dims
+from envs.vec_env import make_vec_env
+from envs.point_maze_env import VecPointMazeEnv
 from hiro.hiro_utils import Subgoal 
 from hiro.utils import Logger, _is_update, record_experience_to_csv, listdirs
+from hiro.utils import CheckpointWriter, load_checkpoint, get_rng_state, set_rng_state, profiler
 from hiro.models import HiroAgent, TD3Agent
+from hiro.async_training import ActorPool
+from hiro.evaluation import EvaluationPool
 
 def run_evaluation(args, env, agent):
     agent.load(args.load_episode)
@@ -24,17 +29,43 @@ def run_evaluation(args, env, agent):
                 success=success_rate))
 
 class Trainer():
-    def __init__(self, args, env, agent, experiment_name):
+    def __init__(self, args, env, agent, experiment_name, envs=None):
         self.args = args
-        self.env = env
+        self._env = env
+        self.envs = envs
         self.agent = agent 
         log_path = os.path.join(args.log_path, experiment_name)
         self.logger = Logger(log_path=log_path)
 
+        # Progress, moved forward by resume()
+        self.start_episode = 1
+        self.start_global_step = 0
+        self.checkpoint_path = os.path.join(args.model_path, experiment_name, 'checkpoint.pt')
+        self.checkpoint_writer = CheckpointWriter()
+
+        # Evaluation episodes run in worker processes when eval_workers > 0
+        self.evaluator = None
+        if args.eval_workers > 0 or args.async_eval:
+            self.evaluator = EvaluationPool(functools.partial(make_env, args.env), max(args.eval_workers, 1))
+        self.pending_evaluations = []
+
+    @property
+    def env(self):
+        # Only started once needed; async training with evaluation workers
+        # never runs a simulator in this process
+        if self._env is None:
+            self._env = make_env(self.args.env)
+        return self._env
+
     def train(self):
-        global_step = 0
+        if self.args.num_actors > 0:
+            return self.train_async()
+        if self.envs is not None:
+            return self.train_envs()
 
-        for e in np.arange(self.args.num_episode)+1:
+        global_step = self.start_global_step
+
+        for e in np.arange(self.start_episode, self.args.num_episode+1):
             obs = self.env.reset()
             fg = obs['desired_goal']
             s = obs['observation']
@@ -57,6 +88,7 @@ class Trainer():
 
                 # Log
                 self.log(global_step, [losses, td_errors])
+                profiler.step(global_step, self.logger)
                 
                 # Updates
                 s = n_s
@@ -68,32 +100,174 @@ class Trainer():
             self.agent.end_episode(e, self.logger)
             self.logger.write('reward/Reward', episode_reward, e)
             self.evaluate(e)
+            self.checkpoint(e, global_step)
+
+    def train_envs(self):
+        # Same as train(), but steps all of self.envs at once. Every env step
+        # counts as one global step and gets one training update.
+        global_step = self.start_global_step
+        e = self.start_episode - 1
+        num_envs = self.envs.num_envs
+
+        obs = self.envs.reset()
+        s = obs['observation']
+        steps = np.zeros(num_envs, dtype=int)
+        episode_rewards = np.zeros(num_envs)
+        self.agent.init_envs(obs['desired_goal'])
+
+        while e < self.args.num_episode:
+            # Take action
+            a, r, n_s, done = self.agent.step_envs(s, self.envs, steps, global_step, explore=True)
+
+            # Append
+            self.agent.append_envs(steps, s, a, n_s, r, done)
+
+            # Train
+            for _ in range(num_envs):
+                losses, td_errors = self.agent.train(global_step)
+                self.log(global_step, [losses, td_errors])
+                profiler.step(global_step, self.logger)
+                global_step += 1
+
+            # Updates
+            s = n_s
+            episode_rewards += r
+            steps += 1
+            self.agent.end_step_envs()
+
+            for i in np.flatnonzero(done):
+                e += 1
+                self.agent.end_episode_env(i, e, self.logger)
+                self.logger.write('reward/Reward', episode_rewards[i], e)
+                self.evaluate(e)
+                self.checkpoint(e, global_step)
+
+                obs = self.envs.reset(i)
+                s[i] = obs['observation'][0]
+                self.agent.set_final_goals(i, obs['desired_goal'][0])
+                steps[i] = 0
+                episode_rewards[i] = 0
+
+                if e == self.args.num_episode:
+                    break
+
+        self.envs.close()
+
+    def train_async(self):
+        # Actor processes collect experience into the shared replay buffers
+        # while this process trains. global_step counts learner updates.
+        pool = ActorPool(
+            self.agent,
+            functools.partial(make_env, self.args.env),
+            self.args.num_actors,
+            utd_ratio=self.args.utd_ratio,
+            max_staleness=self.args.max_staleness,
+            start_training_steps=self.args.start_training_steps)
+        pool.start()
+
+        global_step = self.start_global_step
+        e = self.start_episode - 1
+        try:
+            while e < self.args.num_episode:
+                for episode_reward, episode_subreward in pool.finished_episodes():
+                    e += 1
+                    self.agent.episode_subreward = episode_subreward
+                    self.agent.end_episode(e, self.logger)
+                    self.logger.write('reward/Reward', episode_reward, e)
+                    self.evaluate(e)
+                    self.checkpoint(e, global_step)
+
+                if not pool.can_update():
+                    time.sleep(0.001)
+                    continue
+
+                # Train
+                losses, td_errors = self.agent.train(self.args.start_training_steps + global_step)
+                # One train() call makes utd_low updates of the lower level
+                pool.record_update(getattr(self.agent, 'utd_low', 1))
+
+                # Log
+                self.log(self.args.start_training_steps + global_step, [losses, td_errors])
+                profiler.step(self.args.start_training_steps + global_step, self.logger)
+
+                global_step += 1
+                if _is_update(global_step, self.args.publish_freq):
+                    pool.publish()
+        finally:
+            pool.close()
+
+    def checkpoint(self, e, global_step):
+        # Written in the background from a copy taken here
+        if self.args.checkpoint_freq > 0 and _is_update(e, self.args.checkpoint_freq):
+            with profiler.phase('checkpoint'):
+                state = {
+                    'episode': e,
+                    'global_step': global_step,
+                    'rng': get_rng_state(),
+                    'agent': self.agent.state_dict(),
+                }
+                self.checkpoint_writer.save(state, self.checkpoint_path)
+
+    def resume(self):
+        state = load_checkpoint(self.checkpoint_path)
+        self.agent.load_state_dict(state['agent'])
+        set_rng_state(state['rng'])
+        self.start_episode = state['episode'] + 1
+        self.start_global_step = state['global_step']
+        print('resumed from episode %d (global step %d)' % (state['episode'], state['global_step']))
 
     def log(self, global_step, data):
         losses, td_errors = data[0], data[1]
 
         # Logs
         if global_step >= self.args.start_training_steps and _is_update(global_step, args.writer_freq):
-            for k, v in losses.items():
-                self.logger.write('loss/%s'%(k), v, global_step)
-            
-            for k, v in td_errors.items():
-                self.logger.write('td_error/%s'%(k), v, global_step)
+            with profiler.phase('log'):
+                for k, v in losses.items():
+                    self.logger.write('loss/%s'%(k), v, global_step)
+                
+                for k, v in td_errors.items():
+                    self.logger.write('td_error/%s'%(k), v, global_step)
     
     def evaluate(self, e):
+        self.log_evaluations()
+
         # Print
         if _is_update(e, args.print_freq):
-            agent = copy.deepcopy(self.agent)
-            rewards, success_rate = agent.evaluate_policy(self.env)
-            #rewards, success_rate = self.agent.evaluate_policy(self.env)
-            self.logger.write('Success Rate', success_rate, e)
-            
-            print('episode:{episode:05d}, mean:{mean:.2f}, std:{std:.2f}, median:{median:.2f}, success:{success:.2f}'.format(
-                    episode=e, 
-                    mean=np.mean(rewards), 
-                    std=np.std(rewards), 
-                    median=np.median(rewards), 
-                    success=success_rate))
+            with profiler.phase('evaluate'):
+                policy = self.agent.snapshot()
+                if self.evaluator is None:
+                    rewards, success_rate = policy.evaluate_policy(self.env)
+                elif self.args.async_eval:
+                    # Logged by a later evaluate() call once it is done
+                    self.pending_evaluations.append((e, self.evaluator.evaluate_async(policy, seed=self.args.eval_seed)))
+                    return
+                else:
+                    rewards, success_rate = self.evaluator.evaluate(policy, seed=self.args.eval_seed)
+            self.log_evaluation(e, rewards, success_rate)
+
+    def log_evaluations(self, wait=False):
+        while self.pending_evaluations and (wait or self.pending_evaluations[0][1].ready()):
+            e, result = self.pending_evaluations.pop(0)
+            rewards, success_rate = result.get()
+            self.log_evaluation(e, rewards, success_rate)
+
+    def log_evaluation(self, e, rewards, success_rate):
+        self.logger.write('Success Rate', success_rate, e)
+        
+        print('episode:{episode:05d}, mean:{mean:.2f}, std:{std:.2f}, median:{median:.2f}, success:{success:.2f}'.format(
+                episode=e, 
+                mean=np.mean(rewards), 
+                std=np.std(rewards), 
+                median=np.median(rewards), 
+                success=success_rate))
+
+    def close(self):
+        self.checkpoint_writer.wait()
+        if self.evaluator is not None:
+            self.log_evaluations(wait=True)
+            self.evaluator.close()
+        if profiler.enabled:
+            print(profiler.summary())
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -105,26 +279,52 @@ if __name__ == '__main__':
     parser.add_argument('--save_video', action='store_true')
     parser.add_argument('--sleep', type=float, default=-1)
     parser.add_argument('--eval_episodes', type=float, default=5, help='Unit = Episode')
-    parser.add_argument('--env', default='AntMaze', type=str)
+    parser.add_argument('--env', default='AntMaze', type=str, help='AntMaze, AntPush, AntFall, or PointMaze, PointPush, PointFall for the NumPy point mass')
     parser.add_argument('--td3', action='store_true')
 
     # Training
     parser.add_argument('--num_episode', default=25000, type=int)
     parser.add_argument('--start_training_steps', default=2500, type=int, help='Unit = Global Step')
     parser.add_argument('--writer_freq', default=25, type=int, help='Unit = Global Step')
+    parser.add_argument('--num_envs', default=1, type=int, help='Environments stepped together in subprocesses')
+    parser.add_argument('--utd_low', default=1, type=int, help='Lower controller updates per training step, trained on one batch sampled for all of them')
+    parser.add_argument('--utd_high', default=1, type=int, help='Higher controller updates every train_freq steps, trained on one batch sampled for all of them')
+    # Training (Asynchronous actor-learner)
+    parser.add_argument('--num_actors', default=0, type=int, help='Actor processes collecting experience while this process trains; 0 to alternate on one thread')
+    parser.add_argument('--utd_ratio', default=1.0, type=float, help='Learner updates per environment step, counting each of the --utd_low updates of a training step')
+    parser.add_argument('--max_staleness', default=1000, type=int, help='Unit = Environment Step, how far actors may run ahead of the learner')
+    parser.add_argument('--publish_freq', default=100, type=int, help='Unit = Update, how often actor weights are sent to the actors')
     # Training (Model Saving)
     parser.add_argument('--subgoal_dim', default=15, type=int)
     parser.add_argument('--load_episode', default=-1, type=int)
     parser.add_argument('--model_save_freq', default=2000, type=int, help='Unit = Episodes')
     parser.add_argument('--print_freq', default=250, type=int, help='Unit = Episode')
     parser.add_argument('--exp_name', default=None, type=str)
+    parser.add_argument('--checkpoint_freq', default=0, type=int, help='Unit = Episode, 0 to disable full training checkpoints')
+    parser.add_argument('--resume', action='store_true', help='Resume training from the checkpoint of --exp_name (default: latest experiment)')
+    parser.add_argument('--profile', action='store_true', help='Time every phase of the training loop, logged to profile/ and printed at the end')
+    parser.add_argument('--profile_window', default=1000, type=int, help='Unit = Global Step, window of the profile/ logs')
+    # Training (Evaluation)
+    parser.add_argument('--eval_workers', default=0, type=int, help='Worker processes for evaluation episodes; 0 to run them in this process')
+    parser.add_argument('--async_eval', action='store_true', help='Keep training while evaluations run, log results when they arrive')
+    parser.add_argument('--eval_seed', default=0, type=int, help='Seed of the first episode of every evaluation run by eval workers')
     # Model
     parser.add_argument('--model_path', default='model', type=str)
     parser.add_argument('--log_path', default='log', type=str)
     parser.add_argument('--policy_freq_low', default=2, type=int)
     parser.add_argument('--policy_freq_high', default=2, type=int)
+    parser.add_argument('--fused_critic', action='store_true', help='Run both critics of a controller as one batched ensemble with one optimizer')
+    parser.add_argument('--target_update', default='loop', type=str, choices=['loop', 'foreach', 'flat'], help='How soft target updates run: per parameter, one multi-tensor op, or on flat parameter buffers')
     # Replay Buffer
     parser.add_argument('--buffer_size', default=200000, type=int)
+    parser.add_argument('--buffer_dtype', default='float32', type=str, choices=['float16', 'float32', 'float64'])
+    parser.add_argument('--disk_buffer', action='store_true', help='Memory-map replay buffers under the experiment directory')
+    parser.add_argument('--high_buffer_index', action='store_true', help='High buffer references low buffer windows instead of copying them')
+    parser.add_argument('--per', action='store_true', help='Prioritized experience replay')
+    parser.add_argument('--per_alpha', default=0.6, type=float)
+    parser.add_argument('--per_beta', default=0.4, type=float)
+    parser.add_argument('--prefetch', default=0, type=int, help='Number of batches sampled ahead on a background thread')
+    parser.add_argument('--her_ratio', default=0., type=float, help='Fraction of low level samples relabeled with subgoals achieved later in their episode')
     parser.add_argument('--batch_size', default=100, type=int)
     parser.add_argument('--buffer_freq', default=10, type=int)
     parser.add_argument('--train_freq', default=10, type=int)
@@ -135,7 +335,7 @@ if __name__ == '__main__':
     if args.exp_name:
         experiment_name = args.exp_name
     else:
-        if args.eval:
+        if args.eval or args.resume:
             # choose most updated experiment for evaluation
             dirs_str = listdirs(args.model_path)
             dirs = np.array(list(map(int, dirs_str)))
@@ -144,12 +344,11 @@ if __name__ == '__main__':
             experiment_name = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
     print(experiment_name)
 
-    # Environment and its attributes
-    env = EnvWithGoal(create_maze_env(args.env), args.env)
-    goal_dim = 2
-    state_dim = env.state_dim
-    action_dim = env.action_dim
-    scale = env.action_space.high * np.ones(action_dim)
+    # Environment attributes, read without starting a simulator. The
+    # environment itself is made when it is first used.
+    state_dim, goal_dim, action_dim, scale = env_dims(args.env)
+    env = make_env(args.env) if args.eval else None
+    buffer_path = os.path.join(args.model_path, experiment_name, 'buffer') if args.disk_buffer else None
 
     # Spawn an agent
     if args.td3:
@@ -162,7 +361,15 @@ if __name__ == '__main__':
             model_path=os.path.join(args.model_path, experiment_name),
             buffer_size=args.buffer_size,
             batch_size=args.batch_size,
-            start_training_steps=args.start_training_steps
+            start_training_steps=args.start_training_steps,
+            buffer_dtype=args.buffer_dtype,
+            buffer_path=buffer_path,
+            prioritized=args.per,
+            per_alpha=args.per_alpha,
+            per_beta=args.per_beta,
+            prefetch=args.prefetch,
+            fused_critic=args.fused_critic,
+            target_update=args.target_update
             )
     else:
         agent = HiroAgent(
@@ -180,7 +387,19 @@ if __name__ == '__main__':
             train_freq=args.train_freq,
             reward_scaling=args.reward_scaling,
             policy_freq_high=args.policy_freq_high,
-            policy_freq_low=args.policy_freq_low
+            policy_freq_low=args.policy_freq_low,
+            buffer_dtype=args.buffer_dtype,
+            buffer_path=buffer_path,
+            high_buffer_index=args.high_buffer_index,
+            prioritized=args.per,
+            per_alpha=args.per_alpha,
+            per_beta=args.per_beta,
+            prefetch=args.prefetch,
+            her_ratio=args.her_ratio,
+            fused_critic=args.fused_critic,
+            target_update=args.target_update,
+            utd_low=args.utd_low,
+            utd_high=args.utd_high
             )
 
     # Run training or evaluation
@@ -188,7 +407,19 @@ if __name__ == '__main__':
         # Record this experiment with arguments to a CSV file
         record_experience_to_csv(args, experiment_name)
         # Start training
-        trainer = Trainer(args, env, agent, experiment_name)
+        envs = None
+        if args.num_envs > 1 and args.env.startswith('Point'):
+            # Point mass envs are all stepped in one NumPy call
+            envs = VecPointMazeEnv(args.env, args.num_envs)
+        elif args.num_envs > 1:
+            # Workers send every observation right away, so they can reuse one array
+            envs = make_vec_env([functools.partial(make_env, args.env, obs_buffer=True)] * args.num_envs)
+        if args.profile:
+            profiler.enable(window=args.profile_window)
+        trainer = Trainer(args, env, agent, experiment_name, envs)
+        if args.resume:
+            trainer.resume()
         trainer.train()
+        trainer.close()
     if args.eval:
         run_evaluation(args, env, agent)
\ No newline at end of file
@@ -0,0 +1,89 @@
+# Fixtures shared by the test modules
+import functools
+import numpy as np
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import gym
+from hiro.models import HiroAgent
+
+STATE_DIM = 31
+ACTION_DIM = 8
+GOAL_DIM = 2
+SUBGOAL_DIM = 15
+FREQ = 10
+
+class CountingEnv(object):
+    # Deterministic stand-in for EnvWithGoal. state[0] is the step count,
+    # state[1] the env id and state[2:] the last action.
+    def __init__(self, env_id, length=25):
+        self.env_id = env_id
+        self.length = length
+        self.count = 0
+        self.state_dim = STATE_DIM
+        self.action_dim = ACTION_DIM
+        self.observation_space = gym.spaces.Box(-np.inf, np.inf, (STATE_DIM - 1,))
+        self.action_space = gym.spaces.Box(-30, 30, (ACTION_DIM,))
+
+    def seed(self, seed):
+        pass
+
+    def _obs(self, a):
+        s = np.zeros(STATE_DIM)
+        s[0], s[1] = self.count, self.env_id
+        s[2:2+ACTION_DIM] = a
+        return {'observation': s, 'achieved_goal': s[:2], 'desired_goal': np.array([self.env_id, 0.])}
+
+    def reset(self):
+        self.count = 0
+        return self._obs(np.zeros(ACTION_DIM))
+
+    def step(self, a):
+        self.count += 1
+        return self._obs(a), -float(self.count), self.count >= self.length, {}
+
+def counting_env_fns(num_envs, length=25):
+    return [functools.partial(CountingEnv, i, length) for i in range(num_envs)]
+
+def spawn_hiro_agent(buffer_size=1000, high_buffer_index=False, prioritized=False, prefetch=0, her_ratio=0.,
+                     utd_low=1, utd_high=1, goal_dim=GOAL_DIM, buffer_path=None):
+    return HiroAgent(
+        state_dim=STATE_DIM,
+        action_dim=ACTION_DIM,
+        goal_dim=goal_dim,
+        subgoal_dim=SUBGOAL_DIM,
+        scale_low=30 * np.ones(ACTION_DIM),
+        start_training_steps=0,
+        model_save_freq=1000,
+        model_path='model',
+        buffer_size=buffer_size,
+        batch_size=64,
+        buffer_freq=FREQ,
+        train_freq=10,
+        reward_scaling=0.1,
+        policy_freq_high=2,
+        policy_freq_low=2,
+        high_buffer_index=high_buffer_index,
+        prioritized=prioritized,
+        prefetch=prefetch,
+        her_ratio=her_ratio,
+        utd_low=utd_low,
+        utd_high=utd_high,
+        buffer_path=buffer_path)
+
+def run_episodes(agents, episode_lengths):
+    # Feeds identical transitions to every agent. The first entry of each
+    # state is the global step, so windows can be checked for continuity.
+    global_step = 0
+    for length in episode_lengths:
+        for step in range(length):
+            s = np.full(STATE_DIM, float(global_step))
+            n_s = s + 1
+            a = np.full(ACTION_DIM, -float(global_step))
+            sg = np.full(SUBGOAL_DIM, float(step))
+            for agent in agents:
+                agent.n_sg = sg
+                agent.append(step, s, a, n_s, 1.0, step == length-1)
+                agent.end_step()
+            global_step += 1
+        for agent in agents:
+            agent.end_episode(0)
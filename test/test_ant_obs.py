@@ -0,0 +1,137 @@
+import unittest
+import os
+import tempfile
+import numpy as np
+import gym
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from envs import EnvWithGoal, maze_env, env_dims
+from envs.ant import AntEnv
+
+class StubData(object):
+    def __init__(self, rng):
+        # Ant joints and those of a movable block
+        self.qpos = rng.randn(17)
+        self.qvel = rng.randn(16)
+
+class StubAnt(AntEnv):
+    # AntEnv with the simulator replaced by random walks of qpos and qvel
+    dt = 0.05
+    frame_skip = 5
+
+    def __init__(self, file_path=None, expose_all_qpos=True, expose_body_coms=None, expose_body_comvels=None):
+        self._expose_all_qpos = expose_all_qpos
+        self._expose_body_coms = expose_body_coms
+        self._expose_body_comvels = expose_body_comvels
+        self._init_obs_layout()
+        self.rng = np.random.RandomState(0)
+        self.np_random = np.random.RandomState()
+        self.data = StubData(self.rng)
+        self.action_space = gym.spaces.Box(-30, 30, (8,))
+
+    def seed(self, seed=None):
+        self.np_random = np.random.RandomState(seed)
+        return [seed]
+
+    def do_simulation(self, a, frame_skip):
+        self.data.qpos += 0.01 * self.rng.randn(len(self.data.qpos))
+        self.data.qvel += 0.01 * self.rng.randn(len(self.data.qvel))
+
+    def get_body_com(self, name):
+        return self.data.qpos[:3] * (len(name) + 1)
+
+    def get_body_comvel(self, name):
+        return self.data.qvel[:3] * (len(name) + 1)
+
+    def reset(self):
+        # Start noise from np_random, like AntEnv.reset_model
+        self.data.qpos[:] = self.np_random.uniform(-.1, .1, len(self.data.qpos))
+        self.data.qvel[:] = .1 * self.np_random.randn(len(self.data.qvel))
+        return self._get_obs()
+
+class StubMazeEnv(maze_env.MazeEnv):
+    MODEL_CLASS = StubAnt
+
+def reference_obs(ant):
+    # AntEnv._get_obs before observations were written into a buffer
+    if ant._expose_all_qpos:
+        obs = np.concatenate([ant.data.qpos.flat[:15], ant.data.qvel.flat[:14]])
+    else:
+        obs = np.concatenate([ant.data.qpos.flat[2:15], ant.data.qvel.flat[:14]])
+    for name in ant._expose_body_coms or []:
+        obs = np.concatenate([obs, ant.get_body_com(name)])
+    for name in ant._expose_body_comvels or []:
+        obs = np.concatenate([obs, ant.get_body_comvel(name)])
+    return obs
+
+class AntObsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache_dir = maze_env.XML_CACHE_DIR
+        maze_env.XML_CACHE_DIR = self.tmp.name
+
+    def tearDown(self):
+        maze_env.XML_CACHE_DIR = self.cache_dir
+        self.tmp.cleanup()
+
+    def test_ant_obs(self):
+        for kwargs in [{}, {'expose_all_qpos': False},
+                       {'expose_body_coms': ['torso', 'leg'], 'expose_body_comvels': ['torso']}]:
+            ant = StubAnt(**kwargs)
+            expected = reference_obs(ant)
+            self.assertEqual(ant.obs_dim, len(expected))
+            self.assertTrue((ant._get_obs() == expected).all())
+            out = np.zeros(ant.obs_dim)
+            self.assertIs(ant._get_obs(out), out)
+            self.assertTrue((out == expected).all())
+        self.assertEqual(ant._body_com_indices['leg'], range(32, 35))
+        self.assertEqual(ant._body_comvel_indices['torso'], range(35, 38))
+
+    def test_env_with_goal_obs(self):
+        for obs_buffer in [False, True]:
+            env = EnvWithGoal(StubMazeEnv(maze_id='Maze'), 'AntMaze', obs_buffer)
+            ant = env.base_env.wrapped_env
+            np.random.seed(0)
+            obs = env.reset()
+            self.assertTrue((obs['observation'] == np.r_[reference_obs(ant), 0., 0]).all())
+
+            observations = []
+            for t in range(1, 4):
+                obs, reward, _, _ = env.step(np.zeros(8))
+                expected = np.r_[reference_obs(ant), t * 0.001, t]
+                self.assertTrue((obs['observation'] == expected).all())
+                self.assertTrue((obs['achieved_goal'] == expected[:2]).all())
+                self.assertEqual(reward, -np.sum(np.square(expected[:2] - env.goal)) ** 0.5)
+                observations.append(obs['observation'])
+            # Only the buffer mode hands out the same array every step
+            self.assertEqual(observations[0] is observations[1], obs_buffer)
+
+    def test_seeded_resets(self):
+        env = EnvWithGoal(StubMazeEnv(maze_id='Maze'), 'AntMaze')
+        observations = []
+        for seed in [3, 3, 4]:
+            env.seed(seed)
+            observations.append(env.reset()['observation'].copy())
+        self.assertTrue((observations[0] == observations[1]).all())
+        self.assertFalse((observations[0] == observations[2]).all())
+
+    def test_dims_without_simulator(self):
+        env = EnvWithGoal(StubMazeEnv(maze_id='Fall'), 'AntFall')
+        ant = env.base_env.wrapped_env
+        calls = []
+        ant._get_obs = lambda out=None: calls.append(out)
+        # Served from the cached space, without observing the env
+        self.assertIs(env.observation_space, env.base_env.observation_space)
+        self.assertEqual(env.observation_space.shape, (30,))
+        self.assertEqual(calls, [])
+
+        state_dim, goal_dim, action_dim, action_high = env_dims('AntFall')
+        self.assertEqual(state_dim, env.state_dim)
+        self.assertEqual(goal_dim, 3)
+        self.assertEqual(action_dim, 8)
+        self.assertTrue((action_high == 30).all())
+        self.assertEqual(env_dims('AntMaze')[:3], (31, 2, 8))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
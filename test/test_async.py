@@ -0,0 +1,108 @@
+import unittest
+import functools
+import multiprocessing as mp
+import time
+import numpy as np
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import torch
+from hiro.hiro_utils import LowReplayBuffer, HighIndexReplayBuffer
+from hiro.async_training import ActorPool, SharedWeights
+from hiro.models import TD3Actor
+from helpers import CountingEnv, spawn_hiro_agent, STATE_DIM, ACTION_DIM, SUBGOAL_DIM
+
+def fill_low(buffer, n):
+    for i in range(n):
+        buffer.append(np.full(STATE_DIM, i), np.zeros(SUBGOAL_DIM), np.zeros(ACTION_DIM),
+                      np.full(STATE_DIM, i+1), np.zeros(SUBGOAL_DIM), i, 0)
+
+class AsyncTest(unittest.TestCase):
+    def test_shared_buffer_across_processes(self):
+        buffer = LowReplayBuffer(STATE_DIM, SUBGOAL_DIM, ACTION_DIM, 100, 16)
+        fill_low(buffer, 10)
+        buffer.share_memory()
+
+        process = mp.get_context('fork').Process(target=fill_low, args=(buffer, 30))
+        process.start()
+        process.join()
+
+        self.assertEqual(buffer.size, 40)
+        self.assertEqual(buffer.total, 40)
+        self.assertTrue((buffer.state[:40, 0] == np.r_[np.arange(10), np.arange(30)]).all())
+        states, _, _, n_states = buffer.sample()[:4]
+        self.assertTrue((n_states[:, 0] == states[:, 0] + 1).all())
+
+    def test_index_buffer_can_not_be_shared(self):
+        agent = spawn_hiro_agent(high_buffer_index=True)
+        self.assertIsInstance(agent.replay_buffer_high, HighIndexReplayBuffer)
+        with self.assertRaises(ValueError):
+            ActorPool(agent, functools.partial(CountingEnv, 0), 1)
+
+    def test_shared_weights(self):
+        actor = TD3Actor(STATE_DIM, SUBGOAL_DIM, ACTION_DIM)
+        weights = SharedWeights([actor])
+        with torch.no_grad():
+            actor.l1.weight.add_(1)
+        copy = TD3Actor(STATE_DIM, SUBGOAL_DIM, ACTION_DIM)
+
+        self.assertEqual(weights.version, 0)
+        weights.publish([actor])
+        self.assertEqual(weights.pull([copy]), 1)
+        self.assertTrue((copy.l1.weight == actor.l1.weight).all())
+
+    def test_actor_pool(self):
+        agent = spawn_hiro_agent()
+        agent.start_training_steps = 100
+        pool = ActorPool(agent, functools.partial(CountingEnv, 0), 2,
+                         utd_ratio=0.5, max_staleness=50, start_training_steps=100)
+        pool.start()
+
+        episodes = 0
+        deadline = time.time() + 60
+        try:
+            while pool.updates < 100 and time.time() < deadline:
+                episodes += len(pool.finished_episodes())
+                # Actors never run further ahead than max_staleness
+                self.assertTrue(pool.env_steps <= 100 + pool.updates / 0.5 + 50 + 2)
+                if not pool.can_update():
+                    time.sleep(0.001)
+                    continue
+                losses, _ = agent.train(100 + pool.updates)
+                pool.record_update()
+                pool.publish()
+        finally:
+            pool.close()
+
+        self.assertEqual(pool.updates, 100)
+        self.assertTrue(pool.env_steps >= 100 + 100 / 0.5)
+        self.assertEqual(agent.replay_buffer_low.total, pool.env_steps)
+        self.assertTrue(episodes > 0)
+        self.assertIn('critic_loss_low', losses)
+
+    def test_updates_count_gradient_steps(self):
+        pool = ActorPool(spawn_hiro_agent(utd_low=8), functools.partial(CountingEnv, 0), 1)
+        pool._env_steps[0] = 10
+        pool.record_update(8)
+        self.assertEqual(pool.updates, 8)
+        self.assertTrue(pool.can_update())
+        pool.record_update(8)
+        self.assertFalse(pool.can_update())
+
+    def test_dead_actor(self):
+        def crash():
+            raise RuntimeError('env crashed')
+
+        pool = ActorPool(spawn_hiro_agent(), crash, 2)
+        pool.start()
+        deadline = time.time() + 30
+        try:
+            with self.assertRaisesRegex(RuntimeError, 'exited with code 1'):
+                while time.time() < deadline:
+                    pool.can_update()
+                    time.sleep(0.001)
+        finally:
+            pool.close()
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,35 @@
+import unittest
+import copy
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks.run import run_benchmarks, compare, stub_ant_maze_env
+
+class BenchmarkTest(unittest.TestCase):
+    def test_cases_run(self):
+        results = run_benchmarks(buffer_sizes=[1000], batch_sizes=[64], repeat=2, min_time=0., verbose=False)
+        expected = {
+            'sample_low/1000', 'sample_high/100', 'off_policy_corrections/100', 'td3_train/64', 'td3_train/64/fused_critic',
+            'train/utd1', 'train/utd8', 'target_update/loop', 'target_update/foreach', 'target_update/flat',
+            'act/1', 'act/1/noise', 'act/64', 'act/64/noise', 'get_tensor/1', 'get_tensor/100', 'agent_step',
+            'point_env_step', 'vec_point_env_step/64'}
+        # The stub ant needs gym.envs.mujoco, which old gym versions only
+        # import with mujoco_py installed
+        if stub_ant_maze_env() is not None:
+            expected |= {'ant_env_overhead', 'ant_env_overhead/obs_buffer'}
+        self.assertEqual(set(results), expected)
+        for result in results.values():
+            self.assertGreater(result['median_us'], 0)
+            self.assertLessEqual(result['min_us'], result['median_us'])
+
+    def test_compare_flags_regressions(self):
+        baseline = {'a': {'median_us': 10.}, 'b': {'median_us': 10.}, 'c': {'median_us': 10.}}
+        results = copy.deepcopy(baseline)
+        results['a']['median_us'] = 10.5
+        results['b']['median_us'] = 20.
+        results['d'] = {'median_us': 1.}
+        del results['c']
+        self.assertEqual(compare(results, baseline, tolerance=0.1), ['b'])
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,369 @@
+import unittest
+import numpy as np
+import sys, os
+import tempfile
+import copy
+import threading
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import torch
+from hiro.hiro_utils import ReplayBuffer, LowReplayBuffer, HighReplayBuffer, HighIndexReplayBuffer, SumTree
+from hiro.hiro_utils import BatchPrefetcher
+from helpers import spawn_hiro_agent, run_episodes, STATE_DIM, ACTION_DIM, GOAL_DIM, SUBGOAL_DIM, FREQ
+
+def fill_high(buffer, n):
+    for i in range(n):
+        buffer.append(
+            state=np.full(STATE_DIM, i),
+            goal=np.full(GOAL_DIM, i),
+            action=np.full(SUBGOAL_DIM, i),
+            n_state=np.full(STATE_DIM, i+1),
+            reward=i,
+            done=float(i % 2),
+            state_arr=np.full((FREQ, STATE_DIM), i) + np.arange(FREQ)[:, None],
+            action_arr=np.full((FREQ, ACTION_DIM), -i))
+
+def fill_episodes(buffer, num_envs, lengths):
+    # Appends num_envs envs stepping together; env i runs episodes of
+    # lengths[i] steps. State dims 0, 1, 2 hold the global index, the env
+    # and a number unique to the episode, so an achieved subgoal is zero in
+    # dims 1 and 2 iff it was reached in the same episode.
+    steps = np.zeros(num_envs, dtype=int)
+    episodes = np.arange(num_envs)
+    for _ in range(max(lengths) * 3):
+        s = np.zeros((num_envs, STATE_DIM))
+        s[:, 0] = buffer.total + np.arange(num_envs)
+        s[:, 1] = np.arange(num_envs)
+        s[:, 2] = episodes
+        n_s = s.copy()
+        n_s[:, 0] += 0.5
+        steps += 1
+        done = steps == lengths
+        goal = np.ones((num_envs, SUBGOAL_DIM))
+        if num_envs == 1:
+            buffer.append(s[0], goal[0], np.zeros(ACTION_DIM), n_s[0], goal[0], -1., float(done[0]))
+        else:
+            buffer.append_batch(s, goal, np.zeros((num_envs, ACTION_DIM)), n_s, goal,
+                                -np.ones(num_envs), done.astype(float))
+        episodes[done] += num_envs * (episodes.max() // num_envs + 1)
+        steps[done] = 0
+
+class BufferTest(unittest.TestCase):
+    def test_fields_share_storage(self):
+        buffer = LowReplayBuffer(STATE_DIM, SUBGOAL_DIM, ACTION_DIM, 100, 10)
+        buffer.append(np.ones(STATE_DIM), np.ones(SUBGOAL_DIM), np.ones(ACTION_DIM),
+                      np.ones(STATE_DIM), np.ones(SUBGOAL_DIM), 1, 0)
+
+        self.assertEqual(buffer.storage.dtype, np.float32)
+        self.assertEqual(buffer.storage[0].sum(), buffer.width)
+        self.assertTrue(np.shares_memory(buffer.state, buffer.storage))
+
+    def test_sample_shapes(self):
+        buffer = HighReplayBuffer(STATE_DIM, GOAL_DIM, SUBGOAL_DIM, ACTION_DIM, 100, 16, FREQ)
+        fill_high(buffer, 50)
+        states, goals, actions, n_states, rewards, not_done, states_arr, actions_arr = buffer.sample()
+
+        self.assertEqual(tuple(states.shape), (16, STATE_DIM))
+        self.assertEqual(tuple(goals.shape), (16, GOAL_DIM))
+        self.assertEqual(tuple(actions.shape), (16, SUBGOAL_DIM))
+        self.assertEqual(tuple(rewards.shape), (16, 1))
+        self.assertEqual(tuple(states_arr.shape), (16, FREQ, STATE_DIM))
+        self.assertEqual(tuple(actions_arr.shape), (16, FREQ, ACTION_DIM))
+        self.assertEqual(states_arr.dtype, torch.float32)
+
+    def test_sample_rows_are_consistent(self):
+        buffer = HighReplayBuffer(STATE_DIM, GOAL_DIM, SUBGOAL_DIM, ACTION_DIM, 100, 64, FREQ)
+        fill_high(buffer, 50)
+        states, goals, actions, n_states, rewards, not_done, states_arr, actions_arr = buffer.sample()
+
+        i = states[:, 0]
+        self.assertTrue((n_states[:, 0] == i + 1).all())
+        self.assertTrue((rewards[:, 0] == i).all())
+        self.assertTrue((not_done[:, 0] == 1 - i % 2).all())
+        self.assertTrue((states_arr[:, :, 0] == i[:, None] + torch.arange(FREQ)).all())
+        self.assertTrue((actions_arr == -i[:, None, None]).all())
+
+    def test_half_precision_storage(self):
+        buffer = ReplayBuffer(STATE_DIM, GOAL_DIM, ACTION_DIM, 100, 10, dtype=np.float16)
+        for i in range(20):
+            buffer.append(np.full(STATE_DIM, i), np.zeros(GOAL_DIM), np.zeros(ACTION_DIM),
+                          np.zeros(STATE_DIM), 0.5, 0)
+        states = buffer.sample()[0]
+
+        self.assertEqual(buffer.storage.dtype, np.float16)
+        self.assertEqual(states.dtype, torch.float32)
+        self.assertTrue((states < 20).all())
+
+    def test_samples_do_not_alias(self):
+        buffer = ReplayBuffer(STATE_DIM, GOAL_DIM, ACTION_DIM, 100, 10)
+        for i in range(20):
+            buffer.append(np.full(STATE_DIM, i), np.zeros(GOAL_DIM), np.zeros(ACTION_DIM),
+                          np.zeros(STATE_DIM), 0, 0)
+        first = buffer.sample()[0]
+        expected = first.clone()
+        for _ in range(5):
+            buffer.sample()
+
+        self.assertTrue((first == expected).all())
+
+    def test_disk_buffer_reopens(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'buffer', 'high')
+            buffer = HighReplayBuffer(STATE_DIM, GOAL_DIM, SUBGOAL_DIM, ACTION_DIM, 100, 16, FREQ,
+                                      storage_path=path)
+            fill_high(buffer, 30)
+            buffer.flush()
+            del buffer
+
+            buffer = HighReplayBuffer(STATE_DIM, GOAL_DIM, SUBGOAL_DIM, ACTION_DIM, 100, 16, FREQ,
+                                      storage_path=path)
+            self.assertIsInstance(buffer.storage, np.memmap)
+            self.assertEqual(buffer.size, 30)
+            self.assertEqual(buffer.ptr, 30)
+            self.assertTrue((buffer.state_arr[29, :, 0] == 29 + np.arange(FREQ)).all())
+
+            states, goals, actions, n_states = buffer.sample()[:4]
+            self.assertTrue((n_states[:, 0] == states[:, 0] + 1).all())
+
+    def test_disk_buffer_layout_mismatch(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'low')
+            buffer = LowReplayBuffer(STATE_DIM, SUBGOAL_DIM, ACTION_DIM, 100, 10, storage_path=path)
+            buffer.flush()
+            del buffer
+
+            with self.assertRaises(ValueError):
+                LowReplayBuffer(STATE_DIM, SUBGOAL_DIM, ACTION_DIM, 200, 10, storage_path=path)
+
+    def test_index_buffer_matches_copies(self):
+        copied = spawn_hiro_agent()
+        indexed = spawn_hiro_agent(high_buffer_index=True)
+        run_episodes([copied, indexed], [23, 40, 7, 31])
+
+        self.assertIsInstance(indexed.replay_buffer_high, HighIndexReplayBuffer)
+        self.assertEqual(copied.replay_buffer_high.size, indexed.replay_buffer_high.size)
+
+        np.random.seed(0)
+        expected = copied.replay_buffer_high.sample()
+        np.random.seed(0)
+        batch = indexed.replay_buffer_high.sample()
+
+        for x, y in zip(expected, batch):
+            self.assertEqual(x.shape, y.shape)
+            self.assertTrue((x == y).all())
+
+    def test_index_buffer_wraparound(self):
+        agent = spawn_hiro_agent(buffer_size=50, high_buffer_index=True)
+        run_episodes([agent], [23, 40, 7, 31, 18])
+        buffer = agent.replay_buffer_high
+
+        states, _, _, _, _, _, states_arr, actions_arr = buffer.sample()
+        first = states[:, 0]
+        low = agent.replay_buffer_low
+
+        self.assertTrue(buffer.size > 0)
+        self.assertTrue((first >= low.total - low.size).all())
+        self.assertTrue((states_arr[:, :, 0] == first[:, None] + torch.arange(FREQ)).all())
+        self.assertTrue((actions_arr[:, :, 0] == -states_arr[:, :, 0]).all())
+
+    def _check_relabeled(self, buffer, num_envs, lengths):
+        state, goal, _, n_state, n_goal, reward, _ = buffer.sample()
+        relabeled = (goal != 1).any(1)
+        self.assertTrue(relabeled.any())
+
+        # Achieved in the same episode, at the transition itself or later
+        g, s = goal[relabeled], state[relabeled]
+        self.assertTrue((g[:, 1:3] == 0).all())
+        self.assertTrue((g[:, 0] >= 0.5).all())
+        self.assertTrue((s[:, 0] + g[:, 0] < buffer.total).all())
+        self.assertTrue((g[:, 0] % num_envs == 0.5).all())
+        steps = (g[:, 0] - 0.5) / num_envs
+        self.assertTrue((steps < torch.from_numpy(np.asarray(lengths))[s[:, 1].long()]).all())
+
+        n_s = n_state[relabeled]
+        self.assertTrue(torch.allclose(n_goal[relabeled], s[:, :SUBGOAL_DIM] + g - n_s[:, :SUBGOAL_DIM]))
+        expected = -(s[:, :SUBGOAL_DIM] + g - n_s[:, :SUBGOAL_DIM]).norm(dim=1)
+        self.assertTrue(torch.allclose(reward[relabeled, 0], expected))
+        # Untouched rows keep what was stored
+        self.assertTrue((reward[~relabeled] == -1).all())
+        self.assertTrue((n_goal[~relabeled] == 1).all())
+
+    def test_her_relabels_within_episodes(self):
+        buffer = LowReplayBuffer(STATE_DIM, SUBGOAL_DIM, ACTION_DIM, 1000, 256, her_ratio=0.5)
+        fill_episodes(buffer, 1, [23])
+        self._check_relabeled(buffer, 1, [23])
+
+    def test_her_vec_envs_wraparound(self):
+        buffer = LowReplayBuffer(STATE_DIM, SUBGOAL_DIM, ACTION_DIM, 100, 256, her_ratio=0.8)
+        lengths = [7, 31, 12, 40]
+        fill_episodes(buffer, 4, lengths)
+        self.assertEqual(buffer.size, 100)
+        self._check_relabeled(buffer, 4, lengths)
+
+    def test_her_agent(self):
+        agent = spawn_hiro_agent(her_ratio=0.5)
+        run_episodes([agent], [40, 25])
+        losses, _ = agent.train(global_step=10)
+        self.assertIn('critic_loss_low', losses)
+        self.assertFalse(hasattr(spawn_hiro_agent().replay_buffer_low, 'episode_end'))
+        with self.assertRaises(ValueError):
+            agent.replay_buffer_low.share_memory()
+
+    def test_sum_tree(self):
+        tree = SumTree(5)
+        tree.update(np.arange(5), np.array([1., 2., 3., 4., 0.]))
+        self.assertEqual(tree.total(), 10.)
+
+        tree.set(4, 10.)
+        tree.update(np.array([0, 0, 1]), np.array([5., 5., 0.]))
+        self.assertEqual(tree.total(), 22.)
+
+        np.random.seed(0)
+        counts = np.bincount(tree.sample(22000), minlength=tree.leaf)
+        self.assertEqual(counts[1], 0)
+        self.assertEqual(counts[5:].sum(), 0)
+        self.assertTrue(np.allclose(counts[:5] / 22000., [5/22., 0., 3/22., 4/22., 10/22.], atol=0.01))
+
+    def test_prioritized_sample(self):
+        buffer = HighReplayBuffer(STATE_DIM, GOAL_DIM, SUBGOAL_DIM, ACTION_DIM, 100, 32, FREQ,
+                                  prioritized=True)
+        fill_high(buffer, 50)
+        batch = buffer.sample()
+        self.assertEqual(len(batch), 10)
+
+        ind, weights = batch[-2], batch[-1]
+        self.assertTrue((ind < 50).all())
+        self.assertEqual(tuple(weights.shape), (32, 1))
+        # All priorities are equal before the first update
+        self.assertTrue((weights == 1).all())
+
+        # 7 gets 100**0.6 / (49 + 100**0.6) ~ 1/4 of the mass
+        td_errors = np.ones(50)
+        td_errors[7] = 100.
+        buffer.update_priorities(np.arange(50), td_errors)
+        ind, weights = buffer.sample()[-2:]
+        self.assertTrue((ind == 7).sum() >= 6)
+        self.assertTrue((weights[torch.from_numpy(ind == 7)] == weights.min()).all())
+        self.assertTrue((weights[torch.from_numpy(ind != 7)] == 1).all())
+
+    def test_evicted_priorities_stay_zero(self):
+        # A slot evicted between sampling and the priority update (e.g. with
+        # prefetching) must not be sampled again
+        agent = spawn_hiro_agent(buffer_size=50, high_buffer_index=True, prioritized=True)
+        run_episodes([agent], [41])
+        buffer = agent.replay_buffer_high
+        ind = np.arange(buffer.size)
+        run_episodes([agent], [21])
+        buffer.sample()
+        live = (buffer.ptr - buffer.size + np.arange(buffer.size)) % buffer.buffer_size
+        evicted = np.setdiff1d(ind, live)
+        self.assertTrue(0 < len(evicted) < len(ind))
+
+        buffer.update_priorities(ind, np.full(len(ind), 100.))
+        self.assertTrue((buffer.tree.get(evicted) == 0).all())
+        self.assertTrue((buffer.tree.get(np.setdiff1d(ind, evicted)) > 1).all())
+        self.assertTrue(np.isin(buffer.sample()[-2], evicted, invert=True).all())
+
+    def test_prioritized_agent_train(self):
+        agent = spawn_hiro_agent(prioritized=True, high_buffer_index=True)
+        run_episodes([agent], [60])
+
+        before = agent.replay_buffer_high.tree.total()
+        losses, td_errors = agent.train(global_step=10)
+
+        self.assertIn('critic_loss_low', losses)
+        self.assertIn('critic_loss_high', losses)
+        self.assertNotEqual(agent.replay_buffer_high.tree.total(), before)
+
+    def test_prefetcher_with_concurrent_appends(self):
+        buffer = HighReplayBuffer(STATE_DIM, GOAL_DIM, SUBGOAL_DIM, ACTION_DIM, 100, 64, FREQ)
+        fill_high(buffer, 10)
+        sampler = BatchPrefetcher(buffer, num_batches=3)
+        writer = threading.Thread(target=fill_high, args=(buffer, 500))
+        writer.start()
+
+        for _ in range(50):
+            states, goals, actions, n_states, rewards, not_done, states_arr, actions_arr = sampler.sample()
+            i = states[:, 0]
+            self.assertEqual(tuple(states.shape), (64, STATE_DIM))
+            self.assertTrue((n_states[:, 0] == i + 1).all())
+            self.assertTrue((states_arr[:, :, 0] == i[:, None] + torch.arange(FREQ)).all())
+            self.assertTrue((actions_arr == -i[:, None, None]).all())
+        writer.join()
+        sampler.close()
+
+        self.assertEqual(sampler.batch_size, 64)
+        self.assertFalse(sampler.queue.qsize() > 3)
+
+    def test_prefetcher_raises_sampling_errors(self):
+        buffer = ReplayBuffer(STATE_DIM, GOAL_DIM, ACTION_DIM, 100, 10)
+        sampler = BatchPrefetcher(buffer)
+        with self.assertRaises(ValueError):
+            sampler.sample()
+        sampler.close()
+
+    def test_prefetch_agent_train(self):
+        agent = spawn_hiro_agent(high_buffer_index=True, prioritized=True, prefetch=2)
+        run_episodes([agent], [60])
+
+        for global_step in range(10, 41):
+            losses, td_errors = agent.train(global_step=global_step)
+        agent.sampler_low.close()
+        agent.sampler_high.close()
+
+        self.assertIsInstance(agent.sampler_high, BatchPrefetcher)
+        self.assertIn('critic_loss_high', losses)
+
+    def test_utd_matches_separate_updates(self):
+        # One call of utd_low updates trains like as many calls of one
+        # update: the big batch holds the same rows as the separate ones
+        agent = spawn_hiro_agent()
+        mega = spawn_hiro_agent(utd_low=4)
+        mega.load_state_dict(agent.state_dict())
+        run_episodes([agent, mega], [40, 25])
+
+        np.random.seed(0)
+        torch.manual_seed(0)
+        for _ in range(4):
+            expected, _ = agent.low_con.train(agent.sampler_low)
+        np.random.seed(0)
+        torch.manual_seed(0)
+        losses, _ = mega.low_con.train(mega.sampler_low, mega.utd_low)
+
+        self.assertEqual(mega.low_con.total_it, 4)
+        self.assertEqual(set(losses), set(expected))
+        for name in expected:
+            self.assertAlmostEqual(losses[name].item(), expected[name].item(), places=5)
+        for p, q in zip(mega.low_con.actor.parameters(), agent.low_con.actor.parameters()):
+            self.assertTrue(torch.allclose(p, q))
+
+    def test_utd_prefetch_prioritized(self):
+        agent = spawn_hiro_agent(high_buffer_index=True, prioritized=True, prefetch=2, utd_low=3, utd_high=2)
+        run_episodes([agent], [60])
+        losses, _ = agent.train(global_step=10)
+        agent.sampler_low.close()
+        agent.sampler_high.close()
+
+        self.assertEqual(agent.sampler_low.sample_size, 192)
+        self.assertEqual(agent.low_con.total_it, 3)
+        self.assertEqual(agent.high_con.total_it, 2)
+        self.assertIn('actor_loss_low', losses)
+        self.assertIn('actor_loss_high', losses)
+
+    def test_prefetch_agent_deepcopy(self):
+        # Trainer.evaluate runs on a deep copy of the agent
+        agent = spawn_hiro_agent(prefetch=2)
+        run_episodes([agent], [30])
+        agent.train(global_step=10)
+        copied = copy.deepcopy(agent)
+        agent.sampler_low.close()
+
+        self.assertIs(copied.sampler_low.replay_buffer, copied.replay_buffer_low)
+        self.assertEqual(copied.replay_buffer_low.size, 30)
+        losses, _ = copied.train(global_step=10)
+        self.assertIn('critic_loss_low', losses)
+        copied.sampler_low.close()
+        copied.sampler_high.close()
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
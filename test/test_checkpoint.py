@@ -0,0 +1,105 @@
+import unittest
+import os
+import tempfile
+import numpy as np
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import torch
+from hiro.utils import CheckpointWriter, load_checkpoint, get_rng_state, set_rng_state
+from helpers import spawn_hiro_agent, run_episodes
+
+def train(agent, steps, start=0):
+    losses = []
+    for global_step in range(start, start + steps):
+        loss, _ = agent.train(global_step)
+        losses.append({k: v.item() for k, v in loss.items()})
+    return losses
+
+class CheckpointTest(unittest.TestCase):
+    def _resume_matches(self, **kwargs):
+        agent = spawn_hiro_agent(**kwargs)
+        run_episodes([agent], [40, 25])
+        train(agent, 20)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'exp', 'checkpoint.pt')
+            writer = CheckpointWriter()
+            writer.save({'rng': get_rng_state(), 'agent': agent.state_dict()}, path)
+            # Training goes on while the checkpoint is written
+            expected = train(agent, 20, start=20)
+            run_episodes([agent], [15])
+            writer.wait()
+
+            state = load_checkpoint(path)
+            resumed = spawn_hiro_agent(**kwargs)
+            resumed.load_state_dict(state['agent'])
+            set_rng_state(state['rng'])
+
+        self.assertEqual(resumed.low_con.total_it, 20)
+        self.assertEqual(resumed.replay_buffer_low.size, 65)
+        self.assertEqual(train(resumed, 20, start=20), expected)
+
+    def test_resume_matches_uninterrupted_training(self):
+        self._resume_matches()
+
+    def test_resume_index_buffer_with_priorities(self):
+        self._resume_matches(high_buffer_index=True, prioritized=True)
+
+    def test_resume_disk_buffers(self):
+        # The disk backed buffers keep being written after the checkpoint,
+        # past a wrap of their rings
+        kwargs = dict(buffer_size=50, high_buffer_index=True, her_ratio=0.5)
+        with tempfile.TemporaryDirectory() as tmp:
+            kwargs['buffer_path'] = os.path.join(tmp, 'buffer')
+            agent = spawn_hiro_agent(**kwargs)
+            run_episodes([agent], [40, 25])
+            state = agent.state_dict()
+            expected = []
+            for buffer in [agent.replay_buffer_low, agent.replay_buffer_high]:
+                np.random.seed(0)
+                expected.append(buffer.sample())
+
+            run_episodes([agent], [30, 11])
+            agent.load_state_dict(state)
+            resumed = spawn_hiro_agent(**kwargs)
+            resumed.load_state_dict(state)
+
+            for a in [agent, resumed]:
+                for buffer, batch in zip([a.replay_buffer_low, a.replay_buffer_high], expected):
+                    np.random.seed(0)
+                    for x, y in zip(buffer.sample(), batch):
+                        self.assertTrue((x == y).all())
+
+    def test_rollout_state(self):
+        agent = spawn_hiro_agent()
+        run_episodes([agent], [23])
+        resumed = spawn_hiro_agent()
+        resumed.load_state_dict(agent.state_dict())
+
+        self.assertTrue((resumed.sg == agent.sg).all())
+        self.assertEqual(len(resumed.buf[6]), len(agent.buf[6]))
+        self.assertEqual(resumed.buf[3], agent.buf[3])
+
+    def test_buffer_layout_mismatch(self):
+        state = spawn_hiro_agent(buffer_size=100).state_dict()
+        with self.assertRaises(ValueError):
+            spawn_hiro_agent(buffer_size=200).load_state_dict(state)
+
+    def test_writer_reports_errors(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'checkpoint.pt')
+            writer = CheckpointWriter()
+            writer.save({'x': torch.zeros(3)}, path)
+            writer.wait()
+            self.assertTrue((load_checkpoint(path)['x'] == 0).all())
+            self.assertFalse(os.path.exists(path+'.tmp'))
+
+            writer.save({'x': lambda: None}, path)
+            with self.assertRaises(Exception):
+                writer.wait()
+            # The previous checkpoint is left intact
+            self.assertTrue((load_checkpoint(path)['x'] == 0).all())
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,214 @@
+import unittest
+import numpy as np
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import torch
+import copy
+from hiro.models import HigherController, LowerController
+from hiro.hiro_utils import Subgoal
+
+STATE_DIM = 31
+ACTION_DIM = 8
+GOAL_DIM = 2
+SUBGOAL_DIM = 15
+FREQ = 10
+
+def spawn_controllers(fused_critic=False, target_update='loop'):
+    subgoal = Subgoal(SUBGOAL_DIM)
+    scale_high = subgoal.action_space.high * np.ones(SUBGOAL_DIM)
+    scale_low = 30 * np.ones(ACTION_DIM)
+
+    high_con = HigherController(
+        state_dim=STATE_DIM,
+        goal_dim=GOAL_DIM,
+        action_dim=SUBGOAL_DIM,
+        scale=scale_high,
+        model_path='model',
+        fused_critic=fused_critic,
+        target_update=target_update)
+    low_con = LowerController(
+        state_dim=STATE_DIM,
+        goal_dim=SUBGOAL_DIM,
+        action_dim=ACTION_DIM,
+        scale=scale_low,
+        model_path='model',
+        fused_critic=fused_critic,
+        target_update=target_update)
+
+    return high_con, low_con
+
+def loop_corrections(high_con, low_con, candidates, states, actions):
+    # Reference: one lower policy call per candidate, in NumPy
+    batch_size, seq_len = states.shape[0], states.shape[1]
+    ncands = candidates.shape[1]
+    dim = high_con.action_dim
+
+    observations = states.reshape(batch_size*seq_len, -1)
+    true_actions = actions.reshape(batch_size*seq_len, -1)
+    policy_actions = np.zeros((ncands, batch_size*seq_len, actions.shape[-1]))
+
+    for c in range(ncands):
+        subgoal = candidates[:,c]
+        candidate = (subgoal + states[:, 0, :dim])[:, None] - states[:, :, :dim]
+        policy_actions[c] = low_con.policy(observations, candidate.reshape(-1, dim))
+
+    difference = (policy_actions - true_actions)
+    difference = difference.reshape((ncands, batch_size, seq_len, -1)).transpose(1, 0, 2, 3)
+    logprob = -0.5*np.sum(np.linalg.norm(difference, axis=-1)**2, axis=-1)
+
+    return np.argmax(logprob, axis=-1)
+
+class ControllerTest(unittest.TestCase):
+    def test_off_policy_corrections_shape(self):
+        high_con, low_con = spawn_controllers()
+        batch_size = 16
+
+        sgoals = torch.randn(batch_size, SUBGOAL_DIM)
+        states = torch.randn(batch_size, FREQ, STATE_DIM)
+        actions = torch.randn(batch_size, FREQ, ACTION_DIM)
+        corrected = high_con.off_policy_corrections(low_con, batch_size, sgoals, states, actions)
+
+        self.assertEqual(tuple(corrected.shape), (batch_size, SUBGOAL_DIM))
+        self.assertEqual(type(corrected), torch.Tensor)
+
+    def test_off_policy_corrections_match_loop(self):
+        high_con, low_con = spawn_controllers()
+        batch_size = 32
+
+        sgoals = torch.randn(batch_size, SUBGOAL_DIM)
+        states = torch.randn(batch_size, FREQ, STATE_DIM)
+        # Actions produced by the lower policy for the original subgoal,
+        # so the argmax is well separated from the random candidates
+        goals = (sgoals[:, None] + states[:, :1, :SUBGOAL_DIM]) - states[:, :, :SUBGOAL_DIM]
+        with torch.no_grad():
+            actions = low_con.actor(states.reshape(-1, STATE_DIM), goals.reshape(-1, SUBGOAL_DIM))
+        actions = actions.view(batch_size, FREQ, ACTION_DIM) + 0.01 * torch.randn(batch_size, FREQ, ACTION_DIM)
+
+        candidates = high_con._candidate_goals(sgoals, states)
+        batched = high_con._select_candidates(low_con, candidates, states, actions).numpy()
+        looped = loop_corrections(high_con, low_con, candidates.numpy(), states.numpy(), actions.numpy())
+
+        self.assertTrue((batched == looped).all())
+
+    def test_candidate_goals_within_limits(self):
+        high_con, _ = spawn_controllers()
+        batch_size = 64
+
+        sgoals = torch.zeros(batch_size, SUBGOAL_DIM)
+        states = torch.zeros(batch_size, FREQ, STATE_DIM)
+        candidates = high_con._candidate_goals(sgoals, states)
+        scale = high_con.actor.scale
+
+        self.assertEqual(tuple(candidates.shape), (batch_size, 10, SUBGOAL_DIM))
+        self.assertTrue((candidates[:, 2:].abs() <= scale).all())
+
+    def _train_pair(self, weights=None):
+        _, twin = spawn_controllers()
+        _, fused = spawn_controllers(fused_critic=True)
+        fused.actor.load_state_dict(twin.actor.state_dict())
+        fused.actor_target.load_state_dict(twin.actor_target.state_dict())
+        fused.critic.load_critics([twin.critic1, twin.critic2])
+        fused.critic_target.load_critics([twin.critic1_target, twin.critic2_target])
+
+        batch_size = 32
+        batch = [torch.randn(batch_size, STATE_DIM), torch.randn(batch_size, SUBGOAL_DIM),
+                 torch.randn(batch_size, ACTION_DIM), torch.randn(batch_size, 1),
+                 torch.randn(batch_size, STATE_DIM), torch.randn(batch_size, SUBGOAL_DIM),
+                 torch.ones(batch_size, 1), weights]
+        for _ in range(4):
+            torch.manual_seed(0)
+            expected, _ = twin._train(*batch)
+            torch.manual_seed(0)
+            losses, _ = fused._train(*batch)
+            for name in expected:
+                self.assertAlmostEqual(losses[name].item(), expected[name].item(), places=4)
+        return twin, fused
+
+    def test_fused_critic_matches_twin_critics(self):
+        twin, fused = self._train_pair()
+        for w, layer in zip(fused.critic_target.weights, [twin.critic2_target.l1, twin.critic2_target.l2, twin.critic2_target.l3]):
+            self.assertTrue(torch.allclose(w[1], layer.weight.t(), atol=1e-5))
+        for p, q in zip(fused.actor.parameters(), twin.actor.parameters()):
+            self.assertTrue(torch.allclose(p, q, atol=1e-5))
+
+    def test_fused_critic_importance_weights(self):
+        self._train_pair(weights=torch.rand(32, 1))
+
+    def test_fused_critic_state_dict(self):
+        _, fused = spawn_controllers(fused_critic=True)
+        state = fused.state_dict()
+        self.assertIn('critic_optimizer', state)
+        self.assertNotIn('critic1', state)
+        _, resumed = spawn_controllers(fused_critic=True)
+        resumed.load_state_dict(state)
+        for p, q in zip(fused.critic.parameters(), resumed.critic.parameters()):
+            self.assertTrue((p == q).all())
+
+    def _target_update_matches_loop(self, mode, fused_critic=False):
+        _, looped = spawn_controllers(fused_critic)
+        _, con = spawn_controllers(fused_critic, target_update=mode)
+        con.load_state_dict(looped.state_dict())
+        for target, _ in con._target_pairs():
+            with torch.no_grad():
+                for p in target.parameters():
+                    p.add_(torch.randn_like(p))
+        looped.load_state_dict(con.state_dict())
+
+        looped._update_target_networks(0.1)
+        con._update_target_networks(0.1)
+        for (target, _), (expected, _) in zip(con._target_pairs(), looped._target_pairs()):
+            for p, q in zip(target.parameters(), expected.parameters()):
+                self.assertTrue(torch.allclose(p, q, atol=1e-6))
+        return con
+
+    def test_foreach_target_update(self):
+        self._target_update_matches_loop('foreach')
+        self._target_update_matches_loop('foreach', fused_critic=True)
+
+    def test_flat_target_update(self):
+        con = self._target_update_matches_loop('flat', fused_critic=True)
+        self._target_update_matches_loop('flat')
+
+        # Parameters stay views of the flat buffers through training and copies
+        for con in [con, copy.deepcopy(con)]:
+            for module, flat in con._flat.items():
+                for p in module.parameters():
+                    self.assertEqual(p.untyped_storage().data_ptr(), flat.untyped_storage().data_ptr())
+            batch = [torch.randn(8, STATE_DIM), torch.randn(8, SUBGOAL_DIM), torch.randn(8, ACTION_DIM),
+                     torch.randn(8, 1), torch.randn(8, STATE_DIM), torch.randn(8, SUBGOAL_DIM), torch.ones(8, 1)]
+            con._train(*batch)
+            con._train(*batch)
+            before = con.actor_target.l1.weight.clone()
+            con._update_target_networks(1.0)
+            self.assertFalse((before == con.actor_target.l1.weight).all())
+            self.assertTrue((con.actor_target.l1.weight == con.actor.l1.weight).all())
+
+    def test_act_matches_actor(self):
+        _, low_con = spawn_controllers()
+        for rows in [1, 16, 1]:
+            states = np.random.randn(rows, STATE_DIM)
+            goals = np.random.randn(rows, SUBGOAL_DIM).astype(np.float32)
+            with torch.no_grad():
+                expected = low_con.actor(torch.FloatTensor(states), torch.FloatTensor(goals)).numpy().squeeze()
+
+            actions = low_con.policy(states.squeeze(), goals.squeeze())
+            self.assertEqual(actions.shape, expected.shape)
+            self.assertTrue(np.allclose(actions, expected, atol=1e-6))
+            # A new array every call, not a view of a reused buffer
+            self.assertFalse(np.shares_memory(actions, low_con.policy(states.squeeze(), goals.squeeze())))
+
+            noisy = low_con.policy_with_noise(states.squeeze(), goals.squeeze())
+            self.assertFalse(np.allclose(noisy, expected))
+            self.assertTrue((np.abs(noisy) <= 30).all())
+
+        self.assertEqual(sorted(low_con._act_cache), [1, 16])
+        copied = copy.deepcopy(low_con)
+        self.assertTrue(np.allclose(copied.policy(states, goals), low_con.policy(states, goals)))
+
+    def test_unknown_target_update(self):
+        with self.assertRaises(ValueError):
+            spawn_controllers(target_update='fused')
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,54 @@
+import unittest
+import functools
+import numpy as np
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from hiro.evaluation import EvaluationPool
+from helpers import CountingEnv, spawn_hiro_agent
+
+class RandomGoalEnv(CountingEnv):
+    # Goals are drawn from np.random like EnvWithGoal does, and the reward
+    # depends on the actions taken
+    def reset(self):
+        obs = super(RandomGoalEnv, self).reset()
+        self.goal = np.random.uniform(-10, 10, 2)
+        obs['desired_goal'] = self.goal
+        return obs
+
+    def step(self, a):
+        obs, _, done, info = super(RandomGoalEnv, self).step(a)
+        obs['desired_goal'] = self.goal
+        return obs, -np.linalg.norm(obs['observation'][2:4] - self.goal), done, info
+
+class EvaluationTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.pool = EvaluationPool(functools.partial(RandomGoalEnv, 0, 20), 2)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.pool.close()
+
+    def test_pool_matches_serial(self):
+        policy = spawn_hiro_agent().snapshot()
+        expected_rewards, expected_success = policy.evaluate_policy(RandomGoalEnv(0, 20), 5, seed=7)
+        rewards, success = self.pool.evaluate(policy, 5, seed=7)
+
+        self.assertEqual(rewards.shape, (5,))
+        self.assertTrue(np.allclose(rewards, expected_rewards))
+        self.assertEqual(success, expected_success)
+        # Episodes differ from each other, but not between runs
+        self.assertTrue(len(np.unique(rewards)) > 1)
+        self.assertTrue(np.allclose(self.pool.evaluate(policy, 5, seed=7)[0], rewards))
+
+    def test_async_evaluation(self):
+        policy = spawn_hiro_agent().snapshot()
+        result = self.pool.evaluate_async(policy, 4, seed=0)
+        rewards, _ = result.get()
+
+        self.assertTrue(result.ready())
+        self.assertTrue(np.allclose(rewards, self.pool.evaluate(policy, 4, seed=0)[0]))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,149 @@
+import unittest
+import copy
+import pickle
+import tempfile
+import subprocess
+import numpy as np
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import torch
+from hiro.export import export_actors, export_numpy_actors, ScriptedHiroPolicy
+from hiro.numpy_policy import NumpyHiroPolicy
+from envs import make_env
+from helpers import spawn_hiro_agent, run_episodes, STATE_DIM, SUBGOAL_DIM
+
+def trained_agent():
+    agent = spawn_hiro_agent()
+    run_episodes([agent], [40])
+    for global_step in range(10):
+        agent.train(global_step)
+    return agent
+
+def rollout(policy, seed, steps=50):
+    # States and actions of the first steps of a seeded PointMaze episode
+    env = make_env('PointMaze')
+    np.random.seed(seed)
+    env.seed(seed)
+    obs = env.reset()
+    s = obs['observation']
+    policy.set_final_goal(obs['desired_goal'])
+    states, actions = [], []
+    for step in range(steps):
+        a, _, s, _ = policy.step(s, env, step)
+        policy.end_step()
+        states.append(s)
+        actions.append(a)
+    return np.array(states), np.array(actions)
+
+class ExportTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.agent = trained_agent()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _check_matches_agent(self, method):
+        path = os.path.join(self.tmp.name, method)
+        meta = export_actors(self.agent.snapshot(), path, method)
+        self.assertEqual(meta['state_dim'], STATE_DIM)
+        self.assertEqual(meta['subgoal_dim'], SUBGOAL_DIM)
+
+        scripted = ScriptedHiroPolicy(path)
+        expected_states, expected_actions = rollout(self.agent.snapshot(), seed=3)
+        states, actions = rollout(scripted, seed=3)
+        self.assertTrue(np.allclose(actions, expected_actions, atol=1e-4))
+        self.assertTrue(np.allclose(states, expected_states, atol=1e-4))
+        return scripted
+
+    def test_script_matches_agent(self):
+        self._check_matches_agent('script')
+
+    def test_trace_matches_agent(self):
+        self._check_matches_agent('trace')
+
+    def test_batched_actors(self):
+        scripted = self._check_matches_agent('script')
+        s = np.random.randn(16, STATE_DIM)
+        sg = np.random.randn(16, SUBGOAL_DIM)
+        expected = self.agent.low_con.policy(s, sg)
+        self.assertEqual(scripted.action(s, sg).shape, expected.shape)
+        self.assertTrue(np.allclose(scripted.action(s, sg), expected, atol=1e-4))
+
+    def test_goal_dims(self):
+        # e.g. AntFall: fg keeps its 2-dim default until an episode starts
+        agent = spawn_hiro_agent(goal_dim=3)
+        meta = export_actors(agent, os.path.join(self.tmp.name, 'fall'))
+        export_numpy_actors(agent, os.path.join(self.tmp.name, 'fall.npz'))
+        self.assertEqual((meta['state_dim'], meta['goal_dim']), (STATE_DIM, 3))
+
+        s, fg = np.random.randn(4, STATE_DIM), np.random.randn(4, 3)
+        expected = agent.high_con.policy(s, fg)
+        for policy in [ScriptedHiroPolicy(os.path.join(self.tmp.name, 'fall')),
+                       NumpyHiroPolicy(os.path.join(self.tmp.name, 'fall.npz'))]:
+            self.assertEqual(policy.fg.shape, (3,))
+            self.assertTrue(np.allclose(policy.subgoal(s, fg), expected, atol=1e-5))
+
+    def test_copies_reload_actors(self):
+        scripted = self._check_matches_agent('script')
+        for policy in [pickle.loads(pickle.dumps(scripted)), scripted.snapshot()]:
+            self.assertIsNot(policy.low_actor, scripted.low_actor)
+            self.assertTrue((policy.sg == scripted.sg).all())
+            s, sg = np.random.randn(STATE_DIM), np.random.randn(SUBGOAL_DIM)
+            self.assertTrue(np.allclose(policy.action(s, sg), scripted.action(s, sg)))
+
+        with self.assertRaises(NotImplementedError):
+            scripted.step(np.zeros(STATE_DIM), None, 0, explore=True)
+
+class NumpyPolicyTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.agent = trained_agent()
+        self.filename = os.path.join(self.tmp.name, 'policy.npz')
+        export_numpy_actors(self.agent.snapshot(), self.filename)
+        self.policy = NumpyHiroPolicy(self.filename)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_matches_agent(self):
+        self.assertEqual(self.policy.subgoal_dim, SUBGOAL_DIM)
+        self.assertEqual(len(self.policy.fg), len(self.agent.fg))
+        self.assertTrue(np.allclose(self.policy.sg, self.agent.sg))
+
+        expected_states, expected_actions = rollout(self.agent.snapshot(), seed=3)
+        states, actions = rollout(self.policy, seed=3)
+        self.assertTrue(np.allclose(actions, expected_actions, atol=1e-4))
+        self.assertTrue(np.allclose(states, expected_states, atol=1e-4))
+
+        s, n_s = np.random.randn(STATE_DIM), np.random.randn(STATE_DIM)
+        sg = np.random.randn(SUBGOAL_DIM)
+        self.assertTrue(np.allclose(self.policy.subgoal_transition(s, sg, n_s),
+                                    self.agent.subgoal_transition(s, sg, n_s)))
+
+    def test_batched_actors(self):
+        for batch in [1, 16]:
+            s = np.random.randn(batch, STATE_DIM)
+            sg = np.random.randn(batch, SUBGOAL_DIM)
+            fg = np.random.randn(batch, len(self.agent.fg))
+            for actual, expected in [(self.policy.action(s, sg), self.agent.low_con.policy(s, sg)),
+                                     (self.policy.subgoal(s, fg), self.agent.high_con.policy(s, fg))]:
+                self.assertEqual(actual.dtype, np.float32)
+                self.assertEqual(actual.shape, expected.shape)
+                self.assertTrue(np.allclose(actual, expected, atol=1e-5))
+
+    def test_copies(self):
+        for policy in [pickle.loads(pickle.dumps(self.policy)), self.policy.snapshot()]:
+            s, sg = np.random.randn(STATE_DIM), np.random.randn(SUBGOAL_DIM)
+            self.assertTrue(np.allclose(policy.action(s, sg), self.policy.action(s, sg)))
+
+    def test_does_not_import_torch(self):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        code = ('import sys; from hiro.numpy_policy import NumpyHiroPolicy; '
+                'NumpyHiroPolicy(sys.argv[1]).action([0.] * %d, [0.] * %d); '
+                'assert "torch" not in sys.modules' % (STATE_DIM, SUBGOAL_DIM))
+        subprocess.check_call([sys.executable, '-c', code, self.filename], cwd=root)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
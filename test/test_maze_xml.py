@@ -0,0 +1,49 @@
+import unittest
+import os
+import tempfile
+import xml.etree.ElementTree as ET
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from envs import maze_env
+
+class FakeModel(object):
+    # Records the model file instead of loading it into MuJoCo
+    FILE = 'ant.xml'
+
+    def __init__(self, file_path=None):
+        self.file_path = file_path
+
+class FakeMazeEnv(maze_env.MazeEnv):
+    MODEL_CLASS = FakeModel
+
+class MazeXmlTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache_dir = maze_env.XML_CACHE_DIR
+        maze_env.XML_CACHE_DIR = self.tmp.name
+
+    def tearDown(self):
+        maze_env.XML_CACHE_DIR = self.cache_dir
+        self.tmp.cleanup()
+
+    def test_xml_is_shared(self):
+        path = FakeMazeEnv(maze_id='Maze').wrapped_env.file_path
+        self.assertEqual(os.path.dirname(path), self.tmp.name)
+        self.assertEqual(FakeMazeEnv(maze_id='Maze').wrapped_env.file_path, path)
+        self.assertEqual(os.listdir(self.tmp.name), [os.path.basename(path)])
+
+        self.assertNotEqual(FakeMazeEnv(maze_id='Maze', maze_size_scaling=4).wrapped_env.file_path, path)
+        self.assertNotEqual(FakeMazeEnv(maze_id='Push').wrapped_env.file_path, path)
+        self.assertEqual(len(os.listdir(self.tmp.name)), 3)
+
+    def test_xml_content(self):
+        env = FakeMazeEnv(maze_id='Fall')
+        tree = ET.parse(env.wrapped_env.file_path)
+        expected = env._build_tree(os.path.join(maze_env.MODEL_DIR, 'ant.xml'))
+        self.assertEqual(ET.tostring(tree.getroot()), ET.tostring(expected.getroot()))
+        self.assertIsNotNone(tree.find(".//geom[@name='elevated_0_0']"))
+        self.assertIsNotNone(tree.find(".//body[@name='moveable_2_2']"))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
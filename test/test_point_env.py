@@ -0,0 +1,74 @@
+import unittest
+import numpy as np
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from envs import make_env, EnvWithGoal, env_dims
+from envs.vec_env import DummyVecEnv
+from envs.point_maze_env import PointMazeEnv, VecPointMazeEnv
+
+def push(env, direction, steps=100):
+    for _ in range(steps):
+        obs, _, _, _ = env.step(np.tile(direction, 4))
+    return obs['observation'][:2]
+
+class PointEnvTest(unittest.TestCase):
+    def test_dimensions(self):
+        env = make_env('PointMaze')
+        # Same as AntMaze: 30 dims of state and time, 8 limbs
+        self.assertEqual(env.state_dim, 31)
+        self.assertEqual(env.action_dim, 8)
+        self.assertTrue((env.action_space.high == 30).all())
+
+        obs = env.reset()
+        self.assertEqual(obs['observation'].shape, (31,))
+        self.assertEqual(obs['desired_goal'].shape, (2,))
+        self.assertTrue((obs['achieved_goal'] == obs['observation'][:2]).all())
+        self.assertEqual(make_env('PointFall').reset()['desired_goal'].shape, (3,))
+
+        state_dim, goal_dim, action_dim, action_high = env_dims('PointMaze')
+        self.assertEqual((state_dim, goal_dim, action_dim), (env.state_dim, 2, env.action_dim))
+        self.assertTrue((action_high == env.action_space.high).all())
+
+    def test_walls(self):
+        env = make_env('PointMaze')
+        env.reset()
+        # The wall below row 2 of the maze starts at y = 4
+        xy = push(env, [0., 30.])
+        self.assertTrue(3. < xy[1] < 4. - env.base_env.radius)
+        # Slides along it to the corridor at x = 16, which leads up to the
+        # top row and back left to the evaluation goal
+        push(env, [30., 30.], 200)
+        xy = push(env, [-30., 30.], 200)
+        self.assertTrue(np.linalg.norm(xy - [0., 16.]) < 5.)
+
+    def test_vec_env_matches_single_envs(self):
+        num_envs, seed = 4, 3
+        vec = VecPointMazeEnv('PointMaze', num_envs, seed=seed)
+        dummy = DummyVecEnv([lambda: EnvWithGoal(PointMazeEnv(), 'PointMaze')] * num_envs, seed=seed)
+
+        np.random.seed(0)
+        expected = dummy.reset()
+        np.random.seed(0)
+        obs = vec.reset()
+        for k in obs:
+            self.assertTrue(np.allclose(obs[k], expected[k]))
+
+        rng = np.random.RandomState(0)
+        for step in range(501):
+            a = rng.uniform(-30, 30, (num_envs, 8))
+            obs, r, done, _ = vec.step(a)
+            expected, expected_r, expected_done, _ = dummy.step(a)
+            for k in obs:
+                self.assertTrue(np.allclose(obs[k], expected[k]))
+            self.assertTrue(np.allclose(r, expected_r))
+            self.assertTrue((done == expected_done).all())
+            if done[0]:
+                np.random.seed(step)
+                obs = vec.reset(0)
+                np.random.seed(step)
+                self.assertTrue(np.allclose(obs['observation'], dummy.reset(0)['observation']))
+        self.assertEqual(step, 500)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,65 @@
+import unittest
+import numpy as np
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from hiro.utils import profiler
+from helpers import spawn_hiro_agent, run_episodes
+
+class FakeLogger(object):
+    def __init__(self):
+        self.scalars = {}
+
+    def write(self, name, value, index):
+        self.scalars[name] = (value, index)
+
+class ProfilerTest(unittest.TestCase):
+    def tearDown(self):
+        profiler.disable()
+
+    def test_disabled_is_a_shared_noop(self):
+        self.assertIs(profiler.phase('act'), profiler.phase('critic_update', 'low'))
+        with profiler.phase('act'):
+            pass
+        profiler.step(0, FakeLogger())
+        self.assertEqual(profiler.summary(), '')
+
+    def test_training_phases(self):
+        agent = spawn_hiro_agent(prioritized=True)
+        run_episodes([agent], [40, 25])
+        profiler.enable(window=10, cuda_sync=False)
+        logger = FakeLogger()
+        for global_step in range(20):
+            agent.train(global_step)
+            profiler.step(global_step, logger)
+
+        for name in ['critic_target', 'critic_update', 'actor_update', 'target_update', 'sample', 'priorities']:
+            self.assertIn('profile/ms/low/' + name, logger.scalars)
+        self.assertIn('profile/ms/high/off_policy_correction', logger.scalars)
+        self.assertEqual(logger.scalars['profile/steps_per_sec'][1], 19)
+        self.assertGreaterEqual(logger.scalars['profile/ms/other'][0], 0)
+
+        self.assertIn('profile/per_sec/low/updates', logger.scalars)
+        self.assertIn('profile/per_sec/high/updates', logger.scalars)
+
+        summary = profiler.summary()
+        self.assertIn('low/critic_update', summary)
+        self.assertIn('20 steps', summary)
+        self.assertIn('20 low/updates', summary)
+        self.assertIn('2 high/updates', summary)
+
+    def test_nested_phases_count_once(self):
+        profiler.enable(window=1000, cuda_sync=False)
+        with profiler.phase('evaluate'):
+            with profiler.phase('act'):
+                pass
+        self.assertEqual(profiler._calls, {'evaluate': 1})
+
+    def test_rollout_phases(self):
+        profiler.enable(window=1000, cuda_sync=False)
+        agent = spawn_hiro_agent()
+        run_episodes([agent], [10])
+        self.assertEqual(profiler._calls['append'], 10)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,82 @@
+import unittest
+import numpy as np
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import torch
+from envs import get_reward_fn, get_batch_reward_fn, success_fn
+from hiro.hiro_utils import LowReplayBuffer, HighReplayBuffer, low_reward, subgoal_transition
+from helpers import spawn_hiro_agent, STATE_DIM, ACTION_DIM, SUBGOAL_DIM, GOAL_DIM, FREQ
+
+BATCH = 64
+
+class RewardTest(unittest.TestCase):
+    def setUp(self):
+        self.rng = np.random.RandomState(0)
+
+    def test_env_rewards(self):
+        obs = self.rng.randn(BATCH, STATE_DIM) * 10
+        for env_name, goal_dim in [('AntMaze', 2), ('AntPush', 2), ('AntFall', 3), ('PointMaze', 2)]:
+            goals = self.rng.randn(BATCH, goal_dim) * 10
+            reward_fn, batch_fn = get_reward_fn(env_name), get_batch_reward_fn(env_name)
+            expected = np.array([reward_fn(o, g) for o, g in zip(obs, goals)])
+
+            self.assertTrue(np.allclose(batch_fn(obs, goals), expected))
+            rewards = batch_fn(torch.from_numpy(obs), torch.from_numpy(goals))
+            self.assertTrue(np.allclose(rewards.numpy(), expected))
+            # Any leading axes, and one goal for every observation
+            self.assertTrue(np.allclose(batch_fn(obs.reshape(8, 8, -1), goals[0]).reshape(-1),
+                                        [reward_fn(o, goals[0]) for o in obs]))
+
+            successes = success_fn(expected / 5)
+            self.assertTrue((successes == [success_fn(r) for r in expected / 5]).all())
+            self.assertTrue(successes.any() and not successes.all())
+
+    def test_low_rewards(self):
+        agent = spawn_hiro_agent()
+        s = self.rng.randn(BATCH, STATE_DIM)
+        sg = self.rng.randn(BATCH, SUBGOAL_DIM)
+        n_s = self.rng.randn(BATCH, STATE_DIM)
+        expected_rewards = [agent.low_reward(*x) for x in zip(s, sg, n_s)]
+        expected_sgs = [agent.subgoal_transition(*x) for x in zip(s, sg, n_s)]
+
+        self.assertTrue(np.allclose(low_reward(s, sg, n_s), expected_rewards))
+        self.assertTrue(np.allclose(subgoal_transition(s, sg, n_s), expected_sgs))
+        self.assertTrue(np.allclose(agent.low_reward_batch(s, sg, n_s), expected_rewards))
+        tensors = [torch.from_numpy(x) for x in (s, sg, n_s)]
+        self.assertTrue(np.allclose(low_reward(*tensors).numpy(), expected_rewards))
+        self.assertTrue(np.allclose(subgoal_transition(*tensors).numpy(), expected_sgs))
+
+    def test_recompute_low_rewards(self):
+        agent = spawn_hiro_agent()
+        buffer = LowReplayBuffer(STATE_DIM, SUBGOAL_DIM, ACTION_DIM, 100, 10)
+        n = 80
+        s, n_s = self.rng.randn(n, STATE_DIM), self.rng.randn(n, STATE_DIM)
+        buffer.append_batch(s, self.rng.randn(n, SUBGOAL_DIM), self.rng.randn(n, ACTION_DIM), n_s,
+                            self.rng.randn(n, SUBGOAL_DIM), np.zeros(n), np.zeros(n))
+
+        # Relabel the goals of some transitions
+        ind = np.arange(10, 50)
+        goals = self.rng.randn(len(ind), SUBGOAL_DIM)
+        buffer.goal[ind] = goals
+        buffer.recompute_rewards(low_reward, ('state', 'goal', 'n_state'), ind)
+
+        expected = [agent.low_reward(s[i], buffer.goal[i], n_s[i]) for i in ind]
+        self.assertTrue(np.allclose(buffer.reward[ind, 0], expected, atol=1e-5))
+        self.assertTrue((buffer.reward[:10] == 0).all())
+        self.assertTrue((buffer.reward[50:] == 0).all())
+
+    def test_rescale_high_rewards(self):
+        buffer = HighReplayBuffer(STATE_DIM, GOAL_DIM, SUBGOAL_DIM, ACTION_DIM, 100, 10, FREQ)
+        n = 30
+        rewards = self.rng.randn(n)
+        buffer.append_batch(
+            self.rng.randn(n, STATE_DIM), self.rng.randn(n, GOAL_DIM), self.rng.randn(n, SUBGOAL_DIM),
+            self.rng.randn(n, STATE_DIM), rewards, np.zeros(n),
+            self.rng.randn(n, FREQ, STATE_DIM), self.rng.randn(n, FREQ, ACTION_DIM))
+        # reward_scaling 0.1 -> 1.0
+        buffer.recompute_rewards(lambda reward: reward * 10, ('reward',))
+        self.assertTrue(np.allclose(buffer.reward[:n, 0], rewards * 10, atol=1e-5))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
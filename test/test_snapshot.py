@@ -0,0 +1,59 @@
+import unittest
+import copy
+import numpy as np
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import torch
+from hiro.models import HiroAgent, HiroPolicy, TD3Agent, TD3Policy
+from helpers import CountingEnv, spawn_hiro_agent, STATE_DIM, ACTION_DIM, GOAL_DIM
+
+def evaluate(agent, episodes=2):
+    np.random.seed(0)
+    torch.manual_seed(0)
+    return agent.evaluate_policy(CountingEnv(0, length=30), episodes)
+
+class SnapshotTest(unittest.TestCase):
+    def test_hiro_snapshot_matches_agent(self):
+        agent = spawn_hiro_agent()
+        agent.set_final_goal(np.array([3., 4.]))
+        policy = agent.snapshot()
+
+        self.assertIsInstance(policy, HiroPolicy)
+        self.assertFalse(hasattr(policy, 'replay_buffer_low'))
+        self.assertFalse(hasattr(policy.low_con, 'critic1'))
+
+        rewards, success = evaluate(policy)
+        expected_rewards, expected_success = evaluate(copy.deepcopy(agent))
+        self.assertTrue((rewards == expected_rewards).all())
+        self.assertEqual(success, expected_success)
+
+    def test_snapshot_is_a_copy(self):
+        agent = spawn_hiro_agent()
+        policy = agent.snapshot()
+        with torch.no_grad():
+            agent.low_con.actor.l1.weight.add_(1)
+
+        self.assertFalse((policy.low_con.actor.l1.weight == agent.low_con.actor.l1.weight).any())
+        with self.assertRaises(NotImplementedError):
+            policy.train(0)
+
+    def test_td3_snapshot(self):
+        agent = TD3Agent(
+            state_dim=STATE_DIM,
+            action_dim=ACTION_DIM,
+            goal_dim=GOAL_DIM,
+            scale=30 * np.ones(ACTION_DIM),
+            model_path='model',
+            model_save_freq=1000,
+            buffer_size=1000,
+            batch_size=64,
+            start_training_steps=0)
+        policy = agent.snapshot()
+
+        self.assertIsInstance(policy, TD3Policy)
+        rewards, _ = evaluate(policy, episodes=1)
+        self.assertEqual(rewards.shape, (1,))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,99 @@
+import unittest
+import numpy as np
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from envs.vec_env import DummyVecEnv, SubprocVecEnv
+from helpers import counting_env_fns, spawn_hiro_agent, STATE_DIM, ACTION_DIM, SUBGOAL_DIM, FREQ
+
+class VecEnvTest(unittest.TestCase):
+    def test_subproc_matches_dummy(self):
+        dummy = DummyVecEnv(counting_env_fns(3))
+        subproc = SubprocVecEnv(counting_env_fns(3))
+        try:
+            for x, y in zip(dummy.reset()['observation'], subproc.reset()['observation']):
+                self.assertTrue((x == y).all())
+
+            actions = np.random.randn(3, ACTION_DIM)
+            expected = dummy.step(actions)
+            result = subproc.step(actions)
+            self.assertTrue((expected[0]['observation'] == result[0]['observation']).all())
+            self.assertTrue((expected[1] == result[1]).all())
+            self.assertEqual(result[0]['observation'].shape, (3, STATE_DIM))
+
+            obs = subproc.reset(1)
+            self.assertEqual(obs['observation'].shape, (1, STATE_DIM))
+            self.assertEqual(obs['observation'][0, 1], 1)
+        finally:
+            subproc.close()
+
+    def test_step_envs_keeps_per_env_subgoals(self):
+        agent = spawn_hiro_agent()
+        envs = DummyVecEnv(counting_env_fns(4))
+        obs = envs.reset()
+        agent.init_envs(obs['desired_goal'])
+        s = obs['observation']
+
+        # Envs 0 and 2 start a new window and ask the high policy
+        steps = np.array([0, 3, 10, 7])
+        sgs = agent.sgs.copy()
+        a, r, n_s, done = agent.step_envs(s, envs, steps)
+
+        self.assertEqual(a.shape, (4, ACTION_DIM))
+        self.assertEqual(agent.n_sgs.shape, (4, SUBGOAL_DIM))
+        for i in [1, 3]:
+            expected = agent.subgoal_transition(s[i], sgs[i], n_s[i])
+            self.assertTrue(np.allclose(agent.n_sgs[i], expected))
+        for i in [0, 2]:
+            expected = agent.high_con.policy(s[i], agent.fgs[i])
+            self.assertTrue(np.allclose(agent.n_sgs[i], expected, atol=1e-5))
+
+    def test_vec_rollout_windows(self):
+        num_envs = 3
+        agents = [spawn_hiro_agent(), spawn_hiro_agent(high_buffer_index=True)]
+        # Episodes of 2 * FREQ steps: the last window of an episode is one
+        # step short, so carrying it over would complete it in the next one
+        envs = DummyVecEnv(counting_env_fns(num_envs, length=2 * FREQ))
+        obs = envs.reset()
+        s = obs['observation']
+        steps = np.zeros(num_envs, dtype=int)
+        for agent in agents:
+            agent.init_envs(obs['desired_goal'])
+
+        for _ in range(80):
+            a = np.random.randn(num_envs, ACTION_DIM)
+            obs, r, done, _ = envs.step(a)
+            n_s = obs['observation']
+            n_sgs = np.random.randn(num_envs, SUBGOAL_DIM)
+            for agent in agents:
+                agent.n_sgs = n_sgs
+                agent.append_envs(steps, s, a, n_s, r, done)
+                agent.end_step_envs()
+            s, steps = n_s, steps + 1
+            for i in np.flatnonzero(done):
+                for agent in agents:
+                    agent.end_episode_env(i, episode=0)
+                s[i] = envs.reset(i)['observation'][0]
+                steps[i] = 0
+
+        copied, indexed = agents[0].replay_buffer_high, agents[1].replay_buffer_high
+        self.assertEqual(agents[0].replay_buffer_low.size, 80 * num_envs)
+        self.assertEqual(copied.size, indexed.size)
+
+        np.random.seed(0)
+        expected = copied.sample()
+        np.random.seed(0)
+        batch = indexed.sample()
+        for x, y in zip(expected, batch):
+            self.assertTrue((x == y).all())
+
+        # Every window holds freq consecutive steps of a single env
+        states, states_arr, actions_arr = batch[0], batch[-2], batch[-1]
+        self.assertTrue((states_arr[:, :, 1] == states[:, None, 1]).all())
+        counts = states_arr[:, :, 0].numpy()
+        diffs = np.diff(counts, axis=1)
+        self.assertTrue((diffs == 1).all())
+        self.assertTrue((actions_arr[:, :-1].numpy() == states_arr[:, 1:, 2:2+ACTION_DIM].numpy()).all())
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)